@@ -0,0 +1,52 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# compare calculating the AccurateRip checksums of a track at many read
+# offsets with accurip.shifted_checksums against checksumming the track
+# again for every offset
+#
+# usage: benchmark_offsets.py [seconds of audio] [number of offsets]
+
+import sys
+import time
+
+import numpy
+
+from whipper.common import accurip
+
+seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 240
+count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+length = seconds * 44100
+margin = 2000
+offsets = [int(o) for o in numpy.linspace(-margin, margin, count)]
+samples = numpy.random.randint(0, 2 ** 32, size=length + 2 * margin,
+                               dtype=numpy.uint64).astype(numpy.uint32)
+print('%d seconds of audio, %d offsets' % (seconds, len(offsets)))
+
+
+def naive():
+    checksums = {}
+    for offset in offsets:
+        arc = accurip.AccurateRipChecksum(length, 2, 3)
+        arc.update(samples[margin + offset:
+                           margin + offset + length].tobytes())
+        checksums[offset] = (arc.v1, arc.v2)
+    return checksums
+
+
+def timed(name, function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    print('%-24s %8.3f s' % (name, time.time() - start))
+    return result
+
+
+expected = timed('naive', naive)
+shifted = timed('shifted, v1 and v2', accurip.shifted_checksums,
+                samples, margin, length, offsets, 2, 3)
+v1 = timed('shifted, v1 only', accurip.shifted_checksums,
+           samples, margin, length, offsets, 2, 3, v2=False)
+
+assert shifted == expected
+assert dict([(o, (c[0], None)) for o, c in expected.items()]) == v1
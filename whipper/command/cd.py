@@ -18,11 +18,16 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
 import argparse
 import cdio
+import copy
 import os
 import glob
 import logging
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 from whipper.command.basecommand import BaseCommand
 from whipper.common import (
     accurip, config, drive, program, task
@@ -65,6 +70,14 @@ disc and track template are:
 
 class _CD(BaseCommand):
     eject = True
+    # whether other drives are handled at the same time, in other threads
+    concurrent = False
+    pool = None
+    # whether to fetch the AccurateRip entry while looking up metadata
+    accuraterip = False
+
+    # only one drive at a time looks up metadata, as it may prompt
+    _metadataLock = threading.Lock()
 
     @staticmethod
     def add_arguments(parser):
@@ -84,7 +97,8 @@ class _CD(BaseCommand):
         self.config = config.Config()
         self.program = program.Program(self.config,
                                        record=self.options.record)
-        self.runner = task.SyncRunner()
+        self.runner = task.SyncRunner(verbose=not self.concurrent,
+                                      private=self.concurrent)
 
         # if the device is mounted (data session), unmount it
         self.device = self.options.device
@@ -96,6 +110,8 @@ class _CD(BaseCommand):
         # first, read the normal TOC, which is fast
         logger.info("reading TOC...")
         self.ittoc = self.program.getFastToc(self.runner, self.device)
+        if self.accuraterip:
+            self.program.prefetchAccurateRip(self.ittoc)
 
         # already show us some info based on this
         self.program.getRipResult(self.ittoc.getCDDBDiscId())
@@ -106,26 +122,7 @@ class _CD(BaseCommand):
         print("MusicBrainz lookup URL %s" %
               self.ittoc.getMusicBrainzSubmitURL())
 
-        self.program.metadata = (
-            self.program.getMusicBrainz(self.ittoc, self.mbdiscid,
-                                        release=self.options.release_id,
-                                        country=self.options.country,
-                                        prompt=self.options.prompt)
-        )
-
-        if not self.program.metadata:
-            # fall back to FreeDB for lookup
-            cddbid = self.ittoc.getCDDBValues()
-            cddbmd = self.program.getCDDB(cddbid)
-            if cddbmd:
-                logger.info('FreeDB identifies disc as %s', cddbmd)
-
-            # also used by rip cd info
-            if not getattr(self.options, 'unknown', False):
-                logger.critical("unable to retrieve disc metadata, "
-                                "--unknown argument not passed")
-                return -1
-
+        # before cdrdao starts reading the table, as it uses the drive too
         self.program.result.isCdr = cdrdao.DetectCdr(self.device)
         if (self.program.result.isCdr and
                 not getattr(self.options, 'cdr', False)):
@@ -133,21 +130,11 @@ class _CD(BaseCommand):
                             "--cdr not passed")
             return -1
 
-        # Change working directory before cdrdao's task
-        if self.options.working_directory is not None:
-            os.chdir(os.path.expanduser(self.options.working_directory))
-        out_bpath = self.options.output_directory.decode('utf-8')
-        # Needed to preserve cdrdao's tocfile
-        out_fpath = self.program.getPath(out_bpath,
-                                         self.options.disc_template,
-                                         self.mbdiscid,
-                                         self.program.metadata)
-        # now, read the complete index table, which is slower
-        self.itable = self.program.getTable(self.runner,
-                                            self.ittoc.getCDDBDiscId(),
-                                            self.ittoc.getMusicBrainzDiscId(),
-                                            self.device, self.options.offset,
-                                            out_fpath)
+        # now, read the complete index table, which is slower, while the
+        # metadata is looked up
+        self.itable = self._readTable(self._lookUpMetadata)
+        if self.itable is None:
+            return -1
 
         assert self.itable.getCDDBDiscId() == self.ittoc.getCDDBDiscId(), \
             "full table's id %s differs from toc id %s" % (
@@ -174,7 +161,7 @@ class _CD(BaseCommand):
         if info:
             try:
                 self.program.result.cdparanoiaDefeatsCache = \
-                    self.config.getDefeatsCache(*info)
+                    drive.getDatabase().getDefeatsCache(*info)
             except KeyError as e:
                 logger.debug('got key error: %r', (e, ))
         self.program.result.artist = self.program.metadata \
@@ -192,6 +179,87 @@ class _CD(BaseCommand):
         if self.options.eject in ('success', 'always'):
             utils.eject_device(self.device)
 
+    def _lookUpMetadata(self):
+        """
+        Look up the metadata of the disc.
+
+        @returns: where to save cdrdao's tocfile, or None if the disc can't
+                  be handled without metadata
+        @rtype:   unicode or None
+        """
+        with self._metadataLock:
+            self.program.metadata = (
+                self.program.getMusicBrainz(self.ittoc, self.mbdiscid,
+                                            release=self.options.release_id,
+                                            country=self.options.country,
+                                            prompt=self.options.prompt)
+            )
+
+        if not self.program.metadata:
+            # fall back to FreeDB for lookup
+            cddbid = self.ittoc.getCDDBValues()
+            cddbmd = self.program.getCDDB(cddbid)
+            if cddbmd:
+                logger.info('FreeDB identifies disc as %s', cddbmd)
+
+            # also used by rip cd info
+            if not getattr(self.options, 'unknown', False):
+                logger.critical("unable to retrieve disc metadata, "
+                                "--unknown argument not passed")
+                return None
+
+        # Change working directory before cdrdao's task
+        if self.options.working_directory is not None:
+            os.chdir(os.path.expanduser(self.options.working_directory))
+        out_bpath = self.options.output_directory.decode('utf-8')
+        # Needed to preserve cdrdao's tocfile
+        return self.program.getPath(out_bpath, self.options.disc_template,
+                                    self.mbdiscid, self.program.metadata)
+
+    def _readTable(self, lookUp):
+        """
+        Read the complete index table while calling lookUp.
+
+        cdrdao's tocfile is saved next to the rip, so lookUp returns where
+        to.  When it returns None or raises instead, cdrdao is killed
+        rather than waited for.
+
+        @rtype: L{whipper.image.table.Table} or None
+        """
+        tocPath = Queue.Queue(1)
+        cdrdaos = Queue.Queue()
+        # lookUp may print and prompt in the meantime, so the table is
+        # read with a runner of its own that doesn't
+        runner = task.SyncRunner(verbose=False, private=self.concurrent)
+        pool = ThreadPool(1)
+        table = pool.apply_async(self.program.getTable, (
+            runner, self.ittoc.getCDDBDiscId(), self.mbdiscid, self.device,
+            self.options.offset, tocPath.get, cdrdaos.put))
+        pool.close()
+
+        path = None
+        try:
+            path = lookUp()
+        finally:
+            tocPath.put(path)
+            # wait with a timeout, so we can be interrupted
+            while not table.ready():
+                if path is not None:
+                    table.wait(1.0)
+                    continue
+                # the table is not needed after all
+                try:
+                    cdrdao = cdrdaos.get(True, 1.0)
+                except Queue.Empty:
+                    continue
+                if cdrdao.poll() is None:
+                    logger.debug('killing cdrdao')
+                    cdrdao.kill()
+
+        if path is None:
+            return None
+        return table.get()
+
     def doCommand(self):
         pass
 
@@ -210,6 +278,7 @@ class Info(_CD):
 
 class Rip(_CD):
     summary = "rip CD"
+    accuraterip = True
     # see whipper.common.program.Program.getPath for expansion
     description = """
 Rips a CD.
@@ -233,7 +302,7 @@ Log files will log the path to tracks relative to this directory.
         info = drive.getDeviceInfo(self.opts.device)
         if info:
             try:
-                default_offset = config.Config().getReadOffset(*info)
+                default_offset = drive.getDatabase().getReadOffset(*info)
                 logger.info("using configured read offset %d", default_offset)
             except KeyError:
                 pass
@@ -286,6 +355,54 @@ Log files will log the path to tracks relative to this directory.
                                  help="whether to continue ripping if "
                                  "the disc is a CD-R",
                                  default=False)
+        self.parser.add_argument('--repair',
+                                 action="store_true", dest="repair",
+                                 help="when the test and copy reads of a "
+                                 "track differ, only read the differing "
+                                 "parts again, until two reads agree",
+                                 default=False)
+        self.parser.add_argument('--backend',
+                                 action="store", dest="backend",
+                                 choices=cdparanoia.BACKENDS,
+                                 default='cdparanoia',
+                                 help="what to read audio with: the "
+                                 "cd-paranoia program, or libcdio in "
+                                 "whipper itself, which needs pycdio "
+                                 "(default: %(default)s)")
+        self.parser.add_argument('--stream',
+                                 action="store_true", dest="stream",
+                                 help="encode each track while it is "
+                                 "read, without writing it to a "
+                                 "temporary file first; can't be used "
+                                 "with --repair, --pipeline or --drives",
+                                 default=False)
+        self.parser.add_argument('--single-read',
+                                 action="store", dest="single_read",
+                                 type=int, metavar="CONFIDENCE",
+                                 help="read a track only once when its "
+                                 "AccurateRip checksum matches the "
+                                 "database with at least this confidence, "
+                                 "instead of reading it twice to verify "
+                                 "it")
+        self.parser.add_argument('--pipeline',
+                                 action="store_true", dest="pipeline",
+                                 help="encode and tag tracks in the "
+                                 "background while the next track is "
+                                 "being read",
+                                 default=False)
+        self.parser.add_argument('--workers',
+                                 action="store", dest="workers", type=int,
+                                 default=multiprocessing.cpu_count(),
+                                 help="number of tracks to encode at the "
+                                 "same time with --pipeline or --drives "
+                                 "(default: %(default)s)")
+        self.parser.add_argument('--drives',
+                                 action="store", dest="drives",
+                                 help="rip from several drives at the same "
+                                 "time: a comma-separated list of devices, "
+                                 "or 'all'; drives other than the one "
+                                 "given with --device use their configured "
+                                 "read offset")
 
     def handle_arguments(self):
         self.options.output_directory = os.path.expanduser(
@@ -297,7 +414,11 @@ Log files will log the path to tracks relative to this directory.
         self.options.disc_template = self.options.disc_template.decode('utf-8')
         validate_template(self.options.disc_template, 'disc')
 
-        if self.options.offset is None:
+        self.drives = []
+        if self.options.drives:
+            self.drives = self._getDrives(self.options.drives)
+
+        if self.options.offset is None and not self.drives:
             raise ValueError("Drive offset is unconfigured.\n"
                              "Please install pycdio and run 'whipper offset "
                              "find' to detect your drive's offset or set it "
@@ -305,6 +426,18 @@ Log files will log the path to tracks relative to this directory.
                              "also be specified at runtime using the "
                              "'--offset=value' argument")
 
+        if self.options.workers < 1:
+            raise ValueError("--workers needs to be at least 1")
+
+        if self.options.single_read is not None and \
+                self.options.single_read < 1:
+            raise ValueError("--single-read needs a confidence of at least 1")
+
+        if self.options.stream and (self.options.repair or
+                                    self.options.pipeline or self.drives):
+            raise ValueError("--stream can't be used with --repair, "
+                             "--pipeline or --drives")
+
         if self.options.working_directory is not None:
             self.options.working_directory = os.path.expanduser(
                 self.options.working_directory)
@@ -317,11 +450,103 @@ Log files will log the path to tracks relative to this directory.
                 logger.critical(msg)
                 raise ValueError(msg)
 
+    def _getDrives(self, drives):
+        """
+        @returns: the devices to rip from, with their read offsets
+        @rtype:   list of (str, int)
+        """
+        if drives == 'all':
+            devices = drive.getAllDevicePaths()
+        else:
+            devices = [d.strip() for d in drives.split(',') if d.strip()]
+
+        result = []
+        for device in devices:
+            device = os.path.realpath(device)
+            if not os.path.exists(device):
+                raise IOError('CD-DA device %s not found!' % device)
+            if device in [d for d, _ in result]:
+                continue
+
+            offset = None
+            if device == self.options.device:
+                offset = self.options.offset
+            else:
+                info = drive.getDeviceInfo(device)
+                if info:
+                    try:
+                        offset = drive.getDatabase().getReadOffset(*info)
+                    except KeyError:
+                        pass
+            if offset is None:
+                raise ValueError("Drive offset of %s is unconfigured.\n"
+                                 "Please run 'whipper offset find' for it "
+                                 "or set it manually in the configuration "
+                                 "file." % device)
+            result.append((device, offset))
+
+        return result
+
+    def do(self):
+        if not self.drives:
+            return _CD.do(self)
+
+        # the working directory is the same for every drive, and changing
+        # to it is not safe once their threads run, so do it only once
+        if self.options.working_directory is not None:
+            logger.info('changing to working directory %s',
+                        self.options.working_directory)
+            os.chdir(self.options.working_directory)
+
+        # tracks from all drives are encoded by the same workers
+        pool = ThreadPool(self.options.workers)
+        failed = []
+
+        def rip(command):
+            try:
+                if _CD.do(command):
+                    failed.append(command.options.device)
+            except Exception as e:
+                logger.critical('ripping from %s failed: %s',
+                                command.options.device, e)
+                failed.append(command.options.device)
+
+        threads = []
+        for device, offset in self.drives:
+            command = copy.copy(self)
+            command.options = copy.copy(self.options)
+            command.options.device = device
+            command.options.offset = offset
+            command.options.working_directory = None
+            command.concurrent = True
+            command.pool = pool
+
+            logger.info('ripping from %s with read offset %s',
+                        device, offset)
+            t = threading.Thread(target=rip, args=(command, ), name=device)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        try:
+            for t in threads:
+                # join with a timeout, so we can be interrupted
+                while t.is_alive():
+                    t.join(1.0)
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed:
+            logger.critical('ripping failed on %s', ', '.join(failed))
+            return 1
+
     def doCommand(self):
         self.program.setWorkingDirectory(self.options.working_directory)
         self.program.outdir = self.options.output_directory.decode('utf-8')
         self.program.result.offset = int(self.options.offset)
         self.program.result.overread = self.options.overread
+        self.program.result.backend = self.options.backend
         self.program.result.logger = self.options.logger
 
         discName = self.program.getPath(self.program.outdir,
@@ -341,6 +566,31 @@ Log files will log the path to tracks relative to this directory.
                         dirname.encode('utf-8'))
             os.makedirs(dirname)
 
+        # used to decide whether tracks need to be read again
+        try:
+            responses = self.program.getAccurateRip(self.ittoc)
+        except accurip.EntryNotFound:
+            responses = None
+            if self.options.single_read:
+                logger.warning('AccurateRip entry not found, reading every '
+                               'track twice')
+
+        # tracks being encoded in the background, by track number
+        pool = self.pool
+        pending = {}
+        if self.options.pipeline and not pool:
+            pool = ThreadPool(self.options.workers)
+
+        def _waitForEncode(number):
+            job = pending.pop(number, None)
+            if job is None:
+                return
+            try:
+                job.get()
+            except Exception as e:
+                logger.critical('encoding track %d failed: %r', number, e)
+                raise RuntimeError("track %d can't be encoded" % number)
+
         # FIXME: turn this into a method
 
         def _ripIfNotRipped(number):
@@ -403,16 +653,23 @@ Log files will log the path to tracks relative to this directory.
                     try:
                         logger.debug('ripIfNotRipped: track %d, try %d',
                                      number, tries)
-                        self.program.ripTrack(self.runner, trackResult,
-                                              offset=int(self.options.offset),
-                                              device=self.device,
-                                              taglist=self.program.getTagList(
-                                                  number, self.mbdiscid),
-                                              overread=self.options.overread,
-                                              what='track %d of %d%s' % (
-                                                  number,
-                                                  len(self.itable.tracks),
-                                                  extra))
+                        job = self.program.ripTrack(
+                            self.runner, trackResult,
+                            offset=int(self.options.offset),
+                            device=self.device,
+                            taglist=self.program.getTagList(
+                                number, self.mbdiscid),
+                            overread=self.options.overread,
+                            what='track %d of %d%s' % (
+                                number, len(self.itable.tracks), extra),
+                            pool=pool,
+                            repair=MAX_TRIES if self.options.repair else 0,
+                            backend=self.options.backend,
+                            stream=self.options.stream,
+                            responses=responses,
+                            confidence=self.options.single_read)
+                        if job:
+                            pending[number] = job
                         break
                     except Exception as e:
                         logger.debug('got exception %r on try %d', e, tries)
@@ -442,6 +699,7 @@ Log files will log the path to tracks relative to this directory.
                                  'threshold, disregarding', trackResult.peak)
                     self.itable.setFile(1, 0, None,
                                         self.ittoc.getTrackStart(1), number)
+                    _waitForEncode(number)
                     logger.debug('unlinking %r', trackResult.filename)
                     os.unlink(trackResult.filename)
                     trackResult.filename = None
@@ -473,12 +731,23 @@ Log files will log the path to tracks relative to this directory.
                 continue
             _ripIfNotRipped(i + 1)
 
+        if pool:
+            try:
+                for number in sorted(pending):
+                    _waitForEncode(number)
+            finally:
+                if pool is not self.pool:
+                    pool.close()
+                    pool.join()
+
         logger.debug('writing cue file for %r', discName)
         self.program.writeCue(discName)
 
         logger.debug('writing m3u file for %r', discName)
         self.program.write_m3u(discName)
 
+        self._saveDriveFeatures()
+
         try:
             self.program.verifyImage(self.runner, self.ittoc)
         except accurip.EntryNotFound:
@@ -490,6 +759,24 @@ Log files will log the path to tracks relative to this directory.
 
         self.program.writeLog(discName, self.logger)
 
+    def _saveDriveFeatures(self):
+        # remember what this rip showed about the drive
+        info = drive.getDeviceInfo(self.device)
+        if not info:
+            return
+
+        features = {}
+        tracks = [t for t in self.program.result.tracks if t.copyduration]
+        if tracks:
+            # average over the time spent reading
+            features['read_speed'] = sum(
+                [t.copyspeed * t.copyduration for t in tracks]) / sum(
+                [t.copyduration for t in tracks])
+        if self.options.overread:
+            features['overread'] = True
+        if features:
+            drive.getDatabase().set(*info, **features)
+
 
 class CD(BaseCommand):
     summary = "handle CDs"
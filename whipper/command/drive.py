@@ -18,8 +18,10 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
 from whipper.command.basecommand import BaseCommand
-from whipper.common import config, drive
+from whipper.common import drive
 from whipper.extern.task import task
 from whipper.program import cdparanoia
 
@@ -52,9 +54,9 @@ class Analyze(BaseCommand):
                          'could not get device info')
             return
 
-        logger.info('adding drive cache behaviour to configuration file')
+        logger.info('adding drive cache behaviour to drive database')
 
-        config.Config().setDefeatsCache(
+        drive.getDatabase().setDefeatsCache(
             info[0], info[1], info[2], t.defeatsCache)
 
 
@@ -64,7 +66,7 @@ class List(BaseCommand):
 
     def do(self):
         paths = drive.getAllDevicePaths()
-        self.config = config.Config()
+        database = drive.getDatabase()
 
         if not paths:
             logger.critical('no drives found. Create /dev/cdrom '
@@ -84,8 +86,7 @@ class List(BaseCommand):
                   path, vendor, model, release))
 
             try:
-                offset = self.config.getReadOffset(
-                    vendor, model, release)
+                offset = database.getReadOffset(vendor, model, release)
                 print("       Configured read offset: %d" % offset)
             except KeyError:
                 # Note spaces at the beginning for pretty terminal output
@@ -93,18 +94,79 @@ class List(BaseCommand):
                                "Run 'whipper offset find'")
 
             try:
-                defeats = self.config.getDefeatsCache(
-                    vendor, model, release)
+                defeats = database.getDefeatsCache(vendor, model, release)
                 print("       Can defeat audio cache: %s" % defeats)
             except KeyError:
                 logger.warning("unknown whether audio cache can be "
                                "defeated. Run 'whipper drive analyze'")
 
+            try:
+                features = database.get(vendor, model, release)
+            except KeyError:
+                continue
+            if features['overread'] is not None:
+                print("       Can overread: %s" % features['overread'])
+            if features['c2'] is not None:
+                print("       Reports C2 errors: %s" % features['c2'])
+            if features['read_speed'] is not None:
+                print("       Last read speed: %.1fx" %
+                      features['read_speed'])
+
+
+def _speed(speed):
+    if speed is None:
+        return 'unknown'
+    return '%.1fx' % speed
+
+
+class Stats(BaseCommand):
+    summary = "show drive read statistics"
+    description = """Summarize the read speeds, re-reads and errors of all
+drives that were ripped from."""
+
+    def add_arguments(self):
+        self.parser.add_argument('-d', '--days',
+                                 action="store", dest="days", type=int,
+                                 help="only count reads from the last "
+                                 "this many days")
+
+    def do(self):
+        since = None
+        if self.options.days is not None:
+            since = time.time() - self.options.days * 24 * 60 * 60
+        stats = drive.getDatabase().getReadStats(since=since)
+        if not stats:
+            logger.warning('no reads recorded')
+            return
+
+        for (vendor, model, release), s in sorted(stats.items()):
+            print("vendor: %s, model: %s, release: %s" % (
+                  vendor, model, release))
+            print("       Tracks read: %d (%d failed), from %s to %s" % (
+                  s['reads'], s['failed'],
+                  time.strftime('%Y-%m-%d', time.localtime(s['first'])),
+                  time.strftime('%Y-%m-%d', time.localtime(s['last']))))
+            print("       Read speed: %s on average, %s recently, "
+                  "%s at most" % (_speed(s['speed']),
+                                  _speed(s['recent_speed']),
+                                  _speed(s['max_speed'])))
+            print("       Read speed on the inner, middle and outer part "
+                  "of discs: %s" % ', '.join(
+                      [_speed(z) for z in s['zone_speed']]))
+            if s['frames']:
+                print("       Frames read again: %.2f%%" % (
+                      100.0 * (s['rereads'] or 0) / s['frames']))
+            print("       SCSI errors: %d" % (s['errors'] or 0))
+            if s['quality'] is not None:
+                print("       Average track quality: {:.2%}".format(
+                      s['quality']))
+
 
 class Drive(BaseCommand):
     summary = "handle drives"
     description = """Drive utilities."""
     subcommands = {
         'analyze': Analyze,
-        'list': List
+        'list': List,
+        'stats': Stats,
     }
@@ -18,7 +18,12 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import StringIO
+import glob
+import multiprocessing
+import os
 import sys
+import time
 
 from whipper.command.basecommand import BaseCommand
 from whipper.common import accurip, config, program
@@ -30,41 +35,237 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def _findCueFiles(args):
+    """
+    Expand the given cue files, directories and glob patterns.
+
+    @rtype: list of unicode
+    """
+    paths = []
+    seen = set()
+    for arg in args:
+        matches = glob.glob(arg) or [arg]
+        for match in sorted(matches):
+            if not os.path.isdir(match):
+                found = [match]
+            else:
+                found = []
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    found.extend([os.path.join(root, name)
+                                  for name in sorted(files)
+                                  if name.lower().endswith('.cue')])
+            for path in found:
+                # the same image can be found through a symlink
+                if os.path.realpath(path) not in seen:
+                    seen.add(os.path.realpath(path))
+                    paths.append(path.decode('utf-8'))
+
+    return paths
+
+
+def _readState(path):
+    """
+    @returns: the absolute paths of the images recorded as verified in the
+              given state file
+    @rtype:   set of unicode
+    """
+    done = set()
+    if not path or not os.path.exists(path):
+        return done
+
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            # each line is: status, tab, cue path; images that failed are
+            # verified again
+            status, cuePath = line.split('\t', 1)
+            if status == 'verified':
+                done.add(cuePath.decode('utf-8'))
+            else:
+                done.discard(cuePath.decode('utf-8'))
+
+    return done
+
+
+def _verifyImage(args):
+    """
+    Verify one image against the AccurateRip database.
+
+    Runs in a pool of worker processes, so it takes a single tuple and
+    returns the report instead of printing it.
+
+    @param args: the cue path, how many tracks to check at the same time,
+                 whether to show progress, and how many samples to look
+                 for a pressing offset in if the image does not verify
+    @type  args: tuple of (unicode, int, bool, int)
+
+    @returns: the cue path, whether it verified, the size of its audio
+              files in bytes, and the report
+    @rtype:   tuple of (unicode, bool, int, str)
+    """
+    path, workers, verbose, window = args
+    prog = program.Program(config.Config())
+    runner = task.SyncRunner(verbose=verbose)
+    report = StringIO.StringIO()
+    size = 0
+    verified = False
+
+    try:
+        cueImage = image.Image(path)
+        cueImage.setup(runner, workers=workers)
+        for audio in set([index.path for track in cueImage.cue.table.tracks
+                          for index in track.indexes.values()]):
+            size += os.path.getsize(cueImage.getRealPath(audio))
+
+        # FIXME: this feels like we're poking at internals.
+        prog.cuePath = path
+        prog.result = result.RipResult()
+        for track in cueImage.table.tracks:
+            tr = result.TrackResult()
+            tr.number = track.number
+            prog.result.tracks.append(tr)
+
+        # the runner shows its progress on stdout, so only capture the
+        # report once the image is verified
+        try:
+            verified = prog.verifyImage(runner, cueImage.table)
+        except accurip.EntryNotFound:
+            report.write('AccurateRip entry not found\n')
+            window = 0
+
+        stdout = sys.stdout
+        sys.stdout = report
+        try:
+            accurip.print_report(prog.result)
+            if not verified and window:
+                _printPressingOffset(prog, cueImage.table, window)
+        finally:
+            sys.stdout = stdout
+    except Exception as e:
+        logger.debug('verifying %r failed: %r', path, e)
+        report.write('could not verify image: %s\n' % e)
+
+    return path, verified, size, report.getvalue()
+
+
+def _printPressingOffset(prog, table, window):
+    if not accurip.numpy:
+        logger.warning('looking for a pressing offset requires numpy')
+        return
+
+    found = prog.findPressingOffset(table, window)
+    if not found:
+        print('no pressing found within %d samples' % window)
+        return
+
+    response, offset, count = found
+    print('%d of %d tracks match AccurateRip response %d at a pressing '
+          'offset of %+d samples' % (count, table.getAudioTracks(),
+                                     response + 1, offset))
+
+
 class Verify(BaseCommand):
     summary = "verify image"
     description = """
 Verifies the image from the given .cue files against the AccurateRip database.
+
+Directories are searched for .cue files.  With a state file, images are
+recorded as they are done, and those that verified are skipped when run
+again, so an interrupted run over a large library can be resumed.
 """
 
     def add_arguments(self):
         self.parser.add_argument('cuefile', nargs='+', action='store',
-                                 help="cue file to load rip image from")
+                                 help="cue file, directory or glob pattern "
+                                 "to load rip images from")
+        self.parser.add_argument('--workers',
+                                 action="store", dest="workers", type=int,
+                                 default=multiprocessing.cpu_count(),
+                                 help="number of tracks to check at the "
+                                 "same time (default: %(default)s)")
+        self.parser.add_argument('-j', '--jobs',
+                                 action="store", dest="jobs", type=int,
+                                 default=1,
+                                 help="number of images to verify at the "
+                                 "same time, in separate processes "
+                                 "(default: %(default)s)")
+        self.parser.add_argument('--offset-window',
+                                 action="store", dest="window", type=int,
+                                 default=0,
+                                 help="when an image does not verify, look "
+                                 "for a pressing it matches at up to this "
+                                 "many samples of offset")
+        self.parser.add_argument('--state',
+                                 action="store", dest="state",
+                                 help="file to record verified images in, "
+                                 "and to skip the images verified in it")
 
     def do(self):
-        prog = program.Program(config.Config())
-        runner = task.SyncRunner()
-
-        for arg in self.options.cuefile:
-            arg = arg.decode('utf-8')
-            cueImage = image.Image(arg)
-            cueImage.setup(runner)
-
-            # FIXME: this feels like we're poking at internals.
-            prog.cuePath = arg
-            prog.result = result.RipResult()
-            for track in cueImage.table.tracks:
-                tr = result.TrackResult()
-                tr.number = track.number
-                prog.result.tracks.append(tr)
-
-            verified = False
-            try:
-                verified = prog.verifyImage(runner, cueImage.table)
-            except accurip.EntryNotFound:
-                print('AccurateRip entry not found')
-            accurip.print_report(prog.result)
-            if not verified:
-                sys.exit(1)
+        paths = _findCueFiles(self.options.cuefile)
+        done = _readState(self.options.state)
+        todo = [path for path in paths
+                if os.path.abspath(path) not in done]
+        if len(todo) < len(paths):
+            print('skipping %d image(s) already verified in %s' % (
+                len(paths) - len(todo), self.options.state))
+
+        jobs = max(1, self.options.jobs)
+        args = [(path, self.options.workers, jobs == 1, self.options.window)
+                for path in todo]
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap_unordered(_verifyImage, args)
+        else:
+            results = (_verifyImage(arg) for arg in args)
+
+        state = None
+        if self.options.state:
+            state = open(self.options.state, 'a')
+
+        failed = 0
+        count = 0
+        size = 0
+        start = time.time()
+        try:
+            for path, verified, imageSize, report in results:
+                count += 1
+                size += imageSize
+                if not verified:
+                    failed += 1
+
+                if len(todo) > 1:
+                    print('%s:' % path.encode('utf-8'))
+                sys.stdout.write(report)
+                if state:
+                    state.write('%s\t%s\n' % (
+                        verified and 'verified' or 'failed',
+                        os.path.abspath(path).encode('utf-8')))
+                    state.flush()
+
+                if len(todo) > 1:
+                    elapsed = max(time.time() - start, 0.001)
+                    print('%d of %d images, %.1f albums/min, %.1f MB/s' % (
+                        count, len(todo), count * 60.0 / elapsed,
+                        size / elapsed / 1024 / 1024))
+        except KeyboardInterrupt:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+            if state:
+                state.close()
+
+        if len(todo) > 1:
+            print('%d of %d images verified' % (count - failed, count))
+        if failed:
+            sys.exit(1)
 
 
 class Image(BaseCommand):
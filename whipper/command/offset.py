@@ -21,11 +21,12 @@
 import argparse
 import os
 import tempfile
+import wave
 import logging
 from whipper.command.basecommand import BaseCommand
-from whipper.common import accurip, common, config, drive
+from whipper.common import accurip, common, drive
 from whipper.common import task as ctask
-from whipper.program import arc, cdrdao, cdparanoia, utils
+from whipper.program import cdrdao, cdparanoia, utils
 from whipper.extern.task import task
 
 logger = logging.getLogger(__name__)
@@ -102,8 +103,9 @@ CD in the AccurateRip database."""
                 logger.warning("AccurateRip response discid different: %s",
                                responses[0].cddbDiscId)
 
-        # now rip the first track at various offsets, calculating AccurateRip
-        # CRC, and matching it against the retrieved ones
+        # now rip the first track once, with enough audio around it for all
+        # offsets, and calculate the AccurateRip CRC at every offset to match
+        # it against the retrieved ones
 
         # archecksums is a tuple of accuraterip checksums: (v1, v2)
         def match(archecksums, track, responses):
@@ -114,89 +116,134 @@ CD in the AccurateRip database."""
 
             return None, None
 
+        if not accurip.numpy:
+            logger.critical('finding the read offset requires numpy')
+            return 255
+
+        margin = max([abs(o) for o in self._offsets])
+        try:
+            samples = self._readTrack(runner, table, 1, margin)
+        except task.TaskException as e:
+            # let MissingDependency fall through
+            if isinstance(e.exception, common.MissingDependencyException):
+                raise e
+
+            logger.error('cannot rip track 1: %s', e)
+            return
+
+        candidates = []
+        checksums = self._arcs(samples, margin, table, 1, self._offsets)
         for offset in self._offsets:
-            logger.info('trying read offset %d...', offset)
-            try:
-                archecksums = self._arcs(runner, table, 1, offset)
-            except task.TaskException as e:
+            archecksums = checksums[offset]
+            logger.debug('AR checksums calculated for offset %d: %s %s',
+                         offset, archecksums[0], archecksums[1])
 
-                # let MissingDependency fall through
-                if isinstance(e.exception, common.MissingDependencyException):
-                    raise e
+            c, i = match(archecksums, 1, responses)
+            if c:
+                logger.debug('offset %d matched against response %d',
+                             offset, i)
+                candidates.append(offset)
+        del samples
+
+        if not candidates:
+            logger.error('no matching offset found. '
+                         'Consider trying again with a different disc')
+            return
 
-                if isinstance(e.exception, cdparanoia.FileSizeError):
-                    logger.warning('cannot rip with offset %d...', offset)
-                    continue
+        logger.info('offset of device is likely %s, confirming...',
+                    ' or '.join([str(o) for o in candidates]))
 
-                logger.warning("unknown task exception for offset %d: %s",
-                               offset, e)
-                logger.warning('cannot rip with offset %d...', offset)
+        # now rip all other tracks as well, except for the last one (to
+        # avoid readers that can't do overread), and check them at every
+        # offset that matched the first track
+        counts = dict([(offset, 1) for offset in candidates])
+        margin = max([abs(o) for o in candidates])
+        for track in range(2, (len(table.tracks) + 1) - 1):
+            try:
+                samples = self._readTrack(runner, table, track, margin)
+            except task.TaskException as e:
+                logger.warning('cannot rip track %d: %s', track, e)
                 continue
 
-            logger.debug('AR checksums calculated: %s %s', archecksums)
+            checksums = self._arcs(samples, margin, table, track, candidates)
+            for offset in candidates:
+                c, i = match(checksums[offset], track, responses)
+                if c:
+                    logger.debug('matched track %d at offset %d against '
+                                 'response %d', track, offset, i)
+                    counts[offset] += 1
 
-            c, i = match(archecksums, 1, responses)
-            if c:
-                count = 1
-                logger.debug('matched against response %d', i)
-                logger.info('offset of device is likely %d, confirming...',
-                            offset)
-
-                # now try and rip all other tracks as well, except for the
-                # last one (to avoid readers that can't do overread
-                for track in range(2, (len(table.tracks) + 1) - 1):
-                    try:
-                        archecksums = self._arcs(runner, table, track, offset)
-                    except task.TaskException as e:
-                        if isinstance(e.exception, cdparanoia.FileSizeError):
-                            logger.warning('cannot rip with offset %d...',
-                                           offset)
-                            continue
-
-                    c, i = match(archecksums, track, responses)
-                    if c:
-                        logger.debug('matched track %d against response %d',
-                                     track, i)
-                        count += 1
-
-                if count == len(table.tracks) - 1:
-                    self._foundOffset(device, offset)
-                    return 0
-                else:
-                    logger.warning('only %d of %d tracks matched, '
-                                   'continuing...', count,
-                                   len(table.tracks))
+        for offset in candidates:
+            if counts[offset] == len(table.tracks) - 1:
+                self._foundOffset(device, offset)
+                return 0
+
+            logger.warning('only %d of %d tracks matched at offset %d',
+                           counts[offset], len(table.tracks), offset)
 
         logger.error('no matching offset found. '
                      'Consider trying again with a different disc')
 
-    def _arcs(self, runner, table, track, offset):
-        # rips the track with the given offset, return the arcs checksums
-        logger.debug('ripping track %r with offset %d...', track, offset)
+    def _readTrack(self, runner, table, track, margin):
+        """
+        Rip the given track once, without read offset correction, including
+        up to margin samples before and after it.
+
+        Audio outside of the disc is returned as silence.
+
+        @param margin: number of samples to include on both sides
+        @type  margin: int
+
+        @returns: the samples of the track, with the first sample of the
+                  track at index margin
+        @rtype:   L{numpy.ndarray} of uint32
+        """
+        start = table.getTrackStart(track)
+        end = table.getTrackEnd(track)
+        frames = -(-margin // common.SAMPLES_PER_FRAME)
+        audio = [t.number for t in table.tracks if t.audio]
+        first = max(start - frames, 0)
+        last = min(end + frames, table.getTrackEnd(audio[-1]))
+        logger.debug('ripping track %r with margin of %d samples...',
+                     track, margin)
 
         fd, path = tempfile.mkstemp(
-            suffix=u'.track%02d.offset%d.whipper.wav' % (
-                track, offset))
+            suffix=u'.track%02d.whipper.wav' % track)
         os.close(fd)
 
-        t = cdparanoia.ReadTrackTask(path, table,
-                                     table.getTrackStart(
-                                         track), table.getTrackEnd(track),
-                                     overread=False, offset=offset,
-                                     device=self.options.device)
-        t.description = 'Ripping track %d with read offset %d' % (
-            track, offset)
-        runner.run(t)
-
-        v1 = arc.accuraterip_checksum(
-                path, track, len(table.tracks), wave=True, v2=False
-            )
-        v2 = arc.accuraterip_checksum(
-                path, track, len(table.tracks), wave=True, v2=True
-            )
-
-        os.unlink(path)
-        return ("%08x" % v1, "%08x" % v2)
+        try:
+            t = cdparanoia.ReadTrackTask(path, table, first, last,
+                                         overread=False, offset=0,
+                                         device=self.options.device)
+            t.description = 'Ripping track %d' % track
+            runner.run(t)
+
+            w = wave.open(path)
+            read = accurip.numpy.frombuffer(w.readframes(w.getnframes()),
+                                            dtype='<u4')
+            w.close()
+        finally:
+            os.unlink(path)
+
+        samples = accurip.numpy.zeros(
+            (end - start + 1) * common.SAMPLES_PER_FRAME + 2 * margin,
+            dtype=accurip.numpy.uint32)
+        # position of the first sample read in samples
+        position = (first - start) * common.SAMPLES_PER_FRAME + margin
+        skip = max(-position, 0)
+        count = min(len(read) - skip, len(samples) - position - skip)
+        samples[position + skip:position + skip + count] = \
+            read[skip:skip + count]
+        return samples
+
+    def _arcs(self, samples, margin, table, track, offsets):
+        # return the arcs checksums of the track as read with each of the
+        # given offsets, from the samples returned by _readTrack
+        checksums = accurip.shifted_checksums(
+            samples, margin, len(samples) - 2 * margin, offsets, track,
+            len(table.tracks))
+        return dict([(o, ("%08x" % v1, "%08x" % v2))
+                     for o, (v1, v2) in checksums.items()])
 
     def _foundOffset(self, device, offset):
         print('\nRead offset of device is: %d.' % offset)
@@ -207,10 +254,9 @@ CD in the AccurateRip database."""
                          'could not get device info (requires pycdio)')
             return
 
-        logger.info('adding read offset to configuration file')
+        logger.info('adding read offset to drive database')
 
-        config.Config().setReadOffset(info[0], info[1], info[2],
-                                      offset)
+        drive.getDatabase().setReadOffset(info[0], info[1], info[2], offset)
 
 
 class Offset(BaseCommand):
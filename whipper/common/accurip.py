@@ -20,21 +20,62 @@
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
 import requests
+import sqlite3
 import struct
+import threading
+import time
+import wave
 from errno import EEXIST
-from os import makedirs
-from os.path import dirname, exists, join
+from os import makedirs, walk
+from os.path import dirname, exists, getmtime, join, relpath
 
-from whipper.common import directory
+from whipper.common import common, directory
+from whipper.program import flac
 from whipper.program.arc import accuraterip_checksum
 
 import logging
 logger = logging.getLogger(__name__)
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 ACCURATERIP_URL = "http://www.accuraterip.com/accuraterip/"
 _CACHE_DIR = join(directory.cache_path(), 'accurip')
 
+# AccurateRip ignores the first five sectors of the first track and the
+# last five sectors of the last track
+_SKIPPED_SAMPLES = 5 * common.SAMPLES_PER_FRAME
+# number of samples to decode at a time when checksumming a file
+_CHUNK_SAMPLES = 256 * 1024
+
+# connect and read timeouts for downloads, in seconds
+_TIMEOUT = (10, 30)
+# number of times a download is retried after a connection error, a
+# timeout or a server error; the wait doubles after every attempt
+_RETRIES = 3
+_BACKOFF = 1.0
+# maximum number of connections kept open, for the downloads of the
+# drives that are ripped at the same time
+_CONNECTIONS = 4
+
+_session = None
+_sessionLock = threading.Lock()
+
+# how long entries are kept before they are downloaded again to pick up
+# new confidences, and how long a disc without an entry is remembered,
+# in seconds
+_ENTRY_TTL = 30 * 24 * 60 * 60
+_MISS_TTL = 24 * 60 * 60
+# size of the cache in bytes, above which the least recently used entries
+# are dropped
+_CACHE_SIZE = 64 * 1024 * 1024
+
+_cache = None
+_cacheLock = threading.Lock()
+
 
 class EntryNotFound(Exception):
     pass
@@ -54,47 +95,182 @@ class _AccurateRipResponse(object):
 
     The response is stored as a packed binary structure.
     """
-    def __init__(self, data):
+    def __init__(self, data, offset=0):
         """
         The checksums and confidences arrays are indexed by relative track
         position, so track 1 will have array index 0, track 2 will have array
         index 1, and so forth. HTOA and other hidden tracks are not included.
+
+        @param data:   the raw entry the response is in
+        @type  data:   str
+        @param offset: position of the response in data
+        @type  offset: int
         """
-        self.num_tracks = struct.unpack("B", data[0])[0]
-        self.discId1 = "%08x" % struct.unpack("<L", data[1:5])[0]
-        self.discId2 = "%08x" % struct.unpack("<L", data[5:9])[0]
-        self.cddbDiscId = "%08x" % struct.unpack("<L", data[9:13])[0]
-
-        self.confidences = []
-        self.checksums = []
-        pos = 13
-        for _ in range(self.num_tracks):
-            confidence = struct.unpack("B", data[pos])[0]
-            checksum = "%08x" % struct.unpack("<L", data[pos + 1:pos + 5])[0]
-            self.confidences.append(confidence)
-            self.checksums.append(checksum)
-            pos += 9
+        self.num_tracks = struct.unpack_from("B", data, offset)[0]
+        fields = struct.unpack_from(
+            "<3L" + "BLL" * self.num_tracks, data, offset + 1)
+        self.discId1, self.discId2, self.cddbDiscId = [
+            "%08x" % i for i in fields[:3]]
+
+        # every track has a confidence, a checksum and an unused field
+        self.confidences = fields[3::3]
+        self.crcs = fields[4::3]
+
+    @property
+    def checksums(self):
+        return ["%08x" % crc for crc in self.crcs]
 
     def __eq__(self, other):
         return [
             self.num_tracks, self.discId1, self.discId2, self.cddbDiscId,
-            self.confidences, self.checksums
+            self.confidences, self.crcs
         ] == [
             other.num_tracks, other.discId1, other.discId2, other.cddbDiscId,
-            other.confidences, other.checksums
+            other.confidences, other.crcs
         ]
 
 
 def _split_responses(raw_entry):
     responses = []
-    while raw_entry:
-        track_count = struct.unpack("B", raw_entry[0])[0]
-        nbytes = 1 + 12 + track_count * (1 + 8)
-        responses.append(_AccurateRipResponse(raw_entry[:nbytes]))
-        raw_entry = raw_entry[nbytes:]
+    offset = 0
+    while offset < len(raw_entry):
+        response = _AccurateRipResponse(raw_entry, offset)
+        responses.append(response)
+        offset += 1 + 12 + response.num_tracks * (1 + 8)
     return responses
 
 
+class AccurateRipChecksum(object):
+    """
+    I calculate the AccurateRip v1 and v2 checksums of a track in one pass.
+
+    Feed me the audio of the track as little-endian 16-bit stereo PCM
+    through update(); I only keep running sums, so memory use does not
+    depend on the length of the track.
+
+    The results are the same as those of src/accuraterip-checksum.c.
+
+    @ivar v1: the AccurateRip v1 checksum of the audio seen so far
+    @ivar v2: the AccurateRip v2 checksum of the audio seen so far
+    """
+
+    v1 = 0
+    v2 = 0
+
+    def __init__(self, samples, track_number, total_tracks):
+        """
+        @param samples:      length of the track, in audio samples
+        @type  samples:      int
+        @param track_number: number of the track on the disc, starting at 1
+        @type  track_number: int
+        @param total_tracks: number of audio tracks on the disc
+        @type  total_tracks: int
+        """
+        assert numpy, "AccurateRipChecksum requires numpy"
+
+        self._check_from = 0
+        self._check_to = samples
+        if track_number == 1:
+            self._check_from += _SKIPPED_SAMPLES
+        if track_number == total_tracks:
+            # wraps around for tiny tracks, like the reference implementation
+            self._check_to = (self._check_to - _SKIPPED_SAMPLES) & 0xffffffff
+
+        self._position = 0  # number of samples seen so far
+        self._pending = ''  # trailing bytes of an incomplete sample
+
+    def update(self, data):
+        """
+        Add the next part of the audio of the track.
+
+        @type data: str
+        """
+        if self._pending:
+            data = self._pending + data
+        count = len(data) // 4
+        self._pending = data[count * 4:]
+
+        samples = numpy.frombuffer(data, dtype='<u4', count=count)
+        # the checksum multiplier of a sample is its 1-based position
+        first = self._position + 1
+        self._position += count
+
+        start = max(self._check_from - first, 0)
+        stop = min(self._check_to - first + 1, count)
+        if start >= stop:
+            return
+
+        multipliers = numpy.arange(first + start, first + stop,
+                                   dtype=numpy.uint64)
+        products = samples[start:stop].astype(numpy.uint64) * multipliers
+        low = int(numpy.sum(products & numpy.uint64(0xffffffff),
+                            dtype=numpy.uint64))
+        high = int(numpy.sum(products >> numpy.uint64(32),
+                             dtype=numpy.uint64))
+
+        self.v1 = (self.v1 + low) & 0xffffffff
+        self.v2 = (self.v2 + low + high) & 0xffffffff
+
+
+def _open_wave(path):
+    """
+    Open a WAV or FLAC file for reading its audio as WAV.
+
+    FLAC files are decoded through a pipe from flac.
+
+    @rtype: tuple of (L{wave.Wave_read}, L{subprocess.Popen} or None)
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic != 'fLaC':
+        return wave.open(path), None
+
+    decoder = flac.decode(path)
+    try:
+        return wave.open(decoder.stdout), decoder
+    except Exception:
+        decoder.kill()
+        decoder.wait()
+        raise
+
+
+def _checksum_track(path, track_number, total_tracks):
+    """
+    Calculate the AccurateRip v1 and v2 checksums of a track in-process.
+
+    @rtype: tuple of (int, int), or (None, None) on error
+    """
+    try:
+        w, decoder = _open_wave(path)
+    except (IOError, OSError, EOFError, wave.Error) as e:
+        logger.warning('could not open %r for checksumming: %s', path, e)
+        return None, None
+
+    try:
+        if (w.getnchannels(), w.getsampwidth(), w.getframerate()) != \
+                (2, 2, 44100):
+            logger.warning('%r is not 16-bit stereo 44.1 kHz audio', path)
+            return None, None
+
+        arc = AccurateRipChecksum(w.getnframes(), track_number, total_tracks)
+        while True:
+            data = w.readframes(_CHUNK_SAMPLES)
+            if not data:
+                break
+            arc.update(data)
+    finally:
+        w.close()
+        if decoder:
+            decoder.stdout.close()
+            decoder.wait()
+
+    if decoder and decoder.returncode != 0:
+        logger.warning('AccurateRip calculation failed: flac '
+                       'return code is non zero: %r', decoder.returncode)
+        return None, None
+    return arc.v1, arc.v2
+
+
 def calculate_checksums(track_paths):
     """
     Return ARv1 and ARv2 checksums as two arrays of character strings in a
@@ -103,6 +279,9 @@ def calculate_checksums(track_paths):
     Return None instead of checksum string for unchecksummable tracks.
 
     HTOA checksums are not included in the database and are not calculated.
+
+    Both checksums are calculated in-process in a single read of each track
+    when numpy is available; otherwise accuraterip-checksum is used.
     """
     track_count = len(track_paths)
     v1_checksums = []
@@ -110,18 +289,21 @@ def calculate_checksums(track_paths):
     logger.debug('checksumming %d tracks', track_count)
     # This is done sequentially because it is very fast.
     for i, path in enumerate(track_paths):
-        v1_sum = accuraterip_checksum(
-            path, i+1, track_count, wave=True, v2=False
-        )
+        if numpy:
+            v1_sum, v2_sum = _checksum_track(path, i + 1, track_count)
+        else:
+            v1_sum = accuraterip_checksum(
+                path, i+1, track_count, wave=True, v2=False
+            )
+            v2_sum = accuraterip_checksum(
+                path, i+1, track_count, wave=True, v2=True
+            )
         if not v1_sum:
             logger.error('could not calculate AccurateRip v1 checksum '
                          'for track %d %r', i + 1, path)
             v1_checksums.append(None)
         else:
             v1_checksums.append("%08x" % v1_sum)
-        v2_sum = accuraterip_checksum(
-            path, i+1, track_count, wave=True, v2=True
-        )
         if not v2_sum:
             logger.error('could not calculate AccurateRip v2 checksum '
                          'for track %d %r', i + 1, path)
@@ -131,31 +313,451 @@ def calculate_checksums(track_paths):
     return {'v1': v1_checksums, 'v2': v2_checksums}
 
 
-def _download_entry(path):
-    url = ACCURATERIP_URL + path
-    logger.debug('downloading AccurateRip entry from %s', url)
+def _prefix_sums(samples, indices):
+    """
+    Sum the samples, and the samples multiplied by their index, up to each
+    of the given indices, modulo 2 ** 64.
+
+    @type  samples: L{numpy.ndarray} of uint32
+    @param indices: indices into samples, from 0 up to len(samples)
+    @type  indices: sequence of int
+
+    @rtype: tuple of (L{numpy.ndarray} of uint64, L{numpy.ndarray} of uint64)
+    """
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    order = numpy.argsort(indices, kind='mergesort')
+    wanted = indices[order]
+    sums = numpy.zeros(len(indices), dtype=numpy.uint64)
+    weighted = numpy.zeros(len(indices), dtype=numpy.uint64)
+
+    total = numpy.zeros(2, dtype=numpy.uint64)
+    done = 0
+    for first in range(0, len(samples) + 1, _CHUNK_SAMPLES):
+        chunk = samples[first:first + _CHUNK_SAMPLES].astype(numpy.uint64)
+        # running sums within the chunk, starting with the empty sum
+        running = numpy.zeros((2, len(chunk) + 1), dtype=numpy.uint64)
+        numpy.cumsum(chunk, out=running[0, 1:])
+        numpy.cumsum(chunk * numpy.arange(first, first + len(chunk),
+                                          dtype=numpy.uint64),
+                     out=running[1, 1:])
+
+        end = numpy.searchsorted(wanted, first + len(chunk), side='right')
+        found = wanted[done:end] - first
+        sums[order[done:end]] = total[0] + running[0, found]
+        weighted[order[done:end]] = total[1] + running[1, found]
+        total += running[:, -1]
+        done = end
+
+    return sums, weighted
+
+
+def shifted_checksums(samples, start, length, offsets, track_number,
+                      total_tracks, v2=True):
+    """
+    Calculate the AccurateRip v1 and v2 checksums of a track as read at each
+    of the given sample offsets, from one buffer of its audio.
+
+    The checksum at offset o covers samples[start + o:start + o + length].
+    As the v1 checksum is a weighted sum of the samples, v1 for all offsets
+    follows from two running sums over the buffer, in
+    O(len(samples) + len(offsets)).  The v2 checksum adds the high words of
+    the products, which do not shift along, so it takes a pass over the
+    track for every offset.
+
+    @param samples:      the audio, as little-endian 16-bit stereo samples
+    @type  samples:      L{numpy.ndarray} of uint32
+    @param start:        index of the first sample of the track at offset 0
+    @type  start:        int
+    @param length:       length of the track, in audio samples
+    @type  length:       int
+    @param offsets:      sample offsets to calculate the checksums at
+    @type  offsets:      sequence of int
+    @param track_number: number of the track on the disc, starting at 1
+    @type  track_number: int
+    @param total_tracks: number of audio tracks on the disc
+    @type  total_tracks: int
+    @param v2:           whether to calculate the v2 checksums too
+
+    @returns: the v1 and v2 checksums at every offset; v2 is None when not
+              calculated
+    @rtype:   dict of int -> tuple of (int, int or None)
+    """
+    assert numpy, "shifted_checksums requires numpy"
+    offsets = list(offsets)
+    assert start + min(offsets) >= 0 and \
+        start + max(offsets) + length <= len(samples), \
+        "samples do not cover all offsets"
+
+    # range of checksum multipliers (1-based positions) that are counted
+    first = 1
+    last = length
+    if track_number == 1:
+        first = _SKIPPED_SAMPLES
+    if track_number == total_tracks:
+        last = (length - _SKIPPED_SAMPLES) & 0xffffffff
+    last = min(last, length)
+    if first > last:
+        return dict([(o, (0, 0 if v2 else None)) for o in offsets])
+
+    # the sample at index i has multiplier i - b + 1 at base index b, so
+    # the v1 sum is sum(i * s[i]) - (b - 1) * sum(s[i]) over the window
+    bases = [start + o for o in offsets]
+    sums, weighted = _prefix_sums(
+        samples, [b + first - 1 for b in bases] + [b + last for b in bases])
+    count = len(offsets)
+
+    checksums = {}
+    with numpy.errstate(over='ignore'):
+        for i, (offset, base) in enumerate(zip(offsets, bases)):
+            total = int(sums[count + i] - sums[i])
+            total_weighted = int(weighted[count + i] - weighted[i])
+            v1 = (total_weighted - (base - 1) * total) & 0xffffffff
+            checksums[offset] = (v1, None)
+            if v2:
+                high = _high_sum(samples, base, first, last)
+                checksums[offset] = (v1, (v1 + high) & 0xffffffff)
+
+    return checksums
+
+
+def _high_sum(samples, base, first, last):
+    # sum of the high words of the checksum products, as v2 adds them
+    high = numpy.zeros(1, dtype=numpy.uint64)
+    for m in range(first, last + 1, _CHUNK_SAMPLES):
+        n = min(m + _CHUNK_SAMPLES, last + 1)
+        products = numpy.arange(m, n, dtype=numpy.uint64) * \
+            samples[base + m - 1:base + n - 1].astype(numpy.uint64)
+        high += numpy.sum(products >> numpy.uint64(32), dtype=numpy.uint64)
+    return int(high[0])
+
+
+def _read_samples(path, count=None):
+    """
+    Read the audio of a WAV or FLAC file, or only its first count samples.
+
+    @rtype: L{numpy.ndarray} of uint32, or None on error
+    """
     try:
-        resp = requests.get(url)
-    except requests.exceptions.ConnectionError as e:
-        logger.error('error retrieving AccurateRip entry: %r', e)
+        w, decoder = _open_wave(path)
+    except (IOError, OSError, EOFError, wave.Error) as e:
+        logger.warning('could not open %r: %s', path, e)
         return None
-    if not resp.ok:
-        logger.error('error retrieving AccurateRip entry: %s %s %r',
-                     resp.status_code, resp.reason, resp)
+
+    partial = False
+    try:
+        if (w.getnchannels(), w.getsampwidth(), w.getframerate()) != \
+                (2, 2, 44100):
+            logger.warning('%r is not 16-bit stereo 44.1 kHz audio', path)
+            return None
+        partial = count is not None and count < w.getnframes()
+        data = w.readframes(count if partial else w.getnframes())
+    finally:
+        w.close()
+        if decoder:
+            if partial:
+                decoder.kill()
+            decoder.stdout.close()
+            decoder.wait()
+
+    if decoder and not partial and decoder.returncode != 0:
+        logger.warning('could not decode %r: flac return code is non zero: '
+                       '%r', path, decoder.returncode)
         return None
-    return resp.content
+    return numpy.frombuffer(data, dtype='<u4', count=len(data) // 4)
 
 
-def _save_entry(raw_entry, path):
-    logger.debug('saving AccurateRip entry to %s', path)
-    # XXX: os.makedirs(exist_ok=True) in py3
-    try:
-        makedirs(dirname(path))
-    except OSError as e:
-        if e.errno != EEXIST:
-            logger.error('could not save entry to %s: %s', path, e)
+def find_pressing_offset(track_paths, responses, window):
+    """
+    Search for a pressing in the AccurateRip responses that matches the
+    ripped tracks at a sample offset of up to window samples, for rips
+    that do not match at their own offset.
+
+    Every track is checked at all offsets at once with shifted_checksums,
+    together with the end of the track before it and the start of the one
+    after it.  Only v1 checksums are compared, as v2 takes a pass over the
+    track for every offset.
+
+    @param track_paths: paths to the WAV or FLAC files of the audio tracks,
+                        in order, without HTOA
+    @type  track_paths: list of unicode
+    @type  responses:   list of L{_AccurateRipResponse}
+    @param window:      largest offset to try, in samples
+    @type  window:      int
+
+    @returns: the index of the best matching response, its offset in
+              samples, and the number of tracks that match; or None if no
+              track matches
+    @rtype:   tuple of (int, int, int) or None
+    """
+    assert numpy, "find_pressing_offset requires numpy"
+    total = len(track_paths)
+    offsets = range(-window, window + 1)
+    silence = numpy.zeros(window, dtype=numpy.uint32)
+    matches = {}  # (response, offset) -> number of matching tracks
+
+    before = silence
+    samples = _read_samples(track_paths[0])
+    for i in range(total):
+        after = silence
+        if i + 1 < total:
+            after = _read_samples(track_paths[i + 1], window)
+        if samples is None or after is None:
+            return None
+        after = numpy.concatenate([after, silence])[:window]
+
+        checksums = shifted_checksums(
+            numpy.concatenate([before, samples, after]), window,
+            len(samples), offsets, i + 1, total, v2=False)
+        crcs = {}  # crc -> [offset, ...]
+        for offset, (v1, _) in checksums.items():
+            crcs.setdefault(v1, []).append(offset)
+        for j, r in enumerate(responses):
+            # silent tracks match anywhere
+            if r.num_tracks != total or not r.crcs[i]:
+                continue
+            for offset in crcs.get(r.crcs[i], []):
+                matches[(j, offset)] = matches.get((j, offset), 0) + 1
+
+        before = numpy.concatenate([silence, samples])
+        before = before[len(before) - window:]
+        if i + 1 < total:
+            samples = _read_samples(track_paths[i + 1])
+
+    if not matches:
+        return None
+    (j, offset), count = max(
+        matches.items(), key=lambda m: (m[1], -abs(m[0][1])))
+    logger.debug('response %d matches %d of %d tracks at offset %d',
+                 j, count, total, offset)
+    return j, offset, count
+
+
+def _get_session():
+    """
+    Return the session shared by all downloads, so connections to the
+    AccurateRip server are kept alive and reused.
+
+    @rtype: L{requests.Session}
+    """
+    global _session
+    with _sessionLock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=_CONNECTIONS)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def _download_entry(path):
+    url = ACCURATERIP_URL + path
+    logger.debug('downloading AccurateRip entry from %s', url)
+    for attempt in range(_RETRIES + 1):
+        if attempt:
+            delay = _BACKOFF * 2 ** (attempt - 1)
+            logger.debug('retrying %s in %.1f seconds', url, delay)
+            time.sleep(delay)
+        try:
+            resp = _get_session().get(url, timeout=_TIMEOUT)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            logger.debug('error retrieving AccurateRip entry: %r', e)
+            error = e
+            continue
+        if resp.status_code >= 500:
+            error = '%s %s' % (resp.status_code, resp.reason)
+            continue
+        if resp.status_code == 404:
+            raise EntryNotFound
+        if not resp.ok:
+            logger.error('error retrieving AccurateRip entry: %s %s %r',
+                         resp.status_code, resp.reason, resp)
+            return None
+        return resp.content
+
+    logger.error('error retrieving AccurateRip entry: %s', error)
+    return None
+
+
+class AccurateRipCache(object):
+    """
+    I keep AccurateRip entries in a single SQLite database, keyed by their
+    path as returned by table.accuraterip_path().
+
+    Discs without an entry are remembered too, so they are not looked up
+    again on every rip.
+
+    @ivar path: path to the database file
+    @type path: unicode
+    """
+
+    def __init__(self, path, size=_CACHE_SIZE):
+        """
+        Open the database at path, importing the entries stored as separate
+        files in its directory by earlier versions when it is created.
+
+        @param size: size in bytes above which entries are dropped
+        @type  size: int
+        """
+        self.path = path
+        self._size = size
+        self._lock = threading.Lock()
+        create = not exists(path)
+        self._db = sqlite3.connect(path, timeout=30,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    path TEXT PRIMARY KEY,
+                    data BLOB,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL)""")
+        if create:
+            self.import_tree(dirname(path))
+
+    def close(self):
+        self._db.close()
+
+    def get(self, path):
+        """
+        @returns: None if path is not in the cache, or the raw entry (None
+                  for a disc without an entry) and whether it has expired
+        @rtype:   None or tuple of (str or None, bool)
+        """
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT data, expires FROM entries WHERE path = ?',
+                (path, )).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE entries SET accessed = ? WHERE path = ?',
+                (now, path))
+        data, expires = row
+        return data and str(data) or None, expires <= now
+
+    def put(self, path, data, ttl=None):
+        """
+        Store the raw entry for path, or None for a disc without an entry.
+
+        @param ttl: number of seconds after which the entry expires
+        @type  ttl: int or None
+        """
+        if ttl is None:
+            ttl = data and _ENTRY_TTL or _MISS_TTL
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (path, data and sqlite3.Binary(data), len(path) +
+                 len(data or ''), now + ttl, now))
+            self._evict()
+
+    def _evict(self):
+        total = self._db.execute(
+            'SELECT TOTAL(size) FROM entries').fetchone()[0]
+        if total <= self._size:
             return
-    open(path, 'wb').write(raw_entry)
+
+        rows = self._db.execute(
+            'SELECT path, size FROM entries ORDER BY accessed, rowid'
+        ).fetchall()
+        dropped = []
+        for path, size in rows:
+            if total <= self._size:
+                break
+            dropped.append((path, ))
+            total -= size
+        logger.debug('dropping %d AccurateRip entries from the cache',
+                     len(dropped))
+        self._db.executemany('DELETE FROM entries WHERE path = ?', dropped)
+
+    def import_tree(self, path):
+        """
+        Import the entries stored as separate files under path, as done by
+        earlier versions.  The files are left in place.
+
+        @returns: the number of entries imported
+        @rtype:   int
+        """
+        entries = []
+        for root, dirs, files in walk(path):
+            for name in files:
+                if not (name.startswith('dBAR-') and name.endswith('.bin')):
+                    continue
+                filename = join(root, name)
+                key = relpath(filename, path)
+                data = open(filename, 'rb').read()
+                mtime = getmtime(filename)
+                entries.append((key, sqlite3.Binary(data),
+                                len(key) + len(data), mtime + _ENTRY_TTL,
+                                mtime))
+
+        logger.debug('importing %d AccurateRip entries from %s',
+                     len(entries), path)
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)',
+                entries)
+            self._evict()
+        return len(entries)
+
+
+def _get_cache():
+    """
+    @returns: the cache in _CACHE_DIR, or None if it cannot be opened
+    @rtype:   L{AccurateRipCache} or None
+    """
+    global _cache
+    path = join(_CACHE_DIR, 'entries.sqlite')
+    with _cacheLock:
+        if _cache is not None and _cache.path == path:
+            return _cache
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+
+        # XXX: os.makedirs(exist_ok=True) in py3
+        try:
+            makedirs(_CACHE_DIR)
+        except OSError as e:
+            if e.errno != EEXIST:
+                logger.error('could not create cache in %s: %s',
+                             _CACHE_DIR, e)
+                return None
+        try:
+            _cache = AccurateRipCache(path)
+        except (sqlite3.Error, EnvironmentError) as e:
+            logger.error('could not open cache %s: %s', path, e)
+        return _cache
+
+
+def _get_raw_entry(path):
+    cache = _get_cache()
+    cached = cache and cache.get(path)
+    if cached and not cached[1]:
+        logger.debug('found accuraterip entry for %s in cache', path)
+        return cached[0]
+
+    try:
+        raw_entry = _download_entry(path)
+    except EntryNotFound:
+        raw_entry = None
+    else:
+        if not raw_entry:
+            # could not download it; an expired entry is better than none
+            return cached and cached[0] or None
+
+    if cache:
+        try:
+            cache.put(path, raw_entry)
+        except sqlite3.Error as e:
+            logger.error('could not save entry for %s: %s', path, e)
+    return raw_entry
 
 
 def get_db_entry(path):
@@ -165,28 +767,63 @@ def get_db_entry(path):
 
     `path' is in the format of the output of table.accuraterip_path().
     """
-    cached_path = join(_CACHE_DIR, path)
-    if exists(cached_path):
-        logger.debug('found accuraterip entry at %s', cached_path)
-        raw_entry = open(cached_path, 'rb').read()
-    else:
-        raw_entry = _download_entry(path)
-        if raw_entry:
-            _save_entry(raw_entry, cached_path)
+    raw_entry = _get_raw_entry(path)
     if not raw_entry:
         logger.warning('entry not found in AccurateRip database')
         raise EntryNotFound
     return _split_responses(raw_entry)
 
 
+def has_track(responses, number):
+    """
+    Tell whether the database responses have a checksum for a single track
+    that it can match with any confidence at all.
+
+    @param responses: the responses for the disc
+    @type  responses: list of L{_AccurateRipResponse}
+    @param number:    the number of the track, starting at 1
+    @type  number:    int
+
+    @rtype: bool
+    """
+    return any([0 < number <= r.num_tracks and r.confidences[number - 1]
+                for r in responses])
+
+
+def match_track(responses, number, checksums):
+    """
+    Look up the AccurateRip checksums of a single track in the database
+    responses, for example as soon as the track is read.
+
+    @param responses: the responses for the disc
+    @type  responses: list of L{_AccurateRipResponse}
+    @param number:    the number of the track, starting at 1
+    @type  number:    int
+    @param checksums: the v1 and v2 checksums of the track; None for
+                      those that were not calculated
+    @type  checksums: list of int or None
+
+    @returns: the highest confidence of the responses that have one of the
+              checksums for the track; 0 if none have
+    @rtype:   int
+    """
+    confidence = 0
+    for r in responses:
+        if 0 < number <= r.num_tracks and r.crcs[number - 1] in checksums:
+            confidence = max(confidence, r.confidences[number - 1])
+    return confidence
+
+
 def _assign_checksums_and_confidences(tracks, checksums, responses):
     for i, track in enumerate(tracks):
         for v in ('v1', 'v2'):
             track.AR[v]['CRC'] = checksums[v][i]
-        track.AR['DBMaxConfidence'], track.AR['DBMaxConfidenceCRC'] = max(
-            [(r.confidences[i], r.checksums[i]) for r in responses],
+        confidence, crc = max(
+            [(r.confidences[i], r.crcs[i]) for r in responses],
             key=lambda t: t[0]
         )
+        track.AR['DBMaxConfidence'] = confidence
+        track.AR['DBMaxConfidenceCRC'] = "%08x" % crc
 
 
 def _match_responses(tracks, responses):
@@ -197,18 +834,25 @@ def _match_responses(tracks, responses):
     Returns True if every track has a match for every entry for either
     AccurateRip version.
     """
-    for r in responses:
-        for i, track in enumerate(tracks):
-            for v in ('v1', 'v2'):
-                if track.AR[v]['CRC'] == r.checksums[i]:
-                    if r.confidences[i] > track.AR[v]['DBConfidence']:
-                        track.AR[v]['DBCRC'] = r.checksums[i]
-                        track.AR[v]['DBConfidence'] = r.confidences[i]
-                        logger.debug(
-                            'track %d matched response %s in AccurateRip'
-                            ' database: %s crc %s confidence %s',
-                            i, r.cddbDiscId, v, track.AR[v]['DBCRC'],
-                            track.AR[v]['DBConfidence'])
+    for i, track in enumerate(tracks):
+        # highest confidence of every checksum in the database for the track
+        confidences = {}
+        for r in responses:
+            crc = r.crcs[i]
+            confidences[crc] = max(confidences.get(crc, 0),
+                                   r.confidences[i])
+
+        for v in ('v1', 'v2'):
+            if track.AR[v]['CRC'] is None:
+                continue
+            crc = int(track.AR[v]['CRC'], 16)
+            if crc in confidences:
+                track.AR[v]['DBCRC'] = track.AR[v]['CRC']
+                track.AR[v]['DBConfidence'] = confidences[crc]
+                logger.debug(
+                    'track %d matched in AccurateRip database: %s crc %s '
+                    'confidence %s', i, v, track.AR[v]['DBCRC'],
+                    track.AR[v]['DBConfidence'])
     return any((
         all([t.AR['v1']['DBCRC'] for t in tracks]),
         all([t.AR['v2']['DBCRC'] for t in tracks])
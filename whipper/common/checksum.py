@@ -18,47 +18,268 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import audioop
 import binascii
 import wave
-import tempfile
 import subprocess
-import os
 
 
+from whipper.common import accurip, common
 from whipper.extern.task import task as etask
+from whipper.program import flac
 
 import logging
 logger = logging.getLogger(__name__)
 
 # checksums are not CRC's. a CRC is a specific type of checksum.
 
+# number of samples to read at a time
+_CHUNK_SAMPLES = 256 * 1024
+
 
 class CRC32Task(etask.Task):
-    # TODO: Support sampleStart, sampleLength later on (should be trivial, just
-    # add change the read part in _crc32 to skip some samples and/or not
-    # read too far)
+    """
+    I calculate the CRC32 of the audio data of a WAV or FLAC file.
+
+    The audio is read in fixed-size chunks, so memory use does not depend
+    on the length of the file.  FLAC files are decoded through a pipe.
+
+    @ivar checksum: the CRC32 of the audio data
+    """
+
+    description = 'Calculating checksum'
+
+    checksum = None
+
     def __init__(self, path, sampleStart=0, sampleLength=-1, is_wave=True):
+        """
+        @param sampleStart:  first audio sample to checksum
+        @type  sampleStart:  int
+        @param sampleLength: number of audio samples to checksum;
+                             -1 to checksum until the end of the file
+        @type  sampleLength: int
+        """
         self.path = path
         self.is_wave = is_wave
+        self._sampleStart = sampleStart
+        self._sampleLength = sampleLength
 
     def start(self, runner):
         etask.Task.start(self, runner)
         self.schedule(0.0, self._crc32)
 
     def _crc32(self):
+        decoder = None
+        source = self.path
         if not self.is_wave:
-            fd, tmpf = tempfile.mkstemp()
+            decoder = flac.decode(self.path)
+            source = decoder.stdout
 
+        # whether the rest of the audio is not read, on purpose or not
+        early = True
+        try:
+            w = wave.open(source)
             try:
-                subprocess.check_call(['flac', '-d', self.path, '-fo', tmpf])
+                frameSize = w.getnchannels() * w.getsampwidth()
+                if decoder:
+                    # pipes can't seek, so read up to the start
+                    skip = self._sampleStart
+                    while skip > 0:
+                        data = w.readframes(min(skip, _CHUNK_SAMPLES))
+                        if not data:
+                            break
+                        skip -= len(data) // frameSize
+                elif self._sampleStart:
+                    w.setpos(self._sampleStart)
+
+                length = self._sampleLength
+                if length < 0:
+                    length = w.getnframes() - self._sampleStart
 
-                w = wave.open(tmpf)
+                crc = 0
+                remaining = length
+                while remaining > 0:
+                    data = w.readframes(min(remaining, _CHUNK_SAMPLES))
+                    if not data:
+                        break
+                    crc = binascii.crc32(data, crc)
+                    remaining -= len(data) // frameSize
+                    self.setProgress(float(length - remaining) / length)
+
+                early = remaining <= 0 and \
+                    self._sampleStart + length < w.getnframes()
             finally:
-                os.remove(tmpf)
-        else:
-            w = wave.open(self.path)
+                w.close()
+        finally:
+            if decoder:
+                # flac fails when nobody reads the rest of its output
+                if early:
+                    decoder.kill()
+                decoder.stdout.close()
+                decoder.wait()
+
+        if decoder and not early and decoder.returncode != 0:
+            raise subprocess.CalledProcessError(decoder.returncode, 'flac')
+        if remaining > 0:
+            raise common.MissingFrames(
+                '%d of %d samples missing in %r' % (
+                    remaining, length, self.path))
+
+        self.checksum = crc & 0xffffffff
+        self.stop()
+
+
+class TrackDigest(object):
+    """
+    I calculate everything whipper needs to know about audio data that is
+    given to me a piece at a time, while it is being read.
+
+    @ivar checksum: the CRC32 of the audio data
+    @ivar v1:       the AccurateRip v1 checksum, or None
+    @ivar v2:       the AccurateRip v2 checksum, or None
+    @ivar peak:     the peak level, as an absolute 16-bit sample value
+    @ivar samples:  the length of the audio data, in audio samples
+    @ivar chunks:   the CRC32s of consecutive blocks of chunkSamples
+                    audio samples
+    """
+
+    checksum = None
+    v1 = None
+    v2 = None
+
+    def __init__(self, total, track_number=None, total_tracks=None,
+                 chunkSamples=450 * common.SAMPLES_PER_FRAME):
+        """
+        @param total:        length of the audio data, in audio samples
+        @type  total:        int
+        @param track_number: number of the track on the disc, starting at
+                             1; None or 0 for audio without AccurateRip
+                             checksums
+        @type  track_number: int or None
+        @param total_tracks: number of audio tracks on the disc
+        @type  total_tracks: int or None
+        @param chunkSamples: length of the blocks to calculate CRC32s of
+        @type  chunkSamples: int
+        """
+        self.chunkSamples = chunkSamples
+        self._arc = None
+        if track_number and accurip.numpy:
+            self._arc = accurip.AccurateRipChecksum(
+                total, track_number, total_tracks)
+
+        self._crc = 0
+        self._chunk = []  # pieces of the block that is not complete yet
+        self._chunkSize = 0
+        self.peak = 0
+        self.samples = 0
+        self.chunks = []
+
+    def update(self, data):
+        """
+        Add the next piece of 16-bit stereo audio data.
+
+        @type data: str
+        """
+        self._crc = binascii.crc32(data, self._crc)
+        if data:
+            self.peak = max(self.peak, audioop.max(data, 2))
+        if self._arc:
+            self._arc.update(data)
+        self.samples += len(data) // 4
+
+        blockSize = self.chunkSamples * 4
+        while data:
+            piece = data[:blockSize - self._chunkSize]
+            data = data[len(piece):]
+            self._chunk.append(piece)
+            self._chunkSize += len(piece)
+            if self._chunkSize == blockSize:
+                self._endChunk()
+
+    def _endChunk(self):
+        self.chunks.append(binascii.crc32(''.join(self._chunk)) & 0xffffffff)
+        self._chunk = []
+        self._chunkSize = 0
+
+    def finish(self):
+        """
+        Call me after the last piece of audio data.
+        """
+        if self._chunkSize:
+            self._endChunk()
+        self.checksum = self._crc & 0xffffffff
+        if self._arc:
+            self.v1 = self._arc.v1
+            self.v2 = self._arc.v2
+
+
+class TrackDigestTask(etask.Task):
+    """
+    I read a WAV file once, in fixed-size chunks, and calculate everything
+    whipper needs to know about its audio data.
+
+    AccurateRip checksums are only calculated when a track number is given
+    and numpy is available.
+
+    @ivar checksum: the CRC32 of the audio data
+    @ivar v1:       the AccurateRip v1 checksum, or None
+    @ivar v2:       the AccurateRip v2 checksum, or None
+    @ivar peak:     the peak level, as an absolute 16-bit sample value
+    @ivar samples:  the length of the audio data, in audio samples
+    @ivar chunks:   the CRC32s of consecutive blocks of chunkSamples
+                    audio samples, so another read of the same audio
+                    can be compared while it is being written
+    """
+
+    description = 'Calculating checksums'
+
+    # six seconds of audio; whole CD frames, so blocks can be read again
+    chunkSamples = 450 * common.SAMPLES_PER_FRAME
+
+    checksum = None
+    v1 = None
+    v2 = None
+    peak = None
+    samples = None
+    chunks = None
+
+    def __init__(self, path, track_number=None, total_tracks=None):
+        """
+        @param track_number: number of the track on the disc, starting at 1;
+                             None or 0 for audio without AccurateRip checksums
+        @type  track_number: int or None
+        @param total_tracks: number of audio tracks on the disc
+        @type  total_tracks: int or None
+        """
+        self.path = path
+        self._track_number = track_number
+        self._total_tracks = total_tracks
+
+    def start(self, runner):
+        etask.Task.start(self, runner)
+        self.schedule(0.0, self._digest)
 
-        d = w._data_chunk.read()
+    def _digest(self):
+        w = wave.open(self.path)
+        try:
+            total = w.getnframes()
+            digest = TrackDigest(total, self._track_number,
+                                 self._total_tracks, self.chunkSamples)
+            while True:
+                data = w.readframes(self.chunkSamples)
+                if not data:
+                    break
+                digest.update(data)
+                if total:
+                    self.setProgress(float(digest.samples) / total)
+        finally:
+            w.close()
 
-        self.checksum = binascii.crc32(d) & 0xffffffff
+        digest.finish()
+        self.checksum = digest.checksum
+        self.peak = digest.peak
+        self.samples = digest.samples
+        self.chunks = digest.chunks
+        self.v1 = digest.v1
+        self.v2 = digest.v2
         self.stop()
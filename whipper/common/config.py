@@ -125,6 +125,28 @@ class Config:
             raise KeyError("Could not find defeats_cache for %s/%s/%s" % (
                 vendor, model, release))
 
+    def getDrives(self):
+        """
+        Get the settings of every drive section.
+
+        @returns: the vendor, model and release of each drive, and its
+                  other options
+        @rtype:   list of tuple of (str, str, str, dict of str -> str)
+        """
+        drives = []
+        for name in self._parser.sections():
+            if not name.startswith('drive:'):
+                continue
+
+            options = dict(self._parser.items(name))
+            try:
+                drives.append((options.pop('vendor'), options.pop('model'),
+                               options.pop('release'), options))
+            except KeyError:
+                logger.warning('ignoring incomplete section %r', name)
+
+        return drives
+
     def _findDriveSection(self, vendor, model, release):
         for name in self._parser.sections():
             if not name.startswith('drive:'):
@@ -19,10 +19,43 @@
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sqlite3
+import threading
+import time
+
+from whipper.common import config, directory
 
 import logging
 logger = logging.getLogger(__name__)
 
+# what we know about a drive; None when unknown
+FEATURES = (
+    'read_offset',    # read offset, in samples
+    'defeats_cache',  # whether cdparanoia can defeat the audio cache
+    'overread',       # whether the drive can read into the lead-in/lead-out
+    'c2',             # whether the drive reports C2 errors
+    'read_speed',     # last measured read speed, as a multiple of 1x
+)
+# features that drive sections in the configuration file can set too
+CONFIG_FEATURES = ('read_offset', 'defeats_cache')
+
+# what is recorded for every track read
+READ_METRICS = (
+    'disc',      # CDDB disc id
+    'track',     # track number
+    'position',  # start of the track, as a fraction of the disc length
+    'frames',    # length of the track, in frames
+    'speed',     # read speed, as a multiple of 1x
+    'duration',  # time spent reading, in seconds
+    'rereads',   # number of frames read more than cdparanoia has to
+    'errors',    # number of SCSI errors
+    'quality',   # track quality as reported in the log, 0 to 1
+    'ok',        # whether the track was read successfully
+)
+
+_database = None
+_databaseLock = threading.Lock()
+
 
 def _listify(listOrString):
     if isinstance(listOrString, str):
@@ -69,3 +102,294 @@ def getDeviceInfo(path):
     ok, vendor, model, release = device.get_hwinfo()
 
     return (vendor, model, release)
+
+
+class DriveDatabase(object):
+    """
+    I store what we know about drives, keyed by their vendor, model and
+    release, in a SQLite database.
+
+    All drives are loaded once when I am created, so lookups do not touch
+    the disk.  Drive sections in the configuration file are imported
+    whenever it has changed since the last import, so settings entered by
+    hand still take effect; L{CONFIG_FEATURES} are written to it as well,
+    so an import never undoes a newer value.
+    """
+
+    def __init__(self, path=None, configPath=None):
+        self._path = path or os.path.join(directory.data_path(),
+                                          u'drives.sqlite')
+        self._configPath = configPath or directory.config_path()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self._path, timeout=30,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS drives (
+                    vendor TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    release TEXT NOT NULL,
+                    read_offset INTEGER,
+                    defeats_cache INTEGER,
+                    overread INTEGER,
+                    c2 INTEGER,
+                    read_speed REAL,
+                    PRIMARY KEY (vendor, model, release))""")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT)""")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS reads (
+                    vendor TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    release TEXT NOT NULL,
+                    time REAL NOT NULL,
+                    disc TEXT,
+                    track INTEGER,
+                    position REAL,
+                    frames INTEGER,
+                    speed REAL,
+                    duration REAL,
+                    rereads INTEGER,
+                    errors INTEGER,
+                    quality REAL,
+                    ok INTEGER NOT NULL)""")
+            self._db.execute("""
+                CREATE INDEX IF NOT EXISTS reads_drive
+                ON reads (vendor, model, release, time)""")
+
+        self._drives = {}
+        for row in self._db.execute('SELECT * FROM drives'):
+            features = dict(zip(FEATURES, row[3:]))
+            for key in ('defeats_cache', 'overread', 'c2'):
+                if features[key] is not None:
+                    features[key] = bool(features[key])
+            self._drives[row[:3]] = features
+        logger.debug('loaded %d drives from %s', len(self._drives),
+                     self._path)
+
+        self._importConfig()
+
+    def _importConfig(self):
+        path = self._configPath
+        if not os.path.exists(path):
+            return
+        mtime = os.path.getmtime(path)
+        row = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'config_mtime'").fetchone()
+        if row and float(row[0]) >= mtime:
+            return
+
+        logger.debug('importing drives from %s', path)
+        for vendor, model, release, options in config.Config(
+                path).getDrives():
+            features = {}
+            if 'read_offset' in options:
+                features['read_offset'] = int(options['read_offset'])
+            if 'defeats_cache' in options:
+                features['defeats_cache'] = \
+                    options['defeats_cache'] == 'True'
+            if features:
+                self._store(self._key(vendor, model, release), features)
+
+        self._setConfigMtime(mtime)
+
+    def _setConfigMtime(self, mtime):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('config_mtime', ?)",
+                (repr(mtime), ))
+
+    def _key(self, vendor, model, release):
+        return vendor.strip(), model.strip(), release.strip()
+
+    def getDrives(self):
+        """
+        @returns: the vendor, model and release of every known drive
+        @rtype:   list of tuple of (str, str, str)
+        """
+        return sorted(self._drives)
+
+    def get(self, vendor, model, release):
+        """
+        Get everything we know about the given drive.
+
+        @rtype: dict of str -> object, with the keys in L{FEATURES}
+        """
+        key = self._key(vendor, model, release)
+        if key not in self._drives:
+            raise KeyError("Could not find drive %s/%s/%s" % key)
+        return dict(self._drives[key])
+
+    def set(self, vendor, model, release, **features):
+        """
+        Store features of the given drive.
+
+        Strips the given strings of leading and trailing whitespace.
+        Known values of L{CONFIG_FEATURES} are written to the configuration
+        file too.
+
+        @param features: values for keys in L{FEATURES}
+        """
+        unknown = set(features) - set(FEATURES)
+        assert not unknown, "unknown drive features %r" % unknown
+
+        written = [f for f in CONFIG_FEATURES if features.get(f) is not None]
+        if written:
+            # whatever was changed by hand so far is older than this
+            self._importConfig()
+
+        self._store(self._key(vendor, model, release), features)
+
+        if not written:
+            return
+        conf = config.Config(self._configPath)
+        if 'read_offset' in written:
+            conf.setReadOffset(vendor, model, release,
+                               features['read_offset'])
+        if 'defeats_cache' in written:
+            conf.setDefeatsCache(vendor, model, release,
+                                 features['defeats_cache'])
+        # the configuration file now has nothing new to import
+        self._setConfigMtime(os.path.getmtime(self._configPath))
+
+    def _store(self, key, features):
+        with self._lock:
+            drive = self._drives.setdefault(
+                key, dict([(f, None) for f in FEATURES]))
+            drive.update(features)
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO drives VALUES (?, ?, ?, %s)' %
+                    ', '.join(['?'] * len(FEATURES)),
+                    key + tuple([drive[f] for f in FEATURES]))
+
+    def addRead(self, vendor, model, release, **metrics):
+        """
+        Record how reading a track went on the given drive.
+
+        @param metrics: values for keys in L{READ_METRICS}; missing ones
+                        are stored as unknown
+        """
+        unknown = set(metrics) - set(READ_METRICS)
+        assert not unknown, "unknown read metrics %r" % unknown
+
+        key = self._key(vendor, model, release)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO reads VALUES (?, ?, ?, ?, %s)' %
+                ', '.join(['?'] * len(READ_METRICS)),
+                key + (time.time(), ) + tuple(
+                    [metrics.get(m) for m in READ_METRICS[:-1]]) +
+                (int(metrics.get('ok', True)), ))
+
+    def getReadStats(self, since=None, recent=20):
+        """
+        Summarize the recorded reads of every drive.
+
+        @param since:  only count reads after this time, in seconds since
+                       the epoch
+        @type  since:  float or None
+        @param recent: number of most recent reads to average separately,
+                       to see whether a drive is getting worse
+
+        @returns: per drive: the number of reads and failed reads; the
+                  average, most recent average and highest read speed;
+                  the average speed on the inner, middle and outer third
+                  of discs; the frames read, re-read and SCSI errors; the
+                  average quality; and the times of the first and last
+                  read
+        @rtype:   dict of (str, str, str) -> dict of str -> object
+        """
+        condition = ''
+        args = ()
+        if since is not None:
+            condition = 'AND time >= ?'
+            args = (since, )
+
+        stats = {}
+        with self._lock:
+            for row in self._db.execute("""
+                    SELECT vendor, model, release, COUNT(*), SUM(1 - ok),
+                           AVG(CASE WHEN ok THEN speed END),
+                           MAX(CASE WHEN ok THEN speed END), SUM(frames),
+                           SUM(rereads), SUM(errors),
+                           AVG(CASE WHEN ok THEN quality END),
+                           MIN(time), MAX(time)
+                    FROM reads WHERE 1 %s
+                    GROUP BY vendor, model, release""" % condition, args):
+                stats[row[:3]] = dict(zip((
+                    'reads', 'failed', 'speed', 'max_speed', 'frames',
+                    'rereads', 'errors', 'quality', 'first', 'last'),
+                    row[3:]))
+
+            for key, drive in stats.items():
+                query = """
+                    SELECT AVG(speed) FROM (
+                        SELECT speed FROM reads
+                        WHERE vendor = ? AND model = ? AND release = ?
+                        AND ok %s
+                        ORDER BY time DESC LIMIT ?)""" % condition
+                drive['recent_speed'] = self._db.execute(
+                    query, key + args + (recent, )).fetchone()[0]
+
+                drive['zone_speed'] = [None, None, None]
+                for zone, speed in self._db.execute("""
+                        SELECT MIN(CAST(position * 3 AS INTEGER), 2),
+                               AVG(speed)
+                        FROM reads
+                        WHERE vendor = ? AND model = ? AND release = ?
+                        AND ok AND position IS NOT NULL %s
+                        GROUP BY 1""" % condition, key + args):
+                    drive['zone_speed'][zone] = speed
+
+        return stats
+
+    def _getFeature(self, feature, vendor, model, release):
+        try:
+            value = self.get(vendor, model, release)[feature]
+        except KeyError:
+            value = None
+        if value is None:
+            raise KeyError("Could not find %s for %s/%s/%s" % (
+                (feature, ) + self._key(vendor, model, release)))
+        return value
+
+    def getReadOffset(self, vendor, model, release):
+        """
+        Get the read offset of the given drive.
+        """
+        return self._getFeature('read_offset', vendor, model, release)
+
+    def setReadOffset(self, vendor, model, release, offset):
+        """
+        Set the read offset of the given drive.
+        """
+        self.set(vendor, model, release, read_offset=offset)
+
+    def getDefeatsCache(self, vendor, model, release):
+        """
+        Get whether the given drive defeats the cache.
+        """
+        return self._getFeature('defeats_cache', vendor, model, release)
+
+    def setDefeatsCache(self, vendor, model, release, defeat):
+        """
+        Set whether the given drive defeats the cache.
+        """
+        self.set(vendor, model, release, defeats_cache=defeat)
+
+
+def getDatabase():
+    """
+    Get the drive database, opening it on first use.
+
+    @rtype: L{DriveDatabase}
+    """
+    global _database
+    with _databaseLock:
+        if _database is None:
+            _database = DriveDatabase()
+        return _database
@@ -20,33 +20,26 @@
 
 
 from mutagen.flac import FLAC
+from subprocess import CalledProcessError
 
+from whipper.common import common
+from whipper.common import task as ctask
 from whipper.extern.task import task
 
-from whipper.program import sox
 from whipper.program import flac
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-class SoxPeakTask(task.Task):
-    description = 'Calculating peak level'
+class FlacEncodeTask(ctask.PopenTask):
+    """
+    I encode a track to FLAC.
 
-    def __init__(self, track_path):
-        self.track_path = track_path
-        self.peak = None
-
-    def start(self, runner):
-        task.Task.start(self, runner)
-        self.schedule(0.0, self._sox_peak)
+    flac runs in the background, so several of me can encode at the same
+    time.
+    """
 
-    def _sox_peak(self):
-        self.peak = sox.peak_level(self.track_path)
-        self.stop()
-
-
-class FlacEncodeTask(task.Task):
     description = 'Encoding to FLAC'
 
     def __init__(self, track_path, track_out_path, what="track"):
@@ -54,14 +47,19 @@ class FlacEncodeTask(task.Task):
         self.track_out_path = track_out_path
         self.new_path = None
         self.description = 'Encoding %s to FLAC' % what
+        self.command = flac.encode_command(track_path, track_out_path)
+        self._error = []
 
-    def start(self, runner):
-        task.Task.start(self, runner)
-        self.schedule(0.0, self._flac_encode)
+    def commandMissing(self):
+        raise common.MissingDependencyException('flac')
 
-    def _flac_encode(self):
-        self.new_path = flac.encode(self.track_path, self.track_out_path)
-        self.stop()
+    def readbyteserr(self, bytes):
+        self._error.append(bytes)
+
+    def failed(self):
+        logger.error('flac failed: %s', "".join(self._error))
+        self.setException(CalledProcessError(self._popen.returncode,
+                                             self.command))
 
 
 class TaggingTask(task.Task):
@@ -81,11 +79,18 @@ class TaggingTask(task.Task):
         self.schedule(0.0, self._tag)
 
     def _tag(self):
-        w = FLAC(self.track_path)
+        tag(self.track_path, self.tags)
 
-        for k, v in list(self.tags.items()):
-            w[k] = v
+        self.stop()
 
-        w.save()
 
-        self.stop()
+def tag(track_path, tags):
+    """
+    Write the given tags to the FLAC file at track_path.
+    """
+    w = FLAC(track_path)
+
+    for k, v in list(tags.items()):
+        w[k] = v
+
+    w.save()
@@ -25,9 +25,13 @@ Common functionality and class for all programs using whipper.
 import musicbrainzngs
 import re
 import os
+import sqlite3
+import threading
 import time
 
-from whipper.common import accurip, cache, checksum, common, mbngs, path
+from whipper.common import (
+    accurip, cache, checksum, common, drive, mbngs, path
+)
 from whipper.program import cdrdao, cdparanoia
 from whipper.image import image
 from whipper.extern import freedb
@@ -80,6 +84,8 @@ class Program:
             d[key] = value
 
         self._filter = path.PathFilter(**d)
+        self._driveInfo = {}  # device -> (vendor, model, release) or None
+        self._accurip = {}  # AccurateRip path -> (thread, fetch result)
 
     def setWorkingDirectory(self, workingDirectory):
         if workingDirectory:
@@ -100,10 +106,16 @@ class Program:
         return toc
 
     def getTable(self, runner, cddbdiscid, mbdiscid, device, offset,
-                 out_path):
+                 out_path, started=None):
         """
         Retrieve the Table either from the cache or the drive.
 
+        @param out_path: where to save the TOC file if the drive is read,
+                         or a function returning it; see
+                         L{cdrdao.read_toc}
+        @param started:  called with the cdrdao process if the drive is
+                         read; see L{cdrdao.read_toc}
+
         @rtype: L{table.Table}
         """
         tcache = cache.TableCache()
@@ -122,7 +134,7 @@ class Program:
             logger.debug('getTable: cddbdiscid %s, mbdiscid %s not in cache '
                          'for offset %s, reading table', cddbdiscid, mbdiscid,
                          offset)
-            t = cdrdao.ReadTableTask(device, out_path)
+            t = cdrdao.ReadTableTask(device, out_path, started)
             itable = t.table
             tdict[offset] = itable
             ptable.persist(tdict)
@@ -476,13 +488,43 @@ class Program:
         return ret
 
     def ripTrack(self, runner, trackResult, offset, device, taglist,
-                 overread, what=None):
+                 overread, what=None, pool=None, repair=0,
+                 backend='cdparanoia', stream=False, responses=None,
+                 confidence=None):
         """
         Ripping the track may change the track's filename as stored in
         trackResult.
 
+        If a pool is given, the track is only read and verified here;
+        encoding and tagging is handed off to the pool, so the next track
+        can be read in the meantime.
+
         @param trackResult: the object to store information in.
         @type  trackResult: L{result.TrackResult}
+        @param pool:        pool to encode the track in
+        @type  pool:        L{multiprocessing.pool.ThreadPool} or None
+        @param repair:      how many times to read blocks on which the test
+                            and copy reads differ again, instead of
+                            failing; 0 to fail
+        @type  repair:      int
+        @param backend:     what to read the track with; one of
+                            L{cdparanoia.BACKENDS}
+        @type  backend:     str
+        @param stream:      whether to encode the track while it is read,
+                            without temporary files; can't be used with
+                            a pool or repair
+        @type  stream:      bool
+        @param responses:   the AccurateRip responses for the disc; if
+                            given, a test read that matches them is kept
+                            when the copy read differs from it
+        @type  responses:   list of L{accurip._AccurateRipResponse}
+        @param confidence:  the AccurateRip confidence the test read needs
+                            to skip the copy read; None to always read
+                            the track twice
+        @type  confidence:  int or None
+
+        @returns: the pending encoding job if a pool is given, else None
+        @rtype:   L{multiprocessing.pool.AsyncResult} or None
         """
         if trackResult.number == 0:
             start, stop = self.getHTOA()
@@ -503,9 +545,21 @@ class Program:
                                            offset=offset,
                                            device=device,
                                            taglist=taglist,
-                                           what=what)
+                                           what=what,
+                                           number=trackResult.number,
+                                           encode=pool is None,
+                                           repair=repair,
+                                           backend=backend,
+                                           stream=stream,
+                                           responses=responses,
+                                           confidence=confidence)
 
-        runner.run(t)
+        try:
+            runner.run(t)
+        except Exception:
+            self._recordRead(device, trackResult.number, start, stop, t)
+            raise
+        self._recordRead(device, trackResult.number, start, stop, t)
 
         logger.debug('ripped track')
         logger.debug('test speed %.3f/%.3f seconds',
@@ -516,6 +570,8 @@ class Program:
         trackResult.copycrc = t.copychecksum
         trackResult.peak = t.peak
         trackResult.quality = t.quality
+        for v, arc in (('v1', t.arv1), ('v2', t.arv2)):
+            trackResult.AR[v]['CRC'] = arc is not None and '%08x' % arc or None
         trackResult.testspeed = t.testspeed
         trackResult.copyspeed = t.copyspeed
         # we want rerips to add cumulatively to the time
@@ -526,6 +582,77 @@ class Program:
             trackResult.filename = t.path
             logger.info('filename changed to %r', trackResult.filename)
 
+        if pool is not None:
+            return pool.apply_async(t.finish)
+
+    def _recordRead(self, device, number, start, stop, t):
+        """
+        Add the read speed, re-reads and errors of a track to the
+        telemetry of the drive it was read on.
+        """
+        if device not in self._driveInfo:
+            self._driveInfo[device] = drive.getDeviceInfo(device)
+        info = self._driveInfo[device]
+        if not info:
+            return
+
+        table = self.result.table
+        try:
+            drive.getDatabase().addRead(
+                disc=table.getCDDBDiscId(), track=number,
+                position=float(start) / table.leadout,
+                frames=stop - start + 1, speed=t.copyspeed,
+                duration=(t.testduration or 0.0) + (t.copyduration or 0.0),
+                rereads=t.rereads, errors=t.errors, quality=t.quality,
+                ok=not t.exception, *info)
+        except sqlite3.Error as e:
+            logger.warning('could not record read of track %d: %s',
+                           number, e)
+
+    def prefetchAccurateRip(self, table):
+        """
+        Start fetching the AccurateRip entry for the disc in the background,
+        so that it is at hand by the time it is needed.
+
+        @type table: L{whipper.image.table.Table}
+        """
+        path = table.accuraterip_path()
+        if path in self._accurip:
+            return
+
+        fetched = {}
+
+        def fetch():
+            try:
+                fetched['responses'] = accurip.get_db_entry(path)
+            except Exception as e:
+                fetched['exception'] = e
+
+        logger.debug('fetching AccurateRip entry %s in the background', path)
+        thread = threading.Thread(target=fetch, name='accurip')
+        thread.daemon = True
+        thread.start()
+        self._accurip[path] = (thread, fetched)
+
+    def getAccurateRip(self, table):
+        """
+        Get the AccurateRip entry for the disc, waiting for
+        prefetchAccurateRip() to fetch it if it was called.
+
+        @type table: L{whipper.image.table.Table}
+
+        @raises accurip.EntryNotFound: if the disc is not in the database
+        @rtype: list of L{accurip._AccurateRipResponse}
+        """
+        self.prefetchAccurateRip(table)
+        thread, fetched = self._accurip[table.accuraterip_path()]
+        # join with a timeout, so we can be interrupted
+        while thread.is_alive():
+            thread.join(1.0)
+        if 'exception' in fetched:
+            raise fetched['exception']
+        return fetched['responses']
+
     def verifyImage(self, runner, table):
         """
         verify table against accuraterip and cue_path track lengths
@@ -544,17 +671,61 @@ class Program:
             logger.error(verifytask.exceptionMessage)
             return False
 
-        responses = accurip.get_db_entry(table.accuraterip_path())
+        responses = self.getAccurateRip(table)
         logger.info('%d AccurateRip response(s) found', len(responses))
 
-        checksums = accurip.calculate_checksums([
-            os.path.join(os.path.dirname(self.cuePath), t.indexes[1].path)
-            for t in [t for t in cueImage.cue.table.tracks if t.number != 0]
-        ])
+        checksums = self._getRipChecksums(table.getAudioTracks())
+        if not checksums:
+            checksums = accurip.calculate_checksums(
+                self._getTrackPaths(cueImage))
         if not (checksums and any(checksums['v1']) and any(checksums['v2'])):
             return False
         return accurip.verify_result(self.result, responses, checksums)
 
+    def findPressingOffset(self, table, window):
+        """
+        Look for a pressing in the AccurateRip database that our image
+        matches at a different sample offset, for images that do not
+        verify.
+
+        @param window: largest offset to try, in samples
+        @type  window: int
+
+        @returns: the index of the matching AccurateRip response, its
+                  offset in samples, and the number of tracks that match;
+                  or None
+        @rtype:   tuple of (int, int, int) or None
+        """
+        cueImage = image.Image(self.cuePath)
+        responses = self.getAccurateRip(table)
+        return accurip.find_pressing_offset(
+            self._getTrackPaths(cueImage), responses, window)
+
+    def _getTrackPaths(self, cueImage):
+        return [
+            os.path.join(os.path.dirname(self.cuePath), t.indexes[1].path)
+            for t in cueImage.cue.table.tracks if t.number != 0
+        ]
+
+    def _getRipChecksums(self, trackCount):
+        """
+        Return the AccurateRip checksums calculated while ripping, in the
+        format of L{accurip.calculate_checksums}, if every track has them.
+
+        @rtype: dict or None
+        """
+        tracks = [t for t in self.result.tracks if t.number != 0]
+        if len(tracks) != trackCount:
+            return None
+        if not all(t.AR[v]['CRC'] for t in tracks for v in ('v1', 'v2')):
+            return None
+        logger.debug('using AccurateRip checksums calculated while ripping')
+        return {
+            v: [t.AR[v]['CRC'] for t in sorted(tracks,
+                                               key=lambda t: t.number)]
+            for v in ('v1', 'v2')
+        }
+
     def write_m3u(self, discname):
         m3uPath = common.truncate_filename(discname + '.m3u')
         with open(m3uPath, 'w') as f:
@@ -5,7 +5,6 @@ import os
 import signal
 import subprocess
 
-from whipper.extern import asyncsub
 from whipper.extern.task import task
 
 import logging
@@ -27,6 +26,9 @@ class LoggableMultiSeparateTask(task.MultiSeparateTask):
 class PopenTask(task.Task):
     """
     I am a task that runs a command using Popen.
+
+    The output of the command is read as soon as the runner notices it is
+    there; the command is done when it closed both stdout and stderr.
     """
 
     logCategory = 'PopenTask'
@@ -38,12 +40,12 @@ class PopenTask(task.Task):
         task.Task.start(self, runner)
 
         try:
-            self._popen = asyncsub.Popen(self.command,
-                                         bufsize=self.bufsize,
-                                         stdin=subprocess.PIPE,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE,
-                                         close_fds=True, cwd=self.cwd)
+            self._popen = subprocess.Popen(self.command,
+                                           bufsize=self.bufsize,
+                                           stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE,
+                                           close_fds=True, cwd=self.cwd)
         except OSError as e:
             import errno
             if e.errno == errno.ENOENT:
@@ -53,44 +55,37 @@ class PopenTask(task.Task):
 
         logger.debug('started %r with pid %d', self.command, self._popen.pid)
 
-        self.schedule(1.0, self._read, runner)
-
-    def _read(self, runner):
-        try:
-            read = False
-
-            ret = self._popen.recv()
+        self._open = ['stdout', 'stderr']
+        self.watch(self._popen.stdout.fileno(), self._read, 'stdout')
+        self.watch(self._popen.stderr.fileno(), self._read, 'stderr')
 
-            if ret:
-                logger.debug("read from stdout: %s", ret)
-                self.readbytesout(ret)
-                read = True
+    def _read(self, which):
+        if not self.runner:
+            return False
 
-            ret = self._popen.recv_err()
+        try:
+            ret = os.read(getattr(self._popen, which).fileno(),
+                          self.bufsize)
 
             if ret:
-                logger.debug("read from stderr: %s", ret)
-                self.readbyteserr(ret)
-                read = True
-
-            # if we read anything, we might have more to read, so
-            # reschedule immediately
-            if read and self.runner:
-                self.schedule(0.0, self._read, runner)
-                return
-
-            # if we didn't read anything, give the command more time to
-            # produce output
-            if self._popen.poll() is None and self.runner:
-                # not finished yet
-                self.schedule(1.0, self._read, runner)
-                return
-
-            self._done()
+                logger.debug("read from %s: %s", which, ret)
+                if which == 'stdout':
+                    self.readbytesout(ret)
+                else:
+                    self.readbyteserr(ret)
+                return True
+
+            self._open.remove(which)
+            if not self._open:
+                # the command closed its output, so it is exiting
+                self._popen.wait()
+                self._done()
+            return False
         except Exception as e:
             logger.debug('exception during _read(): %s', e)
             self.setException(e)
             self.stop()
+            return False
 
     def _done(self):
         assert self._popen.returncode is not None, "No returncode"
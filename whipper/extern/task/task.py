@@ -221,6 +221,14 @@ class Task(LogStub):
             return
         self.runner.schedule(self, delta, callable, *args, **kwargs)
 
+    def watch(self, fd, callable, *args, **kwargs):
+        if not self.runner:
+            print("ERROR: watching on a task that's already stopped")
+            import traceback
+            traceback.print_stack()
+            return
+        self.runner.watch(self, fd, callable, *args, **kwargs)
+
     def addListener(self, listener):
         """
         Add a listener for task status changes.
@@ -409,7 +417,7 @@ class MultiSeparateTask(BaseMultiTask):
     def progressed(self, task, value):
         self.setProgress(value)
 
-    def described(self, description):
+    def described(self, task, description):
         self.setDescription("%s (%d of %d) ..." % (
             description, self._task, len(self.tasks)))
 
@@ -433,6 +441,92 @@ class MultiCombinedTask(BaseMultiTask):
         BaseMultiTask.stopped(self, task)
 
 
+class MultiParallelTask(BaseMultiTask):
+    """
+    I perform multiple tasks, running up to a given number of them at the
+    same time.
+    I track progress as the combined progress of all tasks.
+
+    If a task fails, I start no new tasks, and stop with its exception once
+    the running ones are done.
+    """
+
+    description = 'Doing various tasks in parallel'
+
+    def __init__(self, workers=1):
+        """
+        @param workers: how many tasks to run at the same time, at most
+        @type  workers: int
+        """
+        BaseMultiTask.__init__(self)
+        self._workers = max(1, workers)
+        self._running = 0
+        self._progress = {}
+
+    def start(self, runner):
+        Task.start(self, runner)
+
+        if not self.tasks:
+            self.warning('no tasks')
+            self.stop()
+            return
+        self._generic = self.description
+
+        for _ in range(min(self._workers, len(self.tasks))):
+            self.next()
+
+    def next(self):
+        """
+        Start the next task.
+        """
+        # several tasks may have stopped before the first call to me
+        if self.exception or self._task == len(self.tasks):
+            return
+
+        try:
+            task = self.tasks[self._task]
+            self._task += 1
+            self._running += 1
+            self.debug('MultiParallelTask.next(): starting task %d of %d: %r',
+                       self._task, len(self.tasks), task)
+            self.setDescription("%s (%d of %d) ..." % (
+                task.description, self._task, len(self.tasks)))
+            task.addListener(self)
+            task.start(self.runner)
+        except Exception as e:
+            self._running -= 1
+            self.setException(e)
+            self.debug('Got exception during next: %r', self.exceptionMessage)
+            if not self._running:
+                self.stop()
+
+    # ITaskListener methods
+    def progressed(self, task, value):
+        self._progress[task] = value
+        self.setProgress(sum(self._progress.values()) / len(self.tasks))
+
+    def described(self, task, description):
+        pass
+
+    def stopped(self, task):
+        self._running -= 1
+        self.progressed(task, 1.0)
+
+        if task.exception and not self.exception:
+            self.warning('MultiParallelTask.stopped: exception %r',
+                         task.exceptionMessage)
+            self.exception = task.exception
+            self.exceptionMessage = task.exceptionMessage
+
+        if self.exception or self._task == len(self.tasks):
+            if not self._running:
+                self.debug('MultiParallelTask.stopped: all tasks done')
+                self.stop()
+            return
+
+        self.schedule(0, self.next)
+
+
 class TaskRunner(LogStub):
     """
     I am a base class for task runners.
@@ -460,15 +554,40 @@ class TaskRunner(LogStub):
         """
         raise NotImplementedError
 
+    def watch(self, task, fd, callable, *args, **kwargs):
+        """
+        Call the callable whenever the file descriptor can be read from
+        without blocking, which includes end of file.
+        The callable returns whether to keep watching.
+
+        Subclasses should implement this.
+
+        @type  fd: int
+        @param fd: the file descriptor to watch.
+        """
+        raise NotImplementedError
+
 
 class SyncRunner(TaskRunner, ITaskListener):
     """
     I run the task synchronously in a gobject MainLoop.
+
+    By default, I use the default main context, so only one SyncRunner can
+    run at a time.  A private runner uses a main context of its own, so
+    private runners in other threads can run their tasks at the same time.
     """
 
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, private=False):
         self._verbose = verbose
         self._longest = 0  # longest string shown; for clearing
+        self._context = None
+        if private:
+            if not hasattr(gobject, 'timeout_source_new'):
+                raise ImportError('private task runners need PyGObject')
+            if hasattr(gobject, 'threads_init'):
+                # needed by PyGObject before 3.10
+                gobject.threads_init()
+            self._context = gobject.MainContext()
 
     def run(self, task, verbose=None, skip=False):
         self.debug('run task %r', task)
@@ -478,11 +597,11 @@ class SyncRunner(TaskRunner, ITaskListener):
             self._verboseRun = verbose
         self._skip = skip
 
-        self._loop = gobject.MainLoop()
+        self._loop = gobject.MainLoop(self._context)
         self._task.addListener(self)
         # only start the task after going into the mainloop,
         # otherwise the task might complete before we are in it
-        gobject.timeout_add(0L, self._startWrap, self._task)
+        self._addTimeout(0L, lambda *_: self._startWrap(self._task))
         self.debug('run loop')
         self._loop.run()
 
@@ -510,8 +629,27 @@ class SyncRunner(TaskRunner, ITaskListener):
             self.debug('exception during start: %r', task.exceptionMessage)
             self.stopped(task)
 
+    def _addTimeout(self, interval, callback):
+        if self._context is None:
+            gobject.timeout_add(interval, callback)
+            return
+
+        source = gobject.timeout_source_new(interval)
+        source.set_callback(callback)
+        source.attach(self._context)
+
+    def _addWatch(self, fd, condition, callback):
+        if self._context is None:
+            gobject.io_add_watch(fd, condition, callback)
+            return
+
+        source = gobject.io_create_watch(gobject.IOChannel.unix_new(fd),
+                                         condition)
+        source.set_callback(callback)
+        source.attach(self._context)
+
     def schedule(self, task, delta, callable, *args, **kwargs):
-        def c():
+        def c(*_):
             try:
                 self.debug('schedule: calling %r(*args=%r, **kwargs=%r)',
                            callable, args, kwargs)
@@ -526,7 +664,23 @@ class SyncRunner(TaskRunner, ITaskListener):
         self.debug('schedule: scheduling %r(*args=%r, **kwargs=%r)',
                    callable, args, kwargs)
 
-        gobject.timeout_add(int(delta * 1000L), c)
+        self._addTimeout(int(delta * 1000L), c)
+
+    def watch(self, task, fd, callable, *args, **kwargs):
+        def c(*_):
+            try:
+                return callable(*args, **kwargs)
+            except Exception as e:
+                self.debug('exception when calling watching callable %r',
+                           callable)
+                task.setException(e)
+                self.stopped(task)
+                raise
+        self.debug('watch: watching %d for %r(*args=%r, **kwargs=%r)',
+                   fd, callable, args, kwargs)
+
+        self._addWatch(
+            fd, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, c)
 
     # ITaskListener methods
     def progressed(self, task, value):
@@ -66,13 +66,16 @@ class Image(object):
 
         return self.cue.getRealPath(path)
 
-    def setup(self, runner):
+    def setup(self, runner, workers=1):
         """
         Do initial setup, like figuring out track lengths, and
         constructing the Table of Contents.
+
+        @param workers: how many track lengths to get at the same time
+        @type  workers: int
         """
         logger.debug('setup image start')
-        verify = ImageVerifyTask(self)
+        verify = ImageVerifyTask(self, workers=workers)
         logger.debug('verifying image')
         runner.run(verify)
         logger.debug('verified image')
@@ -107,7 +110,7 @@ class Image(object):
         logger.debug('setup image done')
 
 
-class ImageVerifyTask(task.MultiSeparateTask):
+class ImageVerifyTask(task.MultiParallelTask):
     """
     I verify a disk image and get the necessary track lengths.
     """
@@ -117,8 +120,12 @@ class ImageVerifyTask(task.MultiSeparateTask):
     description = "Checking tracks"
     lengths = None
 
-    def __init__(self, image):
-        task.MultiSeparateTask.__init__(self)
+    def __init__(self, image, workers=1):
+        """
+        @param workers: how many tracks to check at the same time
+        @type  workers: int
+        """
+        task.MultiParallelTask.__init__(self, workers=workers)
 
         self._image = image
         cue = image.cue
@@ -169,18 +176,22 @@ class ImageVerifyTask(task.MultiSeparateTask):
             end = taskk.length / common.SAMPLES_PER_FRAME
             self.lengths[trackIndex] = end - index.relative
 
-        task.MultiSeparateTask.stop(self)
+        task.MultiParallelTask.stop(self)
 
 
-class ImageEncodeTask(task.MultiSeparateTask):
+class ImageEncodeTask(task.MultiParallelTask):
     """
     I encode a disk image to a different format.
     """
 
     description = "Encoding tracks"
 
-    def __init__(self, image, outdir):
-        task.MultiSeparateTask.__init__(self)
+    def __init__(self, image, outdir, workers=1):
+        """
+        @param workers: how many tracks to encode at the same time
+        @type  workers: int
+        """
+        task.MultiParallelTask.__init__(self, workers=workers)
 
         self._image = image
         cue = image.cue
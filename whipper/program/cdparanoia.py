@@ -18,6 +18,8 @@
 # You should have received a copy of the GNU General Public License
 # along with whipper.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import binascii
 import errno
 import os
 import re
@@ -26,15 +28,18 @@ import stat
 import subprocess
 import tempfile
 import time
+import wave
 
 from whipper.common import common
 from whipper.common import task as ctask
-from whipper.extern import asyncsub
 from whipper.extern.task import task
+from whipper.program import flac
 
 import logging
 logger = logging.getLogger(__name__)
 
+CDPARANOIA = 'cd-paranoia'
+
 
 class FileSizeError(Exception):
 
@@ -99,7 +104,10 @@ class ProgressParser:
         # FIXME: privatize
         self.read = start
 
-        self._reads = {}  # read count for each sector
+        # reads are counted per frame of the track as the difference with
+        # the previous frame, so marking a read does not touch every frame
+        self._marks = array.array('i', [0]) * (stop - start + 2)
+        self._counts = None
 
     def parse(self, line):
         """
@@ -158,12 +166,12 @@ class ProgressParser:
             markStart = frameOffset  # - self._firstFrames
             markEnd = frameOffset
 
-        # FIXME: doing this is way too slow even for a testcase, so disable
-        if False:
-            for frame in range(markStart, markEnd):
-                if frame not in list(self._reads.keys()):
-                    self._reads[frame] = 0
-                self._reads[frame] += 1
+        first = max(markStart, self.start) - self.start
+        last = min(markEnd, self.stop + 1) - self.start
+        if first < last:
+            self._marks[first] += 1
+            self._marks[last] -= 1
+            self._counts = None
 
         # cdparanoia reads quite a bit beyond the current track before it
         # goes back to verify; don't count those
@@ -200,6 +208,182 @@ class ProgressParser:
             raise RuntimeError("cdparanoia couldn't read any frames "
                                "for the current track")
 
+    def getReadCounts(self):
+        """
+        Get how many times each frame of the track was read.
+
+        @returns: the read count of every frame from start to stop,
+                  capped at 65535
+        @rtype:   L{array.array} of unsigned short
+        """
+        if self._counts is None:
+            self._counts = array.array('H', [0]) * (self.stop - self.start + 1)
+            count = 0
+            for i in xrange(len(self._counts)):
+                count += self._marks[i]
+                self._counts[i] = min(count, 0xffff)
+
+        return self._counts
+
+    def getReadHistogram(self):
+        """
+        @returns: the number of frames of the track that were read each
+                  number of times
+        @rtype:   dict of int -> int
+        """
+        histogram = {}
+        for count in self.getReadCounts():
+            histogram[count] = histogram.get(count, 0) + 1
+
+        return histogram
+
+    def getRereads(self):
+        """
+        @returns: how many frames of the track were read more than the two
+                  times cdparanoia reads every frame
+        @rtype:   int
+        """
+        return sum([(count - 2) * frames
+                    for count, frames in self.getReadHistogram().items()
+                    if count > 2])
+
+    def getFrameQuality(self):
+        """
+        Unlike L{getTrackQuality}, this is not lowered by a few frames
+        read many times more than by many frames read once more.
+
+        @returns: the fraction of frames of the track that were read, and
+                  read no more than twice
+        @rtype:   float
+        """
+        histogram = self.getReadHistogram()
+        good = histogram.get(1, 0) + histogram.get(2, 0)
+        return float(good) / (self.stop - self.start + 1)
+
+    def getSuspectFrames(self, reads=3):
+        """
+        Get the ranges of frames that cdparanoia had to read again, which
+        is where a scratch or a weak drive is most likely to have left an
+        error.
+
+        @param reads: the number of reads of a frame that makes it suspect
+
+        @returns: the first and last frame of each range of suspect frames
+        @rtype:   list of tuple of (int, int)
+        """
+        ranges = []
+        first = None
+        counts = self.getReadCounts()
+        for i in xrange(len(counts) + 1):
+            suspect = i < len(counts) and counts[i] >= reads
+            if suspect and first is None:
+                first = i
+            elif not suspect and first is not None:
+                ranges.append((self.start + first, self.start + i - 1))
+                first = None
+
+        return ranges
+
+
+# programs that can read audio for ReadVerifyTrackTask
+BACKENDS = ('cdparanoia', 'libcdio')
+
+
+def getReadTrackTask(backend='cdparanoia'):
+    """
+    @param backend: one of L{BACKENDS}
+
+    @returns: the task class that reads a track with the given backend
+    """
+    assert backend in BACKENDS, "unknown backend %r" % backend
+    if backend == 'libcdio':
+        from whipper.program import libcdio
+        return libcdio.ReadTrackTask
+
+    return ReadTrackTask
+
+
+def _mergeRanges(ranges):
+    # merge overlapping and adjacent (first, last) ranges
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+
+    return merged
+
+
+class _Verifier(object):
+    """
+    I compare audio that is given to me a piece at a time with the blocks
+    of an earlier read of the same range, and remember where it first
+    differs.
+
+    @ivar divergence: the first audio sample of the block that differed
+                      from the earlier read; None if it did not differ
+    @ivar chunks:     the CRC32s of the blocks compared, including the
+                      one that differed
+    """
+
+    divergence = None
+
+    def __init__(self, verify):
+        """
+        @param verify: the digest of the earlier read
+        @type  verify: L{whipper.common.checksum.TrackDigestTask} or
+                       L{whipper.common.checksum.TrackDigest}
+        """
+        self._verify = verify
+        self._pending = []  # audio of the block that is not compared yet
+        self._pendingSize = 0
+        self.chunks = []
+
+    def update(self, data):
+        """
+        Compare the blocks completed by the next piece of audio data.
+
+        @returns: whether the audio still matches the earlier read
+        @rtype:   bool
+        """
+        blockSize = self._verify.chunkSamples * 4
+        self._pending.append(data)
+        self._pendingSize += len(data)
+        while self.divergence is None and self._pendingSize >= blockSize:
+            self._compare(blockSize)
+
+        return self.divergence is None
+
+    def finish(self):
+        """
+        Compare the last, possibly shorter, block.
+
+        @returns: whether the audio matches the earlier read
+        @rtype:   bool
+        """
+        if self.divergence is None and self._pendingSize:
+            self._compare(self._pendingSize)
+        if self.divergence is None and \
+                len(self.chunks) != len(self._verify.chunks):
+            # the earlier read was longer
+            self.divergence = len(self.chunks) * self._verify.chunkSamples
+
+        return self.divergence is None
+
+    def _compare(self, size):
+        data = ''.join(self._pending)
+        block, rest = data[:size], data[size:]
+        self._pending = [rest]
+        self._pendingSize = len(rest)
+        index = len(self.chunks)
+        self.chunks.append(binascii.crc32(block) & 0xffffffff)
+        if index >= len(self._verify.chunks) or \
+                self.chunks[-1] != self._verify.chunks[index]:
+            self.divergence = index * self._verify.chunkSamples
+            logger.info('read differs from earlier read at sample %d, '
+                        'terminating', self.divergence)
+
 # FIXME: handle errors
 
 
@@ -207,23 +391,49 @@ class ReadTrackTask(task.Task):
     """
     I am a task that reads a track using cdparanoia.
 
-    @ivar reads: how many reads were done to rip the track
+    When given the digest of an earlier read of the same track, I compare
+    the audio while cdparanoia is writing it, and stop reading as soon as
+    it differs.
+
+    Without a path, cdparanoia writes the audio to a pipe instead of a
+    file, and I give it to sinks while it is read.
+
+    @ivar reads:      how many frames were read to rip the track,
+                      including frames read again
+    @ivar rereads:    how many frames of the track were read more than
+                      twice
+    @ivar suspects:   the first and last frame of each range of frames
+                      that were read more than twice
+    @ivar errors:     how many SCSI errors cdparanoia reported
+    @ivar divergence: the first audio sample, relative to the start of
+                      the read, of the block that differed from the
+                      earlier read; None if it did not differ
+    @ivar chunks:     the CRC32s of the blocks compared with the earlier
+                      read, including the one that differed
     """
 
     description = "Reading track"
     quality = None  # set at end of reading
     speed = None
     duration = None  # in seconds
+    reads = 0
+    rereads = 0
+    suspects = None
+    errors = 0
+    divergence = None
+    chunks = None
 
     _MAXERROR = 100  # number of errors detected by parser
 
     def __init__(self, path, table, start, stop, overread, offset=0,
-                 device=None, action="Reading", what="track"):
+                 device=None, action="Reading", what="track", verify=None,
+                 sinks=None):
         """
         Read the given track.
 
-        @param path:   where to store the ripped track
-        @type  path:   unicode
+        @param path:   where to store the ripped track; None to only give
+                       the audio to the sinks
+        @type  path:   unicode or None
         @param table:  table of contents of CD
         @type  table:  L{table.Table}
         @param start:  first frame to rip
@@ -238,8 +448,16 @@ class ReadTrackTask(task.Task):
         @type  action: str
         @param what:   a string representing what's being read; e.g. Track
         @type  what:   str
+        @param verify: the digest of an earlier read of the same range,
+                       finished by the time I start
+        @type  verify: L{whipper.common.checksum.TrackDigestTask}
+        @param sinks:  objects to give the audio to while it is read,
+                       through update(), and finish() after the last of
+                       it; only used without a path
+        @type  sinks:  list of L{whipper.common.checksum.TrackDigest}
         """
-        assert isinstance(path, unicode), "%r is not unicode" % path
+        assert path is None or isinstance(path, unicode), \
+            "%r is not unicode" % path
 
         self.path = path
         self._table = table
@@ -255,6 +473,19 @@ class ReadTrackTask(task.Task):
         self._errors = []
         self.description = "%s %s" % (action, what)
 
+        self._verify = verify
+        self._verifyFile = None
+        self._verified = 0  # number of blocks compared so far
+        if verify:
+            self.chunks = []
+
+        self._sinks = sinks or []
+        self._verifier = None
+        self._streamed = 0  # bytes of audio read from the pipe
+        if path is None and verify:
+            self._verifier = _Verifier(verify)
+            self.chunks = self._verifier.chunks
+
     def start(self, runner):
         task.Task.start(self, runner)
 
@@ -280,25 +511,30 @@ class ReadTrackTask(task.Task):
 
         bufsize = 1024
         if self._overread:
-            argv = ["cd-paranoia", "--stderr-progress",
+            argv = [CDPARANOIA, "--stderr-progress",
                     "--sample-offset=%d" % self._offset, "--force-overread", ]
         else:
-            argv = ["cd-paranoia", "--stderr-progress",
+            argv = [CDPARANOIA, "--stderr-progress",
                     "--sample-offset=%d" % self._offset, ]
         if self._device:
             argv.extend(["--force-cdrom-device", self._device, ])
+        if self.path is None:
+            argv.append("--output-raw-little-endian")
         argv.extend(["%d[%s]-%d[%s]" % (
             startTrack, common.framesToHMSF(startOffset),
             stopTrack, common.framesToHMSF(stopOffset)),
-            self.path])
+            self.path or "-"])
         logger.debug('running %s', (" ".join(argv), ))
+        if self._verify and self.path and os.path.exists(self.path):
+            # make sure we only ever compare what this read wrote
+            os.unlink(self.path)
         try:
-            self._popen = asyncsub.Popen(argv,
-                                         bufsize=bufsize,
-                                         stdin=subprocess.PIPE,
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE,
-                                         close_fds=True)
+            self._popen = subprocess.Popen(argv,
+                                           bufsize=bufsize,
+                                           stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE,
+                                           close_fds=True)
         except OSError as e:
             import errno
             if e.errno == errno.ENOENT:
@@ -307,16 +543,43 @@ class ReadTrackTask(task.Task):
             raise
 
         self._start_time = time.time()
-        self.schedule(1.0, self._read, runner)
+        self.watch(self._popen.stderr.fileno(), self._read)
+        if self.path is None:
+            self.watch(self._popen.stdout.fileno(), self._readAudio)
+
+    def _readAudio(self, drain=False):
+        """
+        Give the audio cdparanoia wrote to the pipe to the sinks.
 
-    def _read(self, runner):
-        ret = self._popen.recv_err()
+        @param drain: whether to read until the end of the audio
+        """
+        while True:
+            data = os.read(self._popen.stdout.fileno(), 65536)
+            if not data:
+                return False
+
+            self._streamed += len(data)
+            if self._verifier and self.divergence is None:
+                if not self._verifier.update(data):
+                    self.divergence = self._verifier.divergence
+                    self._popen.terminate()
+            if self.divergence is None:
+                for sink in self._sinks:
+                    sink.update(data)
+
+            if not drain:
+                return True
+
+    def _read(self):
+        ret = os.read(self._popen.stderr.fileno(), 4096)
         if not ret:
-            if self._popen.poll() is not None:
-                self._done()
-                return
-            self.schedule(0.01, self._read, runner)
-            return
+            # cdparanoia closed stderr, so it is exiting
+            if self.path is None:
+                # get the audio still in the pipe
+                self._readAudio(drain=True)
+            self._popen.wait()
+            self._done()
+            return False
 
         self._buffer += ret
 
@@ -338,6 +601,9 @@ class ReadTrackTask(task.Task):
                 logger.debug('%d errors, terminating', self._parser.errors)
                 self._popen.terminate()
 
+            if self._verify and self.path and self.divergence is None:
+                self._compare()
+
             num = self._parser.wrote - self._start + 1
             den = self._stop - self._start + 1
             assert den != 0, "stop %d should be >= start %d" % (
@@ -346,26 +612,78 @@ class ReadTrackTask(task.Task):
             if progress < 1.0:
                 self.setProgress(progress)
 
-        # 0 does not give us output before we complete, 1.0 gives us output
-        # too late
-        self.schedule(0.01, self._read, runner)
-
-    def _poll(self, runner):
-        if self._popen.poll() is None:
-            self.schedule(1.0, self._poll, runner)
-            return
+        return True
 
-        self._done()
+    def _compare(self):
+        """
+        Compare the blocks cdparanoia wrote completely since the last call
+        with the earlier read, and terminate it on the first difference.
+        """
+        if not self._verifyFile:
+            try:
+                self._verifyFile = open(self.path, 'rb')
+            except IOError:
+                # not created yet
+                return
+            self._verifyFile.seek(44)  # wav header is 44 bytes
+
+        chunks = self._verify.chunks
+        blockSize = self._verify.chunkSamples * 4
+        total = (self._stop - self._start + 1) * common.BYTES_PER_FRAME
+        written = os.fstat(self._verifyFile.fileno()).st_size - 44
+        while self._verified < len(chunks):
+            end = min((self._verified + 1) * blockSize, total)
+            if written < end:
+                return
+            data = self._verifyFile.read(end - self._verified * blockSize)
+            self.chunks.append(binascii.crc32(data) & 0xffffffff)
+            if self.chunks[-1] != chunks[self._verified]:
+                self.divergence = self._verified * self._verify.chunkSamples
+                logger.info('read differs from earlier read at sample %d, '
+                            'terminating', self.divergence)
+                self._popen.terminate()
+                return
+            self._verified += 1
 
     def _done(self):
         end_time = time.time()
         self.setProgress(1.0)
 
-        # check if the length matches
-        size = os.stat(self.path)[stat.ST_SIZE]
-        # wav header is 44 bytes
         offsetLength = self._stop - self._start + 1
-        expected = offsetLength * common.BYTES_PER_FRAME + 44
+        self.reads = self._parser.reads
+        self.rereads = self._parser.getRereads()
+        self.suspects = self._parser.getSuspectFrames()
+        self.errors = self._parser.errors
+        self.quality = self._parser.getTrackQuality()
+        logger.debug('read histogram: %r, frame quality: %.4f',
+                     self._parser.getReadHistogram(),
+                     self._parser.getFrameQuality())
+        self.duration = end_time - self._start_time
+        self.speed = (offsetLength / 75.0) / self.duration
+
+        if self._verifier:
+            if self.divergence is None and not self._verifier.finish():
+                self.divergence = self._verifier.divergence
+        elif self._verify:
+            if self.divergence is None:
+                self._compare()
+            if self._verifyFile:
+                self._verifyFile.close()
+        if self.divergence is not None:
+            self.setAndRaiseException(ChecksumException(
+                'read and verify failed: read differs from test read '
+                'at sample %d' % self.divergence))
+            self.stop()
+            return
+
+        # check if the length matches
+        if self.path is None:
+            size = self._streamed
+            expected = offsetLength * common.BYTES_PER_FRAME
+        else:
+            size = os.stat(self.path)[stat.ST_SIZE]
+            # wav header is 44 bytes
+            expected = offsetLength * common.BYTES_PER_FRAME + 44
         if size != expected:
             # FIXME: handle errors better
             logger.warning('file size %d did not match expected size %d',
@@ -389,18 +707,237 @@ class ReadTrackTask(task.Task):
                 logger.warning('exit code %r', self._popen.returncode)
                 self.exception = ReturnCodeError(self._popen.returncode)
 
-        self.quality = self._parser.getTrackQuality()
-        self.duration = end_time - self._start_time
-        self.speed = (offsetLength / 75.0) / self.duration
+        if not self.exception:
+            try:
+                for sink in self._sinks:
+                    sink.finish()
+            except Exception as e:
+                self.setException(e)
 
         self.stop()
         return
 
 
+class RepairTrackTask(task.MultiSeparateTask):
+    """
+    I repair a track on which the copy read differs from the test read,
+    by reading only the differing blocks again.
+
+    Every read of a block is a vote for its CRC32; a block is accepted as
+    soon as two reads agree on it.  Once all blocks are accepted, I write
+    the agreed audio over the copy read.
+
+    I do nothing if the copy read did not differ from the test read.
+
+    @ivar repaired: whether the track needed repairing
+    @ivar chunks:   the CRC32s of the accepted blocks
+    @ivar duration: the time spent reading blocks again, in seconds
+    """
+
+    description = "Repairing track"
+    repaired = False
+    chunks = None
+    duration = 0.0
+
+    def __init__(self, path, table, start, stop, overread, offset=0,
+                 device=None, what="track", test=None, copy=None, tries=5,
+                 backend='cdparanoia'):
+        """
+        @param path:    the path of the copy read; the repaired track is
+                        written there
+        @type  path:    unicode
+        @param test:    the digest of the test read
+        @type  test:    L{whipper.common.checksum.TrackDigestTask}
+        @param copy:    the copy read, compared with the test read
+        @type  copy:    L{ReadTrackTask}
+        @param tries:   how many times to read a block again, at most
+        @type  tries:   int
+        @param backend: what to read the blocks with; one of L{BACKENDS}
+        @type  backend: str
+        """
+        task.MultiSeparateTask.__init__(self)
+
+        self.path = path
+        self._table = table
+        self._start = start
+        self._stop = stop
+        self._overread = overread
+        self._offset = offset
+        self._device = device
+        self._what = what
+        self._test = test
+        self._copy = copy
+        self._tries = tries
+        self._reader = getReadTrackTask(backend)
+
+        self._votes = None  # per block, CRC32 -> [count, path, first block]
+        self._attempts = None  # per block, how often it was read again
+        self._paths = []  # files with blocks read again
+        self._digest = None
+        self._first = None  # first block of the current read
+
+    def start(self, runner):
+        if self._copy.divergence is None:
+            task.Task.start(self, runner)
+            self.schedule(0.0, self.stop)
+            return
+
+        self.repaired = True
+        blocks = len(self._test.chunks)
+        self._votes = [{} for _ in range(blocks)]
+        self._attempts = [0] * blocks
+        self._vote(self._test.path, 0, self._test.chunks)
+        self._vote(self._copy.path, 0, self._copy.chunks)
+        self._readNext()
+
+        task.MultiSeparateTask.start(self, runner)
+
+    def stopped(self, t):
+        if t.exception:
+            task.MultiSeparateTask.stopped(self, t)
+            return
+
+        if isinstance(t, self._reader):
+            self.duration += t.duration
+        elif t is self._digest:
+            self._vote(t.path, self._first, t.chunks)
+            try:
+                if not self._readNext():
+                    self._write()
+            except Exception as e:
+                self.setException(e)
+                self.stop()
+                return
+
+        task.MultiSeparateTask.stopped(self, t)
+
+    def stop(self):
+        for path in self._paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        task.MultiSeparateTask.stop(self)
+
+    def _vote(self, path, first, chunks):
+        for i, crc in enumerate(chunks):
+            votes = self._votes[first + i]
+            if crc in votes:
+                votes[crc][0] += 1
+            else:
+                votes[crc] = [1, path, first]
+
+    def _agreed(self, block):
+        """
+        @returns: the CRC32 two reads agree on for the given block, or None
+        """
+        for crc, (count, _, _) in self._votes[block].items():
+            if count >= 2:
+                return crc
+
+        return None
+
+    def _readNext(self):
+        """
+        Add tasks to read the first range of unaccepted blocks again.
+
+        @returns: whether there was anything left to read
+        """
+        unaccepted = [b for b in range(len(self._votes))
+                      if self._agreed(b) is None]
+        if not unaccepted:
+            return False
+
+        first = last = unaccepted[0]
+        while last + 1 in unaccepted:
+            last += 1
+        if max(self._attempts[first:last + 1]) >= self._tries:
+            raise ChecksumException(
+                'repair failed: no two reads agree on samples %d to %d' % (
+                    first * self._test.chunkSamples,
+                    (last + 1) * self._test.chunkSamples - 1))
+
+        from whipper.common import checksum
+
+        blockFrames = self._test.chunkSamples // common.SAMPLES_PER_FRAME
+        start = self._start + first * blockFrames
+        stop = min(self._start + (last + 1) * blockFrames - 1, self._stop)
+        logger.debug('reading frames %d to %d again', start, stop)
+
+        fd, path = tempfile.mkstemp(suffix='.whipper.wav')
+        path = unicode(path)
+        os.close(fd)
+        self._paths.append(path)
+
+        self._first = first
+        self._digest = checksum.TrackDigestTask(path)
+        self._digest.chunkSamples = self._test.chunkSamples
+        self.addTask(self._reader(path, self._table, start, stop,
+                                  self._overread, offset=self._offset,
+                                  device=self._device, action="Repairing",
+                                  what=self._what))
+        self.addTask(self._digest)
+        for b in range(first, last + 1):
+            self._attempts[b] += 1
+
+        return True
+
+    def _write(self):
+        """
+        Write the accepted blocks over the copy read.
+        """
+        blockSize = self._test.chunkSamples * 4
+        total = (self._stop - self._start + 1) * common.BYTES_PER_FRAME
+        logger.info('read %d of %d blocks again',
+                    len([a for a in self._attempts if a]), len(self._votes))
+
+        fd, tmppath = tempfile.mkstemp(suffix='.whipper.wav')
+        tmppath = unicode(tmppath)
+        os.close(fd)
+        handles = {}
+        chunks = []
+        try:
+            w = wave.open(tmppath, 'wb')
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            for block in range(len(self._votes)):
+                crc = self._agreed(block)
+                _, path, first = self._votes[block][crc]
+                if path not in handles:
+                    handles[path] = open(path, 'rb')
+                # wav header is 44 bytes
+                handles[path].seek(44 + (block - first) * blockSize)
+                w.writeframes(handles[path].read(
+                    min(blockSize, total - block * blockSize)))
+                chunks.append(crc)
+            w.close()
+            os.rename(tmppath, self.path)
+        except Exception:
+            os.unlink(tmppath)
+            raise
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+        self.chunks = chunks
+
+
 class ReadVerifyTrackTask(task.MultiSeparateTask):
     """
-    I am a task that reads and verifies a track using cdparanoia.
-    I also encode the track.
+    I am a task that reads and verifies a track using cdparanoia, or one
+    of the other L{BACKENDS}.
+    I also encode the track, unless asked not to; the verified track can
+    then be encoded later with finish(), for example in a worker thread
+    while the drive reads the next track.
+
+    When streaming, neither read is written to a temporary file: the audio
+    goes straight from the reads into the digests, and from the copy read
+    into flac as well.
+
+    When given AccurateRip responses, I look up the test read in them.  If
+    it matches well enough, I skip the copy read; if it matches at all, I
+    keep it when the copy read differs from it, instead of failing.  If
+    the responses do not have the track, the test read is not looked up.
 
     The path where the file is stored can be changed if necessary, for
     example if the file name is too long.
@@ -415,24 +952,43 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
                         track duration.
     @ivar testduration: the test duration of the track, in seconds.
     @ivar copyduration: the copy duration of the track, in seconds.
+    @ivar rereads:      how many frames the test and copy reads read more
+                        than the two times cdparanoia reads every frame
+    @ivar suspects:     the first and last frame of each range of frames
+                        that the test or copy read read more than twice
+    @ivar errors:       how many SCSI errors the test and copy reads got
     @ivar peak:         the peak level of the track
+    @ivar arv1:         the AccurateRip v1 checksum of the track, or None
+    @ivar arv2:         the AccurateRip v2 checksum of the track, or None
+    @ivar arconfidence: the AccurateRip confidence of the test read, if
+                        it was looked up
     """
 
     checksum = None
     testchecksum = None
     copychecksum = None
     peak = None
+    arv1 = None
+    arv2 = None
+    arconfidence = None
     quality = None
     testspeed = None
     copyspeed = None
     testduration = None
     copyduration = None
+    rereads = None
+    suspects = None
+    errors = None
 
     _tmpwavpath = None
+    _tmptestpath = None
     _tmppath = None
+    _encoder = None
 
     def __init__(self, path, table, start, stop, overread, offset=0,
-                 device=None, taglist=None, what="track"):
+                 device=None, taglist=None, what="track", number=None,
+                 encode=True, repair=0, backend='cdparanoia', stream=False,
+                 responses=None, confidence=None):
         """
         @param path:    where to store the ripped track
         @type  path:    str
@@ -448,31 +1004,38 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
         @type  device:  str
         @param taglist: a dict of tags
         @type  taglist: dict
+        @param number:  the track number, to calculate AccurateRip checksums
+                        for; None or 0 (HTOA) to skip them
+        @type  number:  int
+        @param encode:  whether to encode and tag the track; if False,
+                        call finish() after I stopped successfully
+        @type  encode:  bool
+        @param repair:  if the copy read differs from the test read, how
+                        many times to read the differing blocks again
+                        instead of failing; 0 to fail
+        @type  repair:  int
+        @param backend: what to read the track with; one of L{BACKENDS}
+        @type  backend: str
+        @param stream:  whether to encode the copy read while it is read,
+                        without temporary files; needs encode and can't
+                        repair
+        @type  stream:  bool
+        @param responses:  the AccurateRip responses for the disc, to look
+                           up the test read in
+        @type  responses:  list of
+                           L{whipper.common.accurip._AccurateRipResponse}
+        @param confidence: the AccurateRip confidence the test read needs
+                           to skip the copy read; None to never skip it
+        @type  confidence: int or None
         """
         task.MultiSeparateTask.__init__(self)
 
         logger.debug('creating read and verify task on %r', path)
+        assert not stream or (encode and not repair), \
+            "streaming needs encode and can't repair"
 
         if taglist:
             logger.debug('read and verify with taglist %r', taglist)
-        # FIXME: choose a dir on the same disk/dir as the final path
-        fd, tmppath = tempfile.mkstemp(suffix='.whipper.wav')
-        tmppath = unicode(tmppath)
-        os.close(fd)
-        self._tmpwavpath = tmppath
-
-        from whipper.common import checksum
-
-        self.tasks = []
-        self.tasks.append(
-            ReadTrackTask(tmppath, table, start, stop, overread,
-                          offset=offset, device=device, what=what))
-        self.tasks.append(checksum.CRC32Task(tmppath))
-        t = ReadTrackTask(tmppath, table, start, stop, overread,
-                          offset=offset, device=device, action="Verifying",
-                          what=what)
-        self.tasks.append(t)
-        self.tasks.append(checksum.CRC32Task(tmppath))
 
         # encode to the final path + '.part'
         try:
@@ -486,57 +1049,226 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
             open(tmpoutpath, 'wb').close()
         self._tmppath = tmpoutpath
         self.path = path
+        self._taglist = taglist
+        self._encode = encode
+        self._stream = stream
+        self._repair = None
+        self._number = number
+        self._responses = None
+        self._confidence = confidence
+
+        from whipper.common import accurip, checksum
+
+        if number and responses:
+            if accurip.has_track(responses, number):
+                self._responses = responses
+            else:
+                # the test read can never match, so read the track twice
+                # without looking it up
+                logger.info('track %d is not in the AccurateRip entry, '
+                            'reading it twice', number)
+
+        # the test read only needs AccurateRip checksums to be looked up
+        testNumber = self._responses and number or None
+        reader = getReadTrackTask(backend)
+        if stream:
+            samples = (stop - start + 1) * common.SAMPLES_PER_FRAME
+            self._testDigest = checksum.TrackDigest(
+                samples, track_number=testNumber,
+                total_tracks=table.getAudioTracks())
+            self._copyDigest = checksum.TrackDigest(
+                samples, track_number=number,
+                total_tracks=table.getAudioTracks())
+            self._encoder = flac.StreamEncoder(tmpoutpath)
+            testSinks = [self._testDigest]
+            if self._responses:
+                # the test read may turn out to be the only read
+                testSinks.append(self._encoder)
+            self._testRead = reader(None, table, start, stop, overread,
+                                    offset=offset, device=device, what=what,
+                                    sinks=testSinks)
+            self._copyRead = reader(None, table, start, stop, overread,
+                                    offset=offset, device=device,
+                                    action="Verifying", what=what,
+                                    verify=self._testDigest,
+                                    sinks=[self._copyDigest, self._encoder])
+
+            from whipper.common import encode
+
+            self.tasks = [self._testRead, self._copyRead,
+                          encode.TaggingTask(tmpoutpath, taglist)]
+            self.checksum = None
+            return
 
-        from whipper.common import encode
+        # FIXME: choose a dir on the same disk/dir as the final path
+        fd, tmppath = tempfile.mkstemp(suffix='.whipper.wav')
+        tmppath = unicode(tmppath)
+        os.close(fd)
+        self._tmpwavpath = tmppath
+        # the test read is kept separately, so it can be used for repairs
+        fd, testpath = tempfile.mkstemp(suffix='.whipper.wav')
+        testpath = unicode(testpath)
+        os.close(fd)
+        self._tmptestpath = testpath
+
+        self._testRead = reader(testpath, table, start, stop, overread,
+                                offset=offset, device=device, what=what)
+        self._testDigest = checksum.TrackDigestTask(
+            testpath, track_number=testNumber,
+            total_tracks=table.getAudioTracks())
+        # compare the copy read with the test read while it is running, so
+        # we can give up on it early
+        self._copyRead = reader(tmppath, table, start, stop, overread,
+                                offset=offset, device=device,
+                                action="Verifying", what=what,
+                                verify=self._testDigest)
+        # the copy digest also provides the peak level and the AccurateRip
+        # checksums, so that nothing else has to read the file again
+        self._copyDigest = checksum.TrackDigestTask(
+            tmppath, track_number=number,
+            total_tracks=table.getAudioTracks())
+
+        self.tasks = [self._testRead, self._testDigest, self._copyRead]
+        if repair:
+            self._repair = RepairTrackTask(
+                tmppath, table, start, stop, overread, offset=offset,
+                device=device, what=what, test=self._testDigest,
+                copy=self._copyRead, tries=repair, backend=backend)
+            self.tasks.append(self._repair)
+        self.tasks.append(self._copyDigest)
+
+        if encode:
+            from whipper.common import encode
+
+            # flac --verify makes sure our encoding is accurate
+            self.tasks.append(encode.FlacEncodeTask(tmppath, tmpoutpath))
+
+            # TODO: Move tagging outside of cdparanoia
+            self.tasks.append(encode.TaggingTask(tmpoutpath, taglist))
 
-        self.tasks.append(encode.FlacEncodeTask(tmppath, tmpoutpath))
+        self.checksum = None
 
-        # MerlijnWajer: XXX: We run the CRC32Task on the wav file, because it's
-        # in general stupid to run the CRC32 on the flac file since it already
-        # has --verify. We should just get rid of this CRC32 step.
-        # make sure our encoding is accurate
-        self.tasks.append(checksum.CRC32Task(tmppath))
-        self.tasks.append(encode.SoxPeakTask(tmppath))
+    def stopped(self, t):
+        if t is self._copyRead and self.arconfidence and \
+                t.divergence is not None and not self._stream:
+            # the test read is known to be good, so there is no need to
+            # read the track again
+            logger.info('copy read differs from test read, keeping the '
+                        'test read, which matches AccurateRip')
+            t.exception = None
+            t.exceptionMessage = None
+            self._useTestRead()
+        elif t is self._copyRead and self._repair and \
+                t.divergence is not None:
+            # the differing blocks get read again by the repair task
+            logger.info('copy read differs from test read, repairing')
+            t.exception = None
+            t.exceptionMessage = None
+
+        tested = self._stream and self._testRead or self._testDigest
+        if t is tested and not t.exception and self._responses:
+            self._checkAccurateRip()
+
+        # compare the reads before encoding anything; when streaming, the
+        # encoded file gets thrown away if they differ
+        copied = self._stream and self._copyRead or self._copyDigest
+        if t is copied and not t.exception:
+            if self._repair and self._repair.repaired:
+                # every block was read the same way at least twice
+                self.testchecksum = self.copychecksum = t.checksum
+                match = t.chunks == self._repair.chunks
+            else:
+                self.testchecksum = self._testDigest.checksum
+                self.copychecksum = self._copyDigest.checksum
+                match = self.testchecksum == self.copychecksum
+            if not match:
+                logger.info('checksums do not match, %08x %08x',
+                            self.testchecksum, self.copychecksum)
+                self.exception = ChecksumException(
+                    'read and verify failed: test checksum')
+                self.stop()
+                return
 
-        # TODO: Move tagging outside of cdparanoia
-        self.tasks.append(encode.TaggingTask(tmpoutpath, taglist))
+        task.MultiSeparateTask.stopped(self, t)
 
-        self.checksum = None
+    def _checkAccurateRip(self):
+        """
+        Skip the copy read if the test read matches AccurateRip well
+        enough; it is then used as the copy read too.
+        """
+        from whipper.common import accurip
+
+        self.arconfidence = accurip.match_track(
+            self._responses, self._number,
+            [self._testDigest.v1, self._testDigest.v2])
+        logger.debug('test read has AccurateRip confidence %d',
+                     self.arconfidence)
+        if self._confidence is None or \
+                self.arconfidence < self._confidence:
+            return
+
+        logger.info('test read matches AccurateRip with confidence %d, '
+                    'skipping the copy read', self.arconfidence)
+        self._useTestRead()
+        self._copyRead = self._testRead
+
+    def _useTestRead(self):
+        """
+        Use the test read instead of the copy read, and skip the tasks
+        that are left to do on the copy read.
+        """
+        # only tasks that did not start yet can be skipped; the copy read
+        # may be the task that just stopped
+        skipped = (self._copyRead, self._repair, self._copyDigest)
+        self.tasks = self.tasks[:self._task] + [
+            t for t in self.tasks[self._task:] if t not in skipped]
+        if not self._stream:
+            os.rename(self._tmptestpath, self._tmpwavpath)
+        self._copyDigest = self._testDigest
+        self.testchecksum = self.copychecksum = self._testDigest.checksum
 
     def stop(self):
         # FIXME: maybe this kind of try-wrapping to make sure
         # we chain up should be handled by a parent class function ?
         try:
             if not self.exception:
-                self.quality = max(self.tasks[0].quality,
-                                   self.tasks[2].quality)
-                self.peak = self.tasks[6].peak
+                self.quality = max(self._testRead.quality,
+                                   self._copyRead.quality)
+                self.peak = self._copyDigest.peak
                 logger.debug('peak: %r', self.peak)
-                self.testspeed = self.tasks[0].speed
-                self.copyspeed = self.tasks[2].speed
-                self.testduration = self.tasks[0].duration
-                self.copyduration = self.tasks[2].duration
-
-                self.testchecksum = c1 = self.tasks[1].checksum
-                self.copychecksum = c2 = self.tasks[3].checksum
-                if c1 == c2:
-                    logger.info('checksums match, %08x', c1)
-                    self.checksum = self.testchecksum
+                self.testspeed = self._testRead.speed
+                self.copyspeed = self._copyRead.speed
+                self.testduration = self._testRead.duration
+                self.copyduration = self._copyRead.duration
+                reads = [self._testRead, self._copyRead]
+                if self._copyRead is self._testRead:
+                    # the copy read was skipped
+                    self.copyduration = 0.0
+                    reads = [self._testRead]
+                self.rereads = sum([r.rereads for r in reads])
+                self.suspects = _mergeRanges(
+                    sum([r.suspects for r in reads], []))
+                if self.suspects:
+                    logger.info('frames read more than twice: %s',
+                                ', '.join(['%d-%d' % r
+                                           for r in self.suspects]))
+                self.errors = sum([r.errors for r in reads])
+                if self._repair:
+                    self.copyduration += self._repair.duration
+
+                logger.info('checksums match, %08x', self.copychecksum)
+                self.checksum = self.testchecksum
+
+                self.arv1 = self._copyDigest.v1
+                self.arv2 = self._copyDigest.v2
+
+                if not self._encode:
+                    # finish() still needs the unencoded file
+                    logger.debug('leaving %r for finish()', self._tmpwavpath)
                 else:
-                    # FIXME: detect this before encoding
-                    logger.info('checksums do not match, %08x %08x',
-                                c1, c2)
-                    self.exception = ChecksumException(
-                        'read and verify failed: test checksum')
-
-                if self.tasks[5].checksum != self.checksum:
-                    self.exception = ChecksumException(
-                        'Encoding failed, checksum does not match')
-
-                # delete the unencoded file
-                os.unlink(self._tmpwavpath)
-
-                if not self.exception:
+                    # delete the unencoded file
+                    if self._tmpwavpath:
+                        os.unlink(self._tmpwavpath)
                     try:
                         logger.debug('moving to final path %r', self.path)
                         os.rename(self._tmppath, self.path)
@@ -544,15 +1276,42 @@ class ReadVerifyTrackTask(task.MultiSeparateTask):
                         logger.debug('exception while moving to final '
                                      'path %r: %s', self.path, e)
                         self.exception = e
-                else:
-                    os.unlink(self._tmppath)
             else:
                 logger.debug('stop: exception %r', self.exception)
+                if self._encoder:
+                    self._encoder.abort()
+                for path in (self._tmpwavpath, self._tmppath):
+                    if path and os.path.exists(path):
+                        os.unlink(path)
+            if self._tmptestpath and os.path.exists(self._tmptestpath):
+                os.unlink(self._tmptestpath)
         except Exception as e:
             print('WARNING: unhandled exception %r' % (e, ))
 
         task.MultiSeparateTask.stop(self)
 
+    def finish(self):
+        """
+        Encode and tag the verified track, and move it to its final path.
+
+        Only needed when I was created with encode=False.  This does not
+        need a runner, so it is safe to call from a worker thread.
+        """
+        from whipper.common import encode
+
+        assert not self._encode, "track was already encoded"
+        try:
+            flac.encode(self._tmpwavpath, self._tmppath)
+            encode.tag(self._tmppath, self._taglist)
+            logger.debug('moving to final path %r', self.path)
+            os.rename(self._tmppath, self.path)
+        except Exception:
+            if os.path.exists(self._tmppath):
+                os.unlink(self._tmppath)
+            raise
+        finally:
+            os.unlink(self._tmpwavpath)
+
 
 _VERSION_RE = re.compile(
     "^cdparanoia (?P<version>.+) release (?P<release>.+)")
@@ -560,7 +1319,7 @@ _VERSION_RE = re.compile(
 
 def getCdParanoiaVersion():
     getter = common.VersionGetter('cd-paranoia',
-                                  ["cd-paranoia", "-V"],
+                                  [CDPARANOIA, "-V"],
                                   _VERSION_RE,
                                   "%(version)s %(release)s")
 
@@ -585,7 +1344,7 @@ class AnalyzeTask(ctask.PopenTask):
     def __init__(self, device=None):
         # cdparanoia -A *always* writes cdparanoia.log
         self.cwd = tempfile.mkdtemp(suffix='.whipper.cache')
-        self.command = ['cd-paranoia', '-A']
+        self.command = [CDPARANOIA, '-A']
         if device:
             self.command += ['-d', device]
 
@@ -13,9 +13,17 @@ logger = logging.getLogger(__name__)
 CDRDAO = 'cdrdao'
 
 
-def read_toc(device, fast_toc=False, toc_path=None):
+def read_toc(device, fast_toc=False, toc_path=None, started=None):
     """
     Return cdrdao-generated table of contents for 'device'.
+
+    The TOC file is saved to 'toc_path' with a .toc extension, if given.
+    'toc_path' can also be a function that returns the path, or None, when
+    called after cdrdao is done, so that it can be decided while cdrdao
+    reads the disc.
+
+    'started' is called with the cdrdao process once it runs, if given, so
+    that another thread can kill it when the TOC is not needed after all.
     """
     # cdrdao MUST be passed a non-existing filename as its last argument
     # to write the TOC to; it does not support writing to stdout or
@@ -32,10 +40,15 @@ def read_toc(device, fast_toc=False, toc_path=None):
     # PIPE is the closest to >/dev/null we can get
     logger.debug("executing %r", cmd)
     p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    if started:
+        started(p)
     _, stderr = p.communicate()
     if p.returncode != 0:
         msg = 'cdrdao read-toc failed: return code is non-zero: ' + \
               str(p.returncode)
+        if p.returncode < 0:
+            # killed, so nobody is waiting for the TOC
+            raise IOError(msg)
         logger.critical(msg)
         # Gracefully handle missing disc
         if "ERROR: Unit not ready, giving up." in stderr:
@@ -44,6 +57,8 @@ def read_toc(device, fast_toc=False, toc_path=None):
 
     toc = TocFile(tocfile)
     toc.parse()
+    if callable(toc_path):
+        toc_path = toc_path()
     if toc_path is not None:
         t_comp = os.path.abspath(toc_path).split(os.sep)
         t_dirn = os.sep.join(t_comp[:-1])
@@ -95,11 +110,11 @@ def ReadTOCTask(device):
     return read_toc(device, fast_toc=True)
 
 
-def ReadTableTask(device, toc_path=None):
+def ReadTableTask(device, toc_path=None, started=None):
     """
     stopgap morituri-insanity compatibility layer
     """
-    return read_toc(device, toc_path=toc_path)
+    return read_toc(device, toc_path=toc_path, started=started)
 
 
 def getCDRDAOVersion():
@@ -1,8 +1,28 @@
-from subprocess import check_call, CalledProcessError
+from subprocess import check_call, CalledProcessError, Popen, PIPE
 
 import logging
 logger = logging.getLogger(__name__)
 
+FLAC = 'flac'
+
+
+def encode_command(infile, outfile):
+    """
+    Returns the command to encode infile to outfile, with flac.
+    Uses '-f' because whipper already creates the file.
+    """
+    return [FLAC, '--silent', '--verify', '-o', outfile, '-f', infile]
+
+
+def stream_encode_command(outfile):
+    """
+    Returns the command to encode 16-bit stereo little-endian audio, read
+    from standard input without a header, to outfile, with flac.
+    """
+    return [FLAC, '--silent', '--verify', '--force-raw-format',
+            '--endian=little', '--sign=signed', '--channels=2', '--bps=16',
+            '--sample-rate=44100', '-o', outfile, '-f', '-']
+
 
 def encode(infile, outfile):
     """
@@ -12,8 +32,68 @@ def encode(infile, outfile):
     try:
         # TODO: Replace with Popen so that we can catch stderr and write it to
         # logging
-        check_call(['flac', '--silent', '--verify', '-o', outfile,
-                    '-f', infile])
+        check_call(encode_command(infile, outfile))
     except CalledProcessError:
         logger.exception('flac failed')
         raise
+
+
+class StreamEncoder(object):
+    """
+    I encode audio that is given to me a piece at a time to FLAC, while it
+    is being read, by writing it to the standard input of flac.
+
+    After finish() or abort(), I start encoding again from the beginning
+    with the next piece, overwriting the file.
+    """
+
+    _popen = None
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.command = stream_encode_command(outfile)
+
+    def update(self, data):
+        """
+        Add the next piece of 16-bit stereo audio data.
+
+        @type data: str
+        """
+        if not self._popen:
+            logger.debug('encoding to %r', self.outfile)
+            self._popen = Popen(self.command, stdin=PIPE, close_fds=True)
+        self._popen.stdin.write(data)
+
+    def finish(self):
+        """
+        Call me after the last piece of audio data; I wait for flac to
+        finish writing and verifying the file.
+        """
+        if not self._popen:
+            self.update('')
+        popen, self._popen = self._popen, None
+        popen.stdin.close()
+        if popen.wait() != 0:
+            logger.error('flac failed on %r', self.outfile)
+            raise CalledProcessError(popen.returncode, self.command)
+
+    def abort(self):
+        """
+        Stop encoding, for example because the audio turned out to be bad.
+        """
+        popen, self._popen = self._popen, None
+        if popen and popen.returncode is None:
+            popen.kill()
+            popen.stdin.close()
+            popen.wait()
+
+
+def decode(infile):
+    """
+    Decodes infile with flac, writing WAV to a pipe.
+
+    Returns the flac process; read the decoded audio from its stdout.
+    """
+    logger.debug('decoding %r', infile)
+    return Popen([FLAC, '--silent', '--decode', '--stdout', infile],
+                 stdout=PIPE)
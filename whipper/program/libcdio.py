@@ -0,0 +1,342 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_program_libcdio -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is part of whipper.
+#
+# whipper is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# whipper is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with whipper.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Read audio in-process with libcdio, through pycdio.
+
+pycdio does not wrap libcdio's paranoia library, so every frame is read
+once, and only read again when the drive reports an error.  The test and
+copy reads of L{whipper.program.cdparanoia.ReadVerifyTrackTask} catch the
+errors the drive does not report.
+"""
+
+import time
+import wave
+
+from whipper.common import common
+from whipper.extern.task import task
+from whipper.program.cdparanoia import ChecksumException, _mergeRanges, \
+    _Verifier
+
+import logging
+logger = logging.getLogger(__name__)
+
+# number of frames to read at a time; one second of audio
+_BLOCK_FRAMES = 75
+# number of times to read a block before giving up on it
+_TRIES = 5
+
+
+class ReadError(Exception):
+    """
+    The drive could not read the given frames.
+    """
+
+    def __init__(self, first, last, message):
+        self.args = (first, last, message)
+        self.first = first
+        self.last = last
+        self.message = message
+
+
+def _readFrames(read, lsn, count, readable):
+    """
+    Read count frames starting at lsn; frames outside of readable are
+    returned as silence.
+
+    @returns: the audio data, the number of times frames were read again,
+              and the number of errors
+    @rtype:   tuple of (str, int, int)
+    """
+    first = max(lsn, readable[0])
+    last = min(lsn + count, readable[1])
+    if first >= last:
+        return '\0' * count * common.BYTES_PER_FRAME, 0, 0
+
+    errors = 0
+    while True:
+        try:
+            data = read(first, last - first)
+            break
+        except IOError as e:
+            errors += 1
+            logger.debug('error reading frames %d to %d: %r',
+                         first, last - 1, e)
+            if errors >= _TRIES:
+                raise ReadError(first, last - 1, str(e))
+
+    return ('\0' * (first - lsn) * common.BYTES_PER_FRAME + data +
+            '\0' * (lsn + count - last) * common.BYTES_PER_FRAME,
+            errors * (last - first), errors)
+
+
+def read_audio(read, start, stop, leadout, offset=0, overread=False,
+               stats=None):
+    """
+    Read the audio of the given frames, the same way cd-paranoia does with
+    the same offset.
+
+    Audio before the start and after the end of the disc is silence, unless
+    overread is set and the drive can read it.
+
+    @param read:     reads the given number of frames from the given
+                     frame, raising IOError when the drive reports an
+                     error
+    @type  read:     callable taking (int, int), returning str
+    @param start:    first frame to read
+    @type  start:    int
+    @param stop:     last frame to read (inclusive)
+    @type  stop:     int
+    @param leadout:  the first frame of the lead-out
+    @type  leadout:  int
+    @param offset:   read offset, in samples
+    @type  offset:   int
+    @param overread: whether to try to read the lead-in and lead-out
+    @type  overread: bool
+    @param stats:    updated with the number of frames the audio is on,
+                     the number of frames read, read again, the ranges
+                     read again, and the number of errors
+    @type  stats:    dict or None
+
+    @returns: the audio data, as little-endian 16-bit stereo PCM, one
+              block at a time
+    @rtype:   generator of str
+    """
+    if stats is None:
+        stats = {}
+    stats.update(reads=0, rereads=0, suspects=[], errors=0)
+
+    first = start * common.SAMPLES_PER_FRAME + offset
+    end = (stop + 1) * common.SAMPLES_PER_FRAME + offset
+    skip = (first % common.SAMPLES_PER_FRAME) * 4
+    remaining = (end - first) * 4
+
+    readable = (0, leadout)
+    if overread:
+        # the lead-in is 150 frames long
+        readable = (-150, 0x7fffffff)
+
+    lsn = first // common.SAMPLES_PER_FRAME
+    # one more frame than asked for when the offset is not a whole number
+    # of frames
+    stats['frames'] = -(-end // common.SAMPLES_PER_FRAME) - lsn
+    while remaining > 0:
+        count = min(_BLOCK_FRAMES,
+                    -(-(skip + remaining) // common.BYTES_PER_FRAME))
+        try:
+            data, rereads, errors = _readFrames(read, lsn, count, readable)
+        except ReadError:
+            if readable == (0, leadout) or 0 <= lsn < lsn + count <= leadout:
+                raise
+            # the drive can't overread after all
+            logger.debug('could not overread frames %d to %d',
+                         lsn, lsn + count - 1)
+            readable = (0, leadout)
+            continue
+
+        stats['reads'] += count + rereads
+        stats['rereads'] += rereads
+        stats['errors'] += errors
+        if rereads:
+            stats['suspects'] = _mergeRanges(
+                stats['suspects'] + [(lsn, lsn + count - 1)])
+
+        data = data[skip:skip + remaining]
+        skip = 0
+        remaining -= len(data)
+        lsn += count
+        yield data
+
+
+class ReadTrackTask(task.Task):
+    """
+    I am a task that reads a track in-process with libcdio.
+
+    I can be used instead of L{whipper.program.cdparanoia.ReadTrackTask};
+    I take the same arguments, write the same WAV file, and set the same
+    attributes.  The audio can also be given to sinks while it is read,
+    so it does not have to be read back from the file.
+
+    @ivar reads:      how many frames were read to rip the track,
+                      including frames read again
+    @ivar rereads:    how many frames were read again after an error
+    @ivar suspects:   the first and last frame of each range of frames
+                      that were read again
+    @ivar errors:     how many read errors the drive reported
+    @ivar divergence: the first audio sample, relative to the start of
+                      the read, of the block that differed from the
+                      earlier read; None if it did not differ
+    @ivar chunks:     the CRC32s of the blocks compared with the earlier
+                      read, including the one that differed
+    """
+
+    description = "Reading track"
+    quality = None
+    speed = None
+    duration = None
+    reads = 0
+    rereads = 0
+    suspects = None
+    errors = 0
+    divergence = None
+    chunks = None
+
+    def __init__(self, path, table, start, stop, overread, offset=0,
+                 device=None, action="Reading", what="track", verify=None,
+                 sinks=None):
+        """
+        Read the given track.
+
+        @param path:   where to store the ripped track; None to only give
+                       the audio to the sinks
+        @type  path:   unicode or None
+        @param sinks:  objects to give the audio to while it is read,
+                       through update(), and finish() after the last of it
+        @type  sinks:  list of L{whipper.common.checksum.TrackDigest}
+
+        See L{whipper.program.cdparanoia.ReadTrackTask} for the other
+        arguments.
+        """
+        assert path is None or isinstance(path, unicode), \
+            "%r is not unicode" % path
+
+        self.path = path
+        self._table = table
+        self._start = start
+        self._stop = stop
+        self._offset = offset
+        self._overread = overread
+        self._device = device
+        self._sinks = sinks or []
+        self.description = "%s %s" % (action, what)
+
+        self._verifier = None
+        if verify:
+            self._verifier = _Verifier(verify)
+            self.chunks = self._verifier.chunks
+
+    def start(self, runner):
+        task.Task.start(self, runner)
+
+        read = self._open()
+
+        self._wave = None
+        if self.path:
+            self._wave = wave.open(self.path, 'wb')
+            self._wave.setnchannels(2)
+            self._wave.setsampwidth(2)
+            self._wave.setframerate(44100)
+
+        self._stats = {}
+        self._audio = read_audio(read, self._start, self._stop,
+                                 self._table.leadout, self._offset,
+                                 self._overread, self._stats)
+        self._total = (self._stop - self._start + 1) * common.BYTES_PER_FRAME
+        self._read = 0
+        self._start_time = time.time()
+        self.schedule(0.0, self._readBlock)
+
+    def _open(self):
+        """
+        Open the device, and set self._cdrom to it.
+
+        @returns: reads the given number of frames from the given frame,
+                  raising IOError when the drive reports an error
+        @rtype:   callable taking (int, int), returning str
+        """
+        try:
+            import cdio
+            import pycdio
+        except ImportError:
+            raise common.MissingDependencyException('pycdio')
+
+        device = self._device
+        if device is None:
+            device = cdio.get_default_device_driver()[0]
+        logger.debug('reading frames %d to %d from %s', self._start,
+                     self._stop, device)
+        self._cdrom = cdio.Device(device)
+
+        def read(lsn, count):
+            try:
+                return self._cdrom.read_sectors(
+                    lsn, pycdio.READ_MODE_AUDIO, count)[1]
+            except cdio.DeviceException as e:
+                raise IOError(str(e))
+
+        return read
+
+    def _readBlock(self):
+        try:
+            data = next(self._audio, None)
+            if data is not None:
+                self._write(data)
+        except Exception as e:
+            self._close()
+            self.setException(e)
+            self.stop()
+            return
+
+        if data is None or self.divergence is not None:
+            self._done()
+        else:
+            self.setProgress(float(self._read) / self._total)
+            self.schedule(0.0, self._readBlock)
+
+    def _write(self, data):
+        self._read += len(data)
+        if self._wave:
+            self._wave.writeframesraw(data)
+        if self._verifier and not self._verifier.update(data):
+            self.divergence = self._verifier.divergence
+            return
+        for sink in self._sinks:
+            sink.update(data)
+
+    def _close(self):
+        if self._wave:
+            self._wave.close()
+            self._wave = None
+        self._cdrom.close()
+
+    def _done(self):
+        self.duration = time.time() - self._start_time
+        self._close()
+
+        frames = self._stop - self._start + 1
+        self.reads = self._stats['reads']
+        self.rereads = self._stats['rereads']
+        self.suspects = self._stats['suspects']
+        self.errors = self._stats['errors']
+        self.quality = min(
+            float(self._stats['frames']) / max(self.reads, 1), 1.0)
+        self.speed = (frames / 75.0) / max(self.duration, 0.001)
+
+        if self._verifier and not self._verifier.finish():
+            self.divergence = self._verifier.divergence
+            self.setAndRaiseException(ChecksumException(
+                'read and verify failed: read differs from test read '
+                'at sample %d' % self.divergence))
+        else:
+            try:
+                for sink in self._sinks:
+                    sink.finish()
+            except Exception as e:
+                self.setException(e)
+
+        self.stop()
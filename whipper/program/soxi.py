@@ -1,7 +1,9 @@
 import os
+import struct
 
 from whipper.common import common
 from whipper.common import task as ctask
+from whipper.extern.task import task
 
 import logging
 logger = logging.getLogger(__name__)
@@ -9,10 +11,81 @@ logger = logging.getLogger(__name__)
 SOXI = 'soxi'
 
 
+def _wave_length(f):
+    f.seek(12)
+    blockAlign = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunkId, size = struct.unpack('<4sI', header)
+        # chunks are padded to an even size
+        skip = size + (size & 1)
+        if chunkId == 'fmt ':
+            fmt = f.read(size)
+            if len(fmt) < 14:
+                return None
+            blockAlign = struct.unpack('<H', fmt[12:14])[0]
+            skip -= len(fmt)
+        elif chunkId == 'data':
+            if not blockAlign or size in (0, 0xffffffff):
+                # unknown format, or length not written (yet)
+                return None
+            # don't count past the end of a truncated file
+            start = f.tell()
+            f.seek(0, os.SEEK_END)
+            size = min(size, f.tell() - start)
+            return size // blockAlign
+        f.seek(skip, os.SEEK_CUR)
+
+
+def _flac_length(f):
+    header = f.read(4)
+    if header[:3] == 'ID3':
+        # skip an ID3v2 tag; its size is stored as 4 times 7 bits
+        header += f.read(6)
+        size = 0
+        for byte in bytearray(header[6:10]):
+            size = (size << 7) | byte
+        f.seek(10 + size)
+        header = f.read(4)
+    if header != 'fLaC':
+        return None
+
+    # STREAMINFO is always the first metadata block
+    block = f.read(4 + 34)
+    if len(block) < 38 or ord(block[0]) & 0x7f != 0:
+        return None
+    high, low = struct.unpack('>BI', block[4 + 13:4 + 18])
+    return ((high & 0x0f) << 32 | low) or None
+
+
+def audio_length(path):
+    """
+    Get the length of a WAVE or FLAC file from its headers.
+
+    @type  path: unicode
+
+    @returns: the length in audio samples, or None if the headers don't
+              tell
+    @rtype:   int or None
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if header[:4] == 'RIFF' and header[8:12] == 'WAVE':
+            return _wave_length(f)
+
+        f.seek(0)
+        return _flac_length(f)
+
+
 class AudioLengthTask(ctask.PopenTask):
     """
     I calculate the length of a track in audio samples.
 
+    The length of WAVE and FLAC files is read from their headers; soxi is
+    only run for other files.
+
     @ivar  length: length of the decoded audio file, in audio samples.
     """
     logCategory = 'AudioLengthTask'
@@ -27,11 +100,24 @@ class AudioLengthTask(ctask.PopenTask):
 
         self.logName = os.path.basename(path).encode('utf-8')
 
+        self._path = path
+
         self.command = [SOXI, '-s', path]
 
         self._error = []
         self._output = []
 
+    def start(self, runner):
+        self.length = audio_length(self._path)
+        if self.length is None:
+            ctask.PopenTask.start(self, runner)
+            return
+
+        logger.debug('length of %r from its headers: %d',
+                     self._path, self.length)
+        task.Task.start(self, runner)
+        self.schedule(0.0, self.stop)
+
     def commandMissing(self):
         raise common.MissingDependencyException('soxi')
 
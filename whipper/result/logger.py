@@ -37,8 +37,11 @@ class WhipperLogger(result.Logger):
         lines.append("Ripping phase information:")
         lines.append("  Drive: %s%s (revision %s)" % (
             ripResult.vendor, ripResult.model, ripResult.release))
-        lines.append("  Extraction engine: cdparanoia %s" %
-                     ripResult.cdparanoiaVersion)
+        if ripResult.backend and ripResult.backend != 'cdparanoia':
+            lines.append("  Extraction engine: %s" % ripResult.backend)
+        else:
+            lines.append("  Extraction engine: cdparanoia %s" %
+                         ripResult.cdparanoiaVersion)
         if ripResult.cdparanoiaDefeatsCache is None:
             defeat = "Unknown"
         elif ripResult.cdparanoiaDefeatsCache:
@@ -79,6 +79,8 @@ class RipResult:
 
     @ivar cdrdaoVersion:     version of cdrdao used for the rip
     @ivar cdparanoiaVersion: version of cdparanoia used for the rip
+    @ivar backend:           what the audio was read with, if not
+                             cdparanoia
     """
 
     offset = 0
@@ -96,6 +98,7 @@ class RipResult:
     cdrdaoVersion = None
     cdparanoiaVersion = None
     cdparanoiaDefeatsCache = None
+    backend = None
 
     classVersion = 3
 
@@ -0,0 +1,137 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_command_cd -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from whipper.command import cd
+from whipper.common import task
+from whipper.test import common
+
+
+class _TOC(object):
+
+    def getCDDBDiscId(self):
+        return '0a0b0c0d'
+
+
+class _Program(object):
+    """
+    I read the table with a cdrdao that takes the given number of seconds.
+    """
+
+    cdrdao = None
+    path = None
+    runner = None
+
+    def __init__(self, seconds):
+        self._seconds = seconds
+
+    def getTable(self, runner, cddbdiscid, mbdiscid, device, offset,
+                 out_path, started=None):
+        self.runner = runner
+        self.cdrdao = subprocess.Popen(['sleep', str(self._seconds)])
+        started(self.cdrdao)
+        self.cdrdao.wait()
+        if self.cdrdao.returncode != 0:
+            raise IOError('cdrdao was killed')
+        self.path = out_path()
+        return 'table'
+
+
+class _Command(cd._CD):
+    """
+    I only have what _CD.do set up before reading the table.
+    """
+
+    def __init__(self):
+        self.program = _Program(30)
+        self.runner = None
+        self.ittoc = _TOC()
+        self.mbdiscid = 'mbdiscid'
+        self.device = '/dev/cdrom'
+        self.options = argparse.Namespace(offset=0)
+
+
+class ReadTableTestCase(common.TestCase):
+
+    def setUp(self):
+        self.cd = _Command()
+
+    def tearDown(self):
+        cdrdao = self.cd.program.cdrdao
+        if cdrdao and cdrdao.poll() is None:
+            cdrdao.kill()
+            cdrdao.wait()
+
+    def testNotNeeded(self):
+        then = time.time()
+        self.assertEqual(self.cd._readTable(lambda: None), None)
+        # cdrdao was killed instead of waited for
+        self.assertTrue(time.time() - then < 10)
+        self.assertTrue(self.cd.program.cdrdao.returncode < 0)
+
+    def testLookUpFails(self):
+        def lookUp():
+            raise KeyError('no metadata')
+
+        self.assertRaises(KeyError, self.cd._readTable, lookUp)
+        self.assertTrue(self.cd.program.cdrdao.returncode < 0)
+
+    def testNeeded(self):
+        self.cd.program = _Program(0.1)
+        self.cd.runner = task.SyncRunner()
+        self.assertEqual(self.cd._readTable(lambda: u'disc'), 'table')
+        self.assertEqual(self.cd.program.path, u'disc')
+        # the table is not read with the runner that shows progress
+        self.assertNotIdentical(self.cd.program.runner, self.cd.runner)
+        self.assertFalse(self.cd.program.runner._verbose)
+
+
+class _Rip(cd.Rip):
+    """
+    I rip from several drives, without parsing arguments.
+    """
+
+    def __init__(self, drives, workingDirectory):
+        self.drives = drives
+        self.options = argparse.Namespace(
+            device=None, offset=None, workers=1,
+            working_directory=workingDirectory)
+
+
+class RipDrivesTestCase(common.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._dir = os.path.realpath(
+            tempfile.mkdtemp(suffix=u'.whipper.test'))
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        shutil.rmtree(self._dir)
+
+    def testWorkingDirectory(self):
+        ripped = []
+        lock = threading.Lock()
+
+        def do(command):
+            with lock:
+                ripped.append((command.options.device, os.getcwd(),
+                               command.options.working_directory))
+
+        self.patch(cd._CD, 'do', do)
+        rip = _Rip([('/dev/sr0', 6), ('/dev/sr1', 667)], self._dir)
+        self.assertEqual(rip.do(), None)
+
+        # every drive rips in the working directory, without changing to
+        # it again
+        self.assertEqual(sorted(ripped), [
+            ('/dev/sr0', self._dir, None),
+            ('/dev/sr1', self._dir, None),
+        ])
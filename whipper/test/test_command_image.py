@@ -0,0 +1,205 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_command_image -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import wave
+
+from whipper.command import image
+from whipper.common import program
+from whipper.test import common
+
+_CUE = """FILE "track.wav" WAVE
+  TRACK 01 AUDIO
+    INDEX 01 00:00:00
+"""
+
+
+def _writeImage(path):
+    """
+    Write an image of a single track of ten silent frames.
+    """
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(_CUE)
+    w = wave.open(os.path.join(os.path.dirname(path), 'track.wav'), 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(44100)
+    w.writeframes('\0' * 4 * 588 * 10)
+    w.close()
+
+
+class _ImageTestCase(common.TestCase):
+
+    def setUp(self):
+        self.dir = os.path.realpath(tempfile.mkdtemp(suffix=u'.whipper.test'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _path(self, *names):
+        return os.path.join(self.dir, *names)
+
+
+class FindCueFilesTestCase(_ImageTestCase):
+
+    def setUp(self):
+        _ImageTestCase.setUp(self)
+        for name in ('a', 'b', os.path.join('b', 'c')):
+            os.makedirs(self._path(name))
+        for name in ('a/1.cue', 'b/2.CUE', 'b/c/3.cue', 'b/c/3.log'):
+            open(self._path(name), 'w').close()
+
+    def testDirectory(self):
+        self.assertEqual(image._findCueFiles([self.dir]), [
+            self._path('a', '1.cue'),
+            self._path('b', '2.CUE'),
+            self._path('b', 'c', '3.cue'),
+        ])
+
+    def testDuplicates(self):
+        # a file found through both its directory and a glob, and a
+        # directory given as a relative path, are only verified once
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        try:
+            paths = image._findCueFiles([
+                self._path('b', 'c', '*.cue'), self._path('b'), 'b'])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(paths, [
+            self._path('b', 'c', '3.cue'),
+            self._path('b', '2.CUE'),
+        ])
+
+    def testSymlink(self):
+        # a symlinked directory is not searched, and a symlinked file is
+        # only verified once
+        os.symlink(self._path('b', 'c'), self._path('a', 'c'))
+        os.symlink(self._path('b', '2.CUE'), self._path('a', '4.cue'))
+        self.assertEqual(image._findCueFiles([self._path('a')]), [
+            self._path('a', '1.cue'),
+            self._path('a', '4.cue'),
+        ])
+        self.assertEqual(
+            image._findCueFiles([self._path('a'), self._path('b')]), [
+                self._path('a', '1.cue'),
+                self._path('a', '4.cue'),
+                self._path('b', 'c', '3.cue'),
+            ])
+
+    def testMissing(self):
+        # a missing file is passed on, to report that it cannot be verified
+        self.assertEqual(image._findCueFiles([self._path('d.cue')]),
+                         [self._path('d.cue')])
+
+
+class ReadStateTestCase(_ImageTestCase):
+
+    def _readState(self, lines):
+        path = self._path('state')
+        with open(path, 'w') as f:
+            f.write(''.join(['%s\t%s\n' % line for line in lines]))
+        return image._readState(path)
+
+    def testNoState(self):
+        self.assertEqual(image._readState(None), set())
+        self.assertEqual(image._readState(self._path('state')), set())
+
+    def testVerified(self):
+        self.assertEqual(self._readState([
+            ('verified', '/a.cue'),
+            ('failed', '/b.cue'),
+        ]), set([u'/a.cue']))
+
+    def testVerifiedAgain(self):
+        # the last run over an image counts
+        self.assertEqual(self._readState([
+            ('failed', '/a.cue'),
+            ('verified', '/b.cue'),
+            ('verified', '/a.cue'),
+            ('failed', '/b.cue'),
+        ]), set([u'/a.cue']))
+
+
+class VerifyTestCase(_ImageTestCase):
+
+    def setUp(self):
+        _ImageTestCase.setUp(self)
+        self.stdouts = []
+
+        test = self
+
+        def verifyImage(self, runner, table):
+            test.stdouts.append(sys.stdout)
+            verified = 'good' in self.cuePath
+            for track in self.result.tracks:
+                track.AR['v1']['CRC'] = '%08x' % 1
+                track.AR['v2']['CRC'] = '%08x' % 2
+                if verified:
+                    track.AR['v2']['DBCRC'] = '%08x' % 2
+                    track.AR['v2']['DBConfidence'] = 5
+                    track.AR['DBMaxConfidence'] = 5
+                    track.AR['DBMaxConfidenceCRC'] = '%08x' % 2
+            return verified
+
+        self.patch(program.Program, 'verifyImage', verifyImage)
+        self.stdout = StringIO.StringIO()
+        self.patch(sys, 'stdout', self.stdout)
+
+    def _verify(self, *args):
+        verify = image.Verify(list(args), 'whipper image verify', None)
+        try:
+            verify.do()
+        except SystemExit as e:
+            return e.code
+        return 0
+
+    def testReport(self):
+        path = self._path(u'good', u'disc.cue')
+        _writeImage(path)
+
+        self.assertEqual(self._verify(path), 0)
+        output = self.stdout.getvalue().split('\r')
+        self.assertEqual(output[-1],
+                         'track  1: rip accurate     (max confidence      5) '
+                         'v1 [00000001], v2 [00000002], DB [00000002]\n')
+        # the report is only captured after verifying, so that progress
+        # is shown as it is made
+        self.assertEqual(self.stdouts, [self.stdout])
+        self.assertTrue(output[0].startswith('Checking tracks'))
+
+    def testSummary(self):
+        for name in (u'good1', u'bad', u'good2'):
+            _writeImage(self._path(name, u'disc.cue'))
+        state = self._path(u'state')
+
+        self.assertEqual(self._verify(self.dir, '--state', state), 1)
+        output = self.stdout.getvalue().splitlines()
+        self.assertEqual(output[-1], '2 of 3 images verified')
+        self.assertEqual(
+            [line.split(',')[0] for line in output if 'albums/min' in line],
+            ['1 of 3 images', '2 of 3 images', '3 of 3 images'])
+        self.assertEqual(sorted(open(state).read().splitlines()), [
+            'failed\t%s' % self._path('bad', 'disc.cue'),
+            'verified\t%s' % self._path('good1', 'disc.cue'),
+            'verified\t%s' % self._path('good2', 'disc.cue'),
+        ])
+
+        # resuming only verifies the image that failed again
+        self.stdout.truncate(0)
+        del self.stdouts[:]
+        self.assertEqual(self._verify(self.dir, '--state', state), 1)
+        output = self.stdout.getvalue().splitlines()
+        self.assertEqual(output[0], 'skipping 2 image(s) already verified '
+                         'in %s' % state)
+        self.assertEqual(len(self.stdouts), 1)
+
+    def testNotFound(self):
+        self.assertEqual(self._verify(self._path(u'missing.cue')), 1)
+        self.assertTrue(self.stdout.getvalue().startswith(
+            'could not verify image: '))
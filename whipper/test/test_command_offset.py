@@ -0,0 +1,136 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_command_offset -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import argparse
+import wave
+
+from whipper.command import offset
+from whipper.common import accurip, common
+from whipper.extern.task import task
+from whipper.image import table
+from whipper.test import common as tcommon
+
+SAMPLES = common.SAMPLES_PER_FRAME
+
+
+def _checksums(samples, first):
+    """
+    Calculate the AccurateRip v1 and v2 checksums of a track the slow way,
+    counting the samples from the given 1-based position on.
+    """
+    v1 = 0
+    v2 = 0
+    for i, sample in enumerate(samples):
+        if i + 1 < first:
+            continue
+        product = (i + 1) * int(sample)
+        v1 += product
+        v2 += (product & 0xffffffff) + (product >> 32)
+    return '%08x' % (v1 & 0xffffffff), '%08x' % (v2 & 0xffffffff)
+
+
+class _ReadTrackTask(task.Task):
+    """
+    I read the disc of the test, with the read offset of its drive.
+    """
+
+    description = 'Reading'
+    disc = None
+    driveOffset = 0
+    reads = []
+
+    def __init__(self, path, table, start, stop, overread, offset, device):
+        self.path = path
+        self.reads.append((start, stop))
+        self._start = start
+        self._stop = stop
+
+    def start(self, runner):
+        task.Task.start(self, runner)
+        # the drive returns the audio of the disc driveOffset samples late,
+        # and silence outside of the disc
+        first = self._start * SAMPLES - self.driveOffset
+        last = (self._stop + 1) * SAMPLES - self.driveOffset
+        samples = accurip.numpy.zeros(last - first, dtype='<u4')
+        read = self.disc[max(first, 0):min(last, len(self.disc))]
+        samples[max(-first, 0):max(-first, 0) + len(read)] = read
+
+        w = wave.open(self.path, 'wb')
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(samples.tostring())
+        w.close()
+        self.stop()
+
+
+class _Find(offset.Find):
+    """
+    I find the offset without parsing arguments.
+    """
+
+    def __init__(self):
+        self.options = argparse.Namespace(device='/dev/cdrom')
+
+
+class ArcsTestCase(tcommon.TestCase):
+
+    if not accurip.numpy:
+        skip = 'requires numpy'
+
+    def setUp(self):
+        # three tracks of 20 frames
+        tracks = []
+        for number in range(1, 4):
+            t = table.Track(number, audio=True)
+            t.index(1, absolute=(number - 1) * 20, path=None, relative=0)
+            tracks.append(t)
+        self.table = table.Table(tracks)
+        self.table.leadout = 60
+
+        state = accurip.numpy.random.RandomState(0)
+        self.disc = state.randint(0, 1 << 32, 60 * SAMPLES).astype('<u4')
+        self.patch(_ReadTrackTask, 'disc', self.disc)
+        self.patch(_ReadTrackTask, 'reads', [])
+        self.patch(offset.cdparanoia, 'ReadTrackTask', _ReadTrackTask)
+
+        self.find = _Find()
+        self.runner = task.SyncRunner(verbose=False)
+
+    def _find(self, track, driveOffset, offsets):
+        self.patch(_ReadTrackTask, 'driveOffset', driveOffset)
+        margin = max([abs(o) for o in offsets])
+        samples = self.find._readTrack(self.runner, self.table, track, margin)
+        checksums = self.find._arcs(samples, margin, self.table, track,
+                                    offsets)
+
+        start = self.table.getTrackStart(track) * SAMPLES
+        end = (self.table.getTrackEnd(track) + 1) * SAMPLES
+        v1, v2 = _checksums(self.disc[start:end],
+                            track == 1 and 5 * SAMPLES or 1)
+        return ([o for o in offsets if checksums[o][0] == v1],
+                [o for o in offsets if checksums[o][1] == v2])
+
+    def testTrack(self):
+        offsets = [-1164, -24, 0, 6, 48, 667, 1292]
+        for driveOffset in (-1164, 0, 6, 667, 1292):
+            self.assertEqual(self._find(2, driveOffset, offsets),
+                             ([driveOffset], [driveOffset]))
+
+    def testFirstTrack(self):
+        offsets = [-1164, -24, 0, 6, 48, 667, 1292]
+        for driveOffset in (-1164, 0, 6, 667, 1292):
+            self.assertEqual(self._find(1, driveOffset, offsets),
+                             ([driveOffset], [driveOffset]))
+
+        # the margin before the first track is not read, as it is not on
+        # the disc
+        self.assertEqual(set(_ReadTrackTask.reads), set([(0, 22)]))
+
+    def testMargin(self):
+        self.patch(_ReadTrackTask, 'driveOffset', 6)
+        samples = self.find._readTrack(self.runner, self.table, 2, 667)
+        self.assertEqual(_ReadTrackTask.reads, [(18, 41)])
+        self.assertEqual(len(samples), 20 * SAMPLES + 2 * 667)
+        # the first sample of the track as read is at index margin
+        self.assertEqual(samples[667 + 6], self.disc[20 * SAMPLES])
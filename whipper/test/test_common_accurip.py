@@ -1,17 +1,24 @@
 # -*- Mode: Python; test-case-name: whipper.test.test_common_accurip -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import BaseHTTPServer
+import SocketServer
+import random
+import struct
 import sys
+import threading
+import wave
 from StringIO import StringIO
 from os import chmod, makedirs
 from os.path import dirname, exists, join
 from shutil import copy, rmtree
 from tempfile import mkdtemp
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 from whipper.common import accurip
 from whipper.common.accurip import (
-    calculate_checksums, get_db_entry, print_report, verify_result,
+    calculate_checksums, get_db_entry, has_track, match_track,
+    print_report, verify_result,
     _split_responses, EntryNotFound
 )
 from whipper.result.result import RipResult, TrackResult
@@ -57,9 +64,10 @@ class TestAccurateRipResponse(TestCase):
 
     def test_retrieves_and_saves_accuraterip_entry(self):
         # for path, entry in zip(self.paths[0], self.entries):
-        self.assertFalse(exists(join(self.cache_dir, self.path)))
+        self.assertEqual(accurip._get_cache().get(self.path), None)
         self.assertEqual(get_db_entry(self.path), self.entry)
-        self.assertTrue(exists(join(self.cache_dir, self.path)))
+        self.assertEqual(_split_responses(
+            accurip._get_cache().get(self.path)[0]), self.entry)
 
     def test_AccurateRipResponse_parses_correctly(self):
         responses = get_db_entry(self.path)
@@ -83,17 +91,332 @@ class TestAccurateRipResponse(TestCase):
         self.assertEqual(responses[1].checksums[0], 'dc77f9ab')
         self.assertEqual(responses[1].checksums[1], 'dd97d2c3')
 
+    def test_split_responses_parses_every_response(self):
+        raw = open(join(dirname(__file__), self.path[6:])).read()
+        responses = _split_responses(raw * 3)
+        self.assertEqual(len(responses), 6)
+        self.assertEqual(responses[4], self.entry[0])
+        self.assertEqual(responses[5].crcs, (0xdc77f9ab, 0xdd97d2c3))
+        self.assertEqual(responses[5].confidences, (5, 5))
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A stand-in for the AccurateRip server, serving the entries in the test
+    directory.  It fails the first `failures' requests for every path.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.clients.add(self.client_address)
+        server.requests.append(self.path)
+        path = join(dirname(__file__), self.path.split('/')[-1])
+        if server.requests.count(self.path) <= server.failures:
+            self.send_response(503)
+            body = ''
+        elif self.path.endswith('.bin') and exists(path):
+            self.send_response(200)
+            body = open(path, 'rb').read()
+        else:
+            self.send_response(404)
+            body = ''
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadEntries(TestCase):
+    path = 'c/1/2/dBAR-002-0000f21c-00027ef8-05021002.bin'
+
+    def setUp(self):
+        self.cache_dir = mkdtemp(suffix='whipper_accurip_cache_test')
+        self.addCleanup(rmtree, self.cache_dir)
+
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.clients = set()
+        self.server.requests = []
+        self.server.failures = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        for name, value in [
+                ('_CACHE_DIR', self.cache_dir),
+                ('ACCURATERIP_URL',
+                 'http://127.0.0.1:%d/accuraterip/' % self.server.server_port),
+                ('_BACKOFF', 0.0),
+                ('_session', None),
+                ('_cache', None)]:
+            self.addCleanup(setattr, accurip, name, getattr(accurip, name))
+            setattr(accurip, name, value)
+
+    def test_caches_entries_and_misses(self):
+        missing = '0/0/0/dBAR-001-missing.bin'
+        for i in range(2):
+            self.assertEqual(get_db_entry(self.path), _split_responses(
+                open(join(dirname(__file__), self.path[6:])).read()))
+            with self.assertRaises(EntryNotFound):
+                get_db_entry(missing)
+
+        # cached entries and misses are not downloaded again
+        self.assertEqual(self.server.requests, [
+            '/accuraterip/' + self.path, '/accuraterip/' + missing])
+
+    def test_reuses_connections(self):
+        for i in range(20):
+            with self.assertRaises(EntryNotFound):
+                get_db_entry('%d/0/0/dBAR-%03d.bin' % (i, i))
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_retries_server_errors(self):
+        self.server.failures = 2
+        self.assertEqual(len(get_db_entry(self.path)), 2)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = accurip._RETRIES + 1
+        with self.assertRaises(EntryNotFound):
+            get_db_entry(self.path)
+        self.assertEqual(len(self.server.requests), accurip._RETRIES + 1)
+
+    def test_refreshes_expired_entries(self):
+        get_db_entry(self.path)
+        accurip._get_cache().put(self.path, 'stale', ttl=-1)
+        self.assertEqual(len(get_db_entry(self.path)), 2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_keeps_expired_entries_when_offline(self):
+        raw = open(join(dirname(__file__), self.path[6:])).read()
+        accurip._get_cache().put(self.path, raw, ttl=-1)
+        self.server.failures = accurip._RETRIES + 1
+        self.assertEqual(get_db_entry(self.path), _split_responses(raw))
+
+
+class TestAccurateRipCache(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp(suffix='whipper_accurip_cache_test')
+        self.addCleanup(rmtree, self.cache_dir)
+
+    def test_evicts_least_recently_used(self):
+        cache = accurip.AccurateRipCache(
+            join(self.cache_dir, 'entries.sqlite'), size=3100)
+        self.addCleanup(cache.close)
+        for name in 'abc':
+            cache.put(name, name * 1000)
+        cache.get('a')
+        cache.put('d', 'd' * 1000)
+        self.assertEqual(cache.get('b'), None)
+        for name in 'acd':
+            self.assertEqual(cache.get(name), (name * 1000, False))
+
+    def test_remembers_misses(self):
+        cache = accurip.AccurateRipCache(
+            join(self.cache_dir, 'entries.sqlite'))
+        self.addCleanup(cache.close)
+        cache.put('a', None)
+        self.assertEqual(cache.get('a'), (None, False))
+        cache.put('a', None, ttl=-1)
+        self.assertEqual(cache.get('a'), (None, True))
+
+    def test_imports_directory_tree(self):
+        path = 'c/1/2/dBAR-002-0000f21c-00027ef8-05021002.bin'
+        makedirs(dirname(join(self.cache_dir, path)))
+        copy(join(dirname(__file__), path[6:]), join(self.cache_dir, path))
+        cache = accurip.AccurateRipCache(
+            join(self.cache_dir, 'entries.sqlite'))
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.get(path)[0],
+                         open(join(self.cache_dir, path), 'rb').read())
+
 # XXX: test arc.py
 
 
+def _reference_checksums(samples, track_number, total_tracks):
+    """
+    Straight port of src/accuraterip-checksum.c, to check against.
+    """
+    check_from = 0
+    check_to = len(samples)
+    if track_number == 1:
+        check_from += 2940
+    if track_number == total_tracks:
+        check_to -= 2940
+    v1 = v2 = 0
+    for i, value in enumerate(samples):
+        multiplier = i + 1
+        if check_from <= multiplier <= check_to:
+            product = value * multiplier
+            v1 = (v1 + product) & 0xffffffff
+            v2 = (v2 + (product & 0xffffffff) + (product >> 32)) & 0xffffffff
+    return v1, v2
+
+
 class TestCalculateChecksums(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp(suffix='whipper_accurip_checksum_test')
+        self.addCleanup(rmtree, self.tmpdir)
+
+    def _write_wave(self, name, samples):
+        path = join(self.tmpdir, name)
+        w = wave.open(path, 'wb')
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(struct.pack('<%dI' % len(samples), *samples))
+        w.close()
+        return path
+
     def test_returns_none_for_bad_files(self):
         self.assertEqual(
             calculate_checksums(['/does/not/exist']),
             {'v1': [None], 'v2': [None]}
         )
 
-    # TODO: test success when file exists
+    @skipUnless(accurip.numpy, 'numpy is not available')
+    def test_matches_reference_implementation(self):
+        rand = random.Random(1)
+        tracks = [
+            [rand.randint(0, 0xffffffff) for _ in range(n)]
+            for n in (7000, 6001, 9000)
+        ]
+        paths = [
+            self._write_wave('track%d.wav' % i, samples)
+            for i, samples in enumerate(tracks)
+        ]
+        expected = [
+            _reference_checksums(samples, i + 1, len(tracks))
+            for i, samples in enumerate(tracks)
+        ]
+        self.assertEqual(calculate_checksums(paths), {
+            'v1': ['%08x' % v1 for v1, _ in expected],
+            'v2': ['%08x' % v2 for _, v2 in expected],
+        })
+
+    @skipUnless(accurip.numpy, 'numpy is not available')
+    def test_accumulates_unaligned_updates(self):
+        rand = random.Random(2)
+        samples = [rand.randint(0, 0xffffffff) for _ in range(7000)]
+        data = struct.pack('<%dI' % len(samples), *samples)
+        arc = accurip.AccurateRipChecksum(len(samples), 1, 1)
+        for i in range(0, len(data), 4099):
+            arc.update(data[i:i + 4099])
+        self.assertEqual((arc.v1, arc.v2),
+                         _reference_checksums(samples, 1, 1))
+
+    @skipUnless(accurip.numpy, 'numpy is not available')
+    def test_rejects_non_cd_audio(self):
+        path = join(self.tmpdir, 'mono.wav')
+        w = wave.open(path, 'wb')
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes('\0' * 4000)
+        w.close()
+        self.assertEqual(calculate_checksums([path]),
+                         {'v1': [None], 'v2': [None]})
+
+
+class TestShiftedChecksums(TestCase):
+    @skipUnless(accurip.numpy, 'numpy is not available')
+    def test_matches_checksum_of_every_offset(self):
+        rand = random.Random(3)
+        samples = [rand.randint(0, 0xffffffff) for _ in range(9000)]
+        buf = accurip.numpy.array(samples, dtype=accurip.numpy.uint32)
+        offsets = range(-1000, 1001, 97) + [0, 3]
+        for track_number in (1, 2, 3):
+            checksums = accurip.shifted_checksums(
+                buf, 1500, 6000, offsets, track_number, 3)
+            for offset in offsets:
+                self.assertEqual(checksums[offset], _reference_checksums(
+                    samples[1500 + offset:7500 + offset], track_number, 3))
+
+    @skipUnless(accurip.numpy, 'numpy is not available')
+    def test_can_skip_v2(self):
+        buf = accurip.numpy.arange(4000, dtype=accurip.numpy.uint32)
+        checksums = accurip.shifted_checksums(buf, 100, 3000, [-5, 5], 2, 3,
+                                              v2=False)
+        self.assertEqual(checksums[-5], (_reference_checksums(
+            range(95, 3095), 2, 3)[0], None))
+
+
+class TestFindPressingOffset(TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp(suffix='whipper_accurip_pressing_test')
+        self.addCleanup(rmtree, self.tmpdir)
+
+    @skipUnless(accurip.numpy, 'numpy is not available')
+    def test_finds_offset_of_other_pressing(self):
+        rand = random.Random(4)
+        lengths = (6000, 4000, 7000)
+        disc = [rand.randint(0, 0xffffffff) for _ in range(sum(lengths))]
+        paths = []
+        starts = []
+        for i, length in enumerate(lengths):
+            start = sum(lengths[:i])
+            starts.append(start)
+            path = join(self.tmpdir, 'track%d.wav' % i)
+            w = wave.open(path, 'wb')
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(struct.pack('<%dI' % length,
+                                      *disc[start:start + length]))
+            w.close()
+            paths.append(path)
+
+        # the other pressing has its audio 123 samples later on the disc
+        padded = [0] * 123 + disc + [0] * 123
+        crcs = [_reference_checksums(
+            padded[first + 246:first + 246 + length], i + 1, 3)[0]
+            for i, (first, length) in enumerate(zip(starts, lengths))]
+        raw = struct.pack('<B3L', 3, 1, 2, 3)
+        for crc in crcs:
+            raw += struct.pack('<BLL', 7, crc, 0)
+        responses = _split_responses(raw)
+
+        self.assertEqual(
+            accurip.find_pressing_offset(paths, responses, 200),
+            (0, 123, 3))
+        self.assertEqual(
+            accurip.find_pressing_offset(paths, responses, 100), None)
+
+
+class TestMatchTrack(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        path = 'c/1/2/dBAR-002-0000f21c-00027ef8-05021002.bin'
+        cls.responses = _split_responses(
+            open(join(dirname(__file__), path[6:])).read()
+        )
+
+    def test_returns_highest_confidence(self):
+        self.assertEqual(
+            match_track(self.responses, 1, [0x284fc705, 0xdc77f9ab]), 12)
+        self.assertEqual(match_track(self.responses, 2, [None, 0xdd97d2c3]),
+                         5)
+
+    def test_returns_zero_without_match(self):
+        self.assertEqual(match_track(self.responses, 1, [0x9cc1f32e, None]),
+                         0)
+        self.assertEqual(match_track(self.responses, 0, [0x284fc705]), 0)
+        self.assertEqual(match_track(self.responses, 3, [0x284fc705]), 0)
+
+    def test_has_track(self):
+        self.assertTrue(has_track(self.responses, 1))
+        self.assertTrue(has_track(self.responses, 2))
+        self.assertFalse(has_track(self.responses, 0))
+        self.assertFalse(has_track(self.responses, 3))
 
 
 class TestVerifyResult(TestCase):
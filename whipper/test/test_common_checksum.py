@@ -0,0 +1,137 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_checksum -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import binascii
+import os
+import random
+import struct
+import tempfile
+import wave
+
+from whipper.common import accurip, checksum, common
+from whipper.extern.task import task
+from whipper.program import flac
+
+from whipper.test import common as tcommon
+
+
+class WaveTestCase(tcommon.TestCase):
+
+    length = 9000
+
+    def setUp(self):
+        rand = random.Random(3)
+        self.samples = [rand.randint(0, 0xffffffff)
+                        for _ in range(self.length)]
+        self.data = struct.pack('<%dI' % len(self.samples), *self.samples)
+
+        fd, self.path = tempfile.mkstemp(suffix=u'.whipper.test.wav')
+        os.close(fd)
+        w = wave.open(self.path, 'wb')
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(self.data)
+        w.close()
+
+        self.runner = task.SyncRunner(verbose=False)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+
+class CRC32TestCase(WaveTestCase):
+
+    def testWhole(self):
+        t = checksum.CRC32Task(self.path)
+        self.runner.run(t)
+        self.assertEqual(t.checksum, binascii.crc32(self.data) & 0xffffffff)
+
+    def testRange(self):
+        t = checksum.CRC32Task(self.path, sampleStart=1000, sampleLength=5000)
+        self.runner.run(t)
+        self.assertEqual(t.checksum,
+                         binascii.crc32(self.data[4000:24000]) & 0xffffffff)
+
+    def testMissingFrames(self):
+        t = checksum.CRC32Task(self.path, sampleStart=8000, sampleLength=5000)
+        e = self.assertRaises(task.TaskException, self.runner.run, t)
+        self.assertTrue(isinstance(e.exception, common.MissingFrames))
+
+
+class CRC32FlacTestCase(WaveTestCase):
+
+    # more audio than fits in a pipe, so flac is still decoding when the
+    # end of a range is read
+    length = 100000
+
+    def setUp(self):
+        WaveTestCase.setUp(self)
+        self.flacpath = self.path[:-len(u'.wav')] + u'.flac'
+        flac.encode(self.path, self.flacpath)
+
+    def tearDown(self):
+        os.unlink(self.flacpath)
+        WaveTestCase.tearDown(self)
+
+    def testWhole(self):
+        t = checksum.CRC32Task(self.flacpath, is_wave=False)
+        self.runner.run(t)
+        self.assertEqual(t.checksum, binascii.crc32(self.data) & 0xffffffff)
+
+    def testRange(self):
+        t = checksum.CRC32Task(self.flacpath, sampleStart=1000,
+                               sampleLength=5000, is_wave=False)
+        self.runner.run(t)
+        self.assertEqual(t.checksum,
+                         binascii.crc32(self.data[4000:24000]) & 0xffffffff)
+
+
+class TrackDigestTestCase(WaveTestCase):
+
+    def testDigest(self):
+        t = checksum.TrackDigestTask(self.path)
+        self.runner.run(t)
+
+        self.assertEqual(t.checksum, binascii.crc32(self.data) & 0xffffffff)
+        values = struct.unpack('<%dh' % (len(self.samples) * 2), self.data)
+        self.assertEqual(t.peak, max(abs(v) for v in values))
+        self.assertEqual(t.samples, len(self.samples))
+        self.assertEqual(t.v1, None)
+        self.assertEqual(t.v2, None)
+
+    def testAccurateRip(self):
+        if not accurip.numpy:
+            raise tcommon.unittest.SkipTest('numpy is not available')
+        t = checksum.TrackDigestTask(self.path, track_number=2,
+                                     total_tracks=2)
+        self.runner.run(t)
+
+        arc = accurip.AccurateRipChecksum(len(self.samples), 2, 2)
+        arc.update(self.data)
+        self.assertEqual((t.v1, t.v2), (arc.v1, arc.v2))
+
+    def testChunks(self):
+        t = checksum.TrackDigestTask(self.path)
+        t.chunkSamples = 4000
+        self.runner.run(t)
+
+        self.assertEqual(t.chunks, [
+            binascii.crc32(self.data[i:i + 16000]) & 0xffffffff
+            for i in range(0, len(self.data), 16000)])
+
+    def testStream(self):
+        t = checksum.TrackDigestTask(self.path)
+        t.chunkSamples = 4000
+        self.runner.run(t)
+
+        # pieces that do not line up with the blocks
+        digest = checksum.TrackDigest(len(self.samples), chunkSamples=4000)
+        for i in range(0, len(self.data), 1764 * 4):
+            digest.update(self.data[i:i + 1764 * 4])
+        digest.finish()
+
+        self.assertEqual(digest.checksum, t.checksum)
+        self.assertEqual(digest.chunks, t.chunks)
+        self.assertEqual(digest.peak, t.peak)
+        self.assertEqual(digest.samples, t.samples)
@@ -1,8 +1,13 @@
 # -*- Mode: Python; test-case-name: whipper.test.test_common_drive -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import os
+import shutil
+import tempfile
+import time
+
 from whipper.test import common
-from whipper.common import drive
+from whipper.common import config, drive
 
 
 class ListifyTestCase(common.TestCase):
@@ -14,3 +19,113 @@ class ListifyTestCase(common.TestCase):
     def testList(self):
         lst = ['/dev/scd0', '/dev/sr0']
         self.assertEqual(drive._listify(lst), lst)
+
+
+class DriveDatabaseTestCase(common.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp(suffix=u'.whipper.test.drive')
+        self._path = os.path.join(self._dir, u'drives.sqlite')
+        self._configPath = os.path.join(self._dir, u'whipper.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _open(self):
+        return drive.DriveDatabase(self._path, self._configPath)
+
+    def testReadOffset(self):
+        database = self._open()
+        self.assertRaises(KeyError, database.getReadOffset,
+                          'PLEXTOR ', 'DVDR   PX-L890SA', '1.05')
+        database.setReadOffset('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', 6)
+        self.assertEqual(database.getReadOffset(
+            'PLEXTOR', 'DVDR   PX-L890SA', '1.05 '), 6)
+
+        # other features stay unknown
+        self.assertRaises(KeyError, database.getDefeatsCache,
+                          'PLEXTOR ', 'DVDR   PX-L890SA', '1.05')
+
+        # and it is still there when opened again
+        self.assertEqual(self._open().getReadOffset(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), 6)
+
+    def testFeatures(self):
+        database = self._open()
+        database.set('HL-DT-ST', 'DVDRAM GH22NS50', 'TN03',
+                     defeats_cache=False, overread=True, read_speed=12.5)
+        database.set('HL-DT-ST', 'DVDRAM GH22NS50', 'TN03', c2=True)
+
+        features = self._open().get('HL-DT-ST', 'DVDRAM GH22NS50', 'TN03')
+        self.assertEqual(features, {
+            'read_offset': None,
+            'defeats_cache': False,
+            'overread': True,
+            'c2': True,
+            'read_speed': 12.5,
+        })
+        self.assertEqual(self._open().getDrives(),
+                         [('HL-DT-ST', 'DVDRAM GH22NS50', 'TN03')])
+
+    def testImportConfig(self):
+        conf = config.Config(self._configPath)
+        conf.setReadOffset('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', 6)
+        conf.setDefeatsCache('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', True)
+        database = self._open()
+        self.assertEqual(database.getReadOffset(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), 6)
+        self.assertEqual(database.getDefeatsCache(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), True)
+
+        # the configuration is only imported again when it changes
+        database.setReadOffset('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', 30)
+        self.assertEqual(self._open().getReadOffset(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), 30)
+
+        conf.setReadOffset('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', 667)
+        mtime = os.path.getmtime(self._configPath) + 1
+        os.utime(self._configPath, (mtime, mtime))
+        self.assertEqual(self._open().getReadOffset(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), 667)
+
+    def testImportConfigAfterSet(self):
+        conf = config.Config(self._configPath)
+        conf.setReadOffset('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', 6)
+        self._open().setReadOffset('PLEXTOR ', 'DVDR   PX-L890SA', '1.05',
+                                   30)
+
+        # changing something else does not bring back the older offset
+        conf = config.Config(self._configPath)
+        conf.setDefeatsCache('PLEXTOR ', 'DVDR   PX-L890SA', '1.05', True)
+        mtime = os.path.getmtime(self._configPath) + 1
+        os.utime(self._configPath, (mtime, mtime))
+        database = self._open()
+        self.assertEqual(database.getReadOffset(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), 30)
+        self.assertEqual(database.getDefeatsCache(
+            'PLEXTOR ', 'DVDR   PX-L890SA', '1.05'), True)
+
+    def testReadStats(self):
+        database = self._open()
+        drive1 = ('PLEXTOR ', 'DVDR   PX-L890SA', '1.05')
+        drive2 = ('HL-DT-ST', 'DVDRAM GH22NS50', 'TN03')
+        database.addRead(*drive1, position=0.1, frames=1000, speed=8.0,
+                         rereads=10, errors=1, quality=0.99)
+        database.addRead(*drive1, position=0.9, frames=1000, speed=16.0,
+                         rereads=0, errors=0, quality=1.0)
+        database.addRead(*drive1, position=0.5, frames=1000, ok=False)
+        database.addRead(*drive2, position=0.5, frames=3000, speed=20.0)
+
+        stats = self._open().getReadStats(recent=1)
+        self.assertEqual(sorted(stats), sorted([
+            ('PLEXTOR', 'DVDR   PX-L890SA', '1.05'),
+            ('HL-DT-ST', 'DVDRAM GH22NS50', 'TN03')]))
+        s = stats[('PLEXTOR', 'DVDR   PX-L890SA', '1.05')]
+        self.assertEqual((s['reads'], s['failed']), (3, 1))
+        self.assertEqual((s['speed'], s['max_speed']), (12.0, 16.0))
+        self.assertEqual(s['recent_speed'], 16.0)
+        self.assertEqual(s['zone_speed'], [8.0, None, 16.0])
+        self.assertEqual((s['frames'], s['rereads'], s['errors']),
+                         (3000, 10, 1))
+
+        self.assertEqual(database.getReadStats(since=time.time() + 60), {})
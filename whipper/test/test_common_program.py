@@ -4,7 +4,7 @@
 
 import unittest
 
-from whipper.common import program, mbngs, config
+from whipper.common import accurip, program, mbngs, config
 from whipper.command.cd import DEFAULT_DISC_TEMPLATE
 
 
@@ -40,3 +40,39 @@ class PathTestCase(unittest.TestCase):
         path = prog.getPath(u'/tmp', u'%A/%d', 'mbdiscid', md, 0)
         self.assertEqual(path,
                          u'/tmp/Jeff Buckley/Grace')
+
+
+class _Table(object):
+
+    def accuraterip_path(self):
+        return '0/0/0/dBAR-001-test.bin'
+
+
+class AccurateRipTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fetched = []
+        self.addCleanup(setattr, accurip, 'get_db_entry',
+                        accurip.get_db_entry)
+
+    def testFetchesOnce(self):
+        def get_db_entry(path):
+            self.fetched.append(path)
+            return ['response']
+        accurip.get_db_entry = get_db_entry
+
+        prog = program.Program(config.Config())
+        prog.prefetchAccurateRip(_Table())
+        prog.prefetchAccurateRip(_Table())
+        self.assertEqual(prog.getAccurateRip(_Table()), ['response'])
+        self.assertEqual(prog.getAccurateRip(_Table()), ['response'])
+        self.assertEqual(self.fetched, ['0/0/0/dBAR-001-test.bin'])
+
+    def testEntryNotFound(self):
+        def get_db_entry(path):
+            raise accurip.EntryNotFound
+        accurip.get_db_entry = get_db_entry
+
+        prog = program.Program(config.Config())
+        self.assertRaises(accurip.EntryNotFound, prog.getAccurateRip,
+                          _Table())
@@ -0,0 +1,87 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_common_task -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+from whipper.common import task as ctask
+from whipper.extern.task import task
+
+from whipper.test import common as tcommon
+
+
+class EchoTask(ctask.PopenTask):
+
+    command = ['sh', '-c', 'echo out; echo err >&2; echo more; exit 3']
+
+    def __init__(self):
+        self.out = ''
+        self.err = ''
+        self.returncode = None
+
+    def readbytesout(self, bytes):
+        self.out += bytes
+
+    def readbyteserr(self, bytes):
+        self.err += bytes
+
+    def failed(self):
+        self.returncode = self._popen.returncode
+
+
+class PopenTaskTestCase(tcommon.TestCase):
+
+    def testOutput(self):
+        t = EchoTask()
+        task.SyncRunner(verbose=False).run(t)
+
+        self.assertEqual(t.out, 'out\nmore\n')
+        self.assertEqual(t.err, 'err\n')
+        self.assertEqual(t.returncode, 3)
+
+
+class SleepTask(ctask.PopenTask):
+
+    command = ['sleep', '0.2']
+
+    def __init__(self, counter):
+        self._counter = counter
+
+    def start(self, runner):
+        self._counter.append(self)
+        self._counter.running += 1
+        self._counter.most = max(self._counter.most, self._counter.running)
+        ctask.PopenTask.start(self, runner)
+
+    def done(self):
+        self._counter.running -= 1
+
+
+class Counter(list):
+    running = 0
+    most = 0
+
+
+class MultiParallelTaskTestCase(tcommon.TestCase):
+
+    def testParallel(self):
+        counter = Counter()
+        t = task.MultiParallelTask(workers=3)
+        for _ in range(5):
+            t.addTask(SleepTask(counter))
+        task.SyncRunner(verbose=False).run(t)
+
+        self.assertEqual(len(counter), 5)
+        self.assertEqual(counter.most, 3)
+        self.assertEqual(t.progress, 1.0)
+
+    def testFailure(self):
+        counter = Counter()
+        t = task.MultiParallelTask(workers=2)
+        t.addTask(EchoTask())
+        t.addTask(SleepTask(counter))
+        t.addTask(SleepTask(counter))
+        t.tasks[0].failed = lambda: t.tasks[0].setException(ValueError())
+        self.assertRaises(task.TaskException,
+                          task.SyncRunner(verbose=False).run, t)
+
+        # the running task finished, but no new one was started
+        self.assertEqual(len(counter), 1)
+        self.assertEqual(counter.running, 0)
@@ -1,11 +1,21 @@
 # -*- Mode: Python; test-case-name: whipper.test.test_program_cdparanoia -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
+import json
 import os
-
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+from whipper.common import accurip, checksum, common as wcommon, encode
 from whipper.extern.task import task
 
-from whipper.program import cdparanoia
+from whipper.program import cdparanoia, flac, libcdio
 
 from whipper.test import common
 
@@ -27,6 +37,20 @@ class ParseTestCase(common.TestCase):
         q = '%.01f %%' % (self._parser.getTrackQuality() * 100.0, )
         self.assertEqual(q, '99.6 %')
 
+    def testReadCounts(self):
+        for line in self._handle.readlines():
+            self._parser.parse(line)
+
+        counts = self._parser.getReadCounts()
+        self.assertEqual(len(counts), 47719 - 45990 + 1)
+        self.assertEqual(sum(counts), self._parser.reads)
+        self.assertEqual(self._parser.getReadHistogram(),
+                         {1: 14, 2: 1702, 3: 1, 4: 13})
+        self.assertEqual(self._parser.getRereads(), 27)
+        self.assertEqual(self._parser.getSuspectFrames(), [(47175, 47188)])
+        q = '%.01f %%' % (self._parser.getFrameQuality() * 100.0, )
+        self.assertEqual(q, '99.2 %')
+
 
 class Parse1FrameTestCase(common.TestCase):
 
@@ -62,6 +86,411 @@ class ErrorTestCase(common.TestCase):
         q = '%.01f %%' % (self._parser.getTrackQuality() * 100.0, )
         self.assertEqual(q, '79.6 %')
 
+    def testSuspectFrames(self):
+        for line in self._handle.readlines():
+            self._parser.parse(line)
+
+        self.assertEqual(self._parser.getSuspectFrames(), [(3, 1196)])
+        self.assertEqual(self._parser.getReadHistogram()[0], 9604)
+
+
+class MergeRangesTestCase(common.TestCase):
+
+    def testMerge(self):
+        self.assertEqual(cdparanoia._mergeRanges(
+            [(10, 20), (1, 3), (4, 5), (15, 25), (30, 30)]),
+            [(1, 5), (10, 25), (30, 30)])
+
+
+class VerifierTestCase(common.TestCase):
+
+    def setUp(self):
+        self.data = ''.join(chr(i % 251) for i in range(10000))
+        self.digest = checksum.TrackDigest(len(self.data) // 4,
+                                           chunkSamples=1000)
+        self.digest.update(self.data)
+        self.digest.finish()
+
+    def testMatch(self):
+        v = cdparanoia._Verifier(self.digest)
+        for i in range(0, len(self.data), 3000):
+            self.assertTrue(v.update(self.data[i:i + 3000]))
+        self.assertTrue(v.finish())
+        self.assertEqual(v.chunks, self.digest.chunks)
+
+    def testDiffer(self):
+        v = cdparanoia._Verifier(self.digest)
+        data = self.data[:5000] + 'x' + self.data[5001:]
+        self.assertTrue(v.update(data[:4000]))
+        self.assertFalse(v.update(data[4000:]))
+        self.assertEqual(v.divergence, 1000)
+
+    def testShorter(self):
+        v = cdparanoia._Verifier(self.digest)
+        self.assertTrue(v.update(self.data[:8000]))
+        self.assertFalse(v.finish())
+        self.assertEqual(v.divergence, 2000)
+
+
+class _Disc(object):
+    """
+    A disc on which every audio sample is its own position, except on the
+    bad reads of a frame, which each return different noise.
+    """
+
+    def __init__(self, leadout, bad=None):
+        self.leadout = leadout
+        self.reads = {}  # frame -> times it was read
+        self._bad = bad or {}  # frame -> which of its reads are bad
+
+    def read(self, lsn, count):
+        data = []
+        for frame in range(lsn, lsn + count):
+            n = self.reads.get(frame, 0)
+            self.reads[frame] = n + 1
+            first = frame * wcommon.SAMPLES_PER_FRAME
+            samples = range(first, first + wcommon.SAMPLES_PER_FRAME)
+            if n in self._bad.get(frame, ()):
+                samples = [s ^ ((n + 1) << 24) for s in samples]
+            data.append(struct.pack('<%dI' % len(samples), *samples))
+        return ''.join(data)
+
+    def close(self):
+        pass
+
+
+class _Reader(libcdio.ReadTrackTask):
+    """
+    I read tracks from the disc of the test instead of from a drive.
+    """
+
+    disc = None
+
+    def _open(self):
+        self._cdrom = self.disc
+        return self.disc.read
+
+
+class _Table(object):
+    leadout = 1350  # three blocks of the digests
+    tracks = [None]
+
+    def getTrackStart(self, number):
+        return 0
+
+    def getTrackEnd(self, number):
+        return self.leadout - 1
+
+    def getAudioTracks(self):
+        return 1
+
+
+# reads the disc of _Disc the way cd-paranoia does, keeping the reads of
+# each frame in a file; hangs after writing the frame to pause at, if it
+# wrote noise before
+_CDPARANOIA = r"""#!%(python)s
+import json
+import os
+import re
+import struct
+import sys
+import time
+
+bad = %(bad)r
+pause = %(pause)r
+with open(%(state)r) as f:
+    reads = dict((int(k), v) for k, v in json.load(f).items())
+
+def frame(hmsf):
+    h, m, s, f = [int(n) for n in re.split('[:.]', hmsf)]
+    return ((h * 60 + m) * 60 + s) * 75 + f
+
+span, path = sys.argv[-2:]
+start, stop = [frame(hmsf) for hmsf in re.findall(r'\[(.*?)\]', span)]
+total = (stop - start + 1) * 2352
+if path == '-':
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+else:
+    out = open(path, 'wb')
+    out.write(b'RIFF' + struct.pack('<I', 36 + total) + b'WAVEfmt ' +
+              struct.pack('<IHHIIHH', 16, 1, 2, 44100, 176400, 4, 16) +
+              b'data' + struct.pack('<I', total))
+
+noise = False
+for first in range(start, stop + 1, 75):
+    for n in range(first, min(first + 75, stop + 1)):
+        count = reads.get(n, 0)
+        reads[n] = count + 1
+        samples = range(n * 588, (n + 1) * 588)
+        if count in bad.get(n, ()):
+            samples = [s ^ ((count + 1) << 24) for s in samples]
+            noise = True
+        out.write(struct.pack('<588I', *samples))
+        sys.stderr.write('##: 0 [read] @ %%d\n' %% (n * 1176))
+        sys.stderr.write('##: -2 [wrote] @ %%d\n' %% ((n + 1) * 1176 - 1))
+    out.flush()
+    sys.stderr.flush()
+    with open(%(state)r + '.part', 'w') as f:
+        json.dump(reads, f)
+    os.rename(%(state)r + '.part', %(state)r)
+    if noise and pause is not None and first <= pause < first + 75:
+        time.sleep(60)
+"""
+
+
+def _fakeCdParanoia(testCase, directory, bad=None, pause=None):
+    """
+    Make cdparanoia run _CDPARANOIA instead of cd-paranoia.
+
+    @returns: reads the number of times each frame was read
+    """
+    state = os.path.join(directory, 'reads.json')
+    with open(state, 'w') as f:
+        f.write('{}')
+    script = os.path.join(directory, 'cd-paranoia')
+    with open(script, 'w') as f:
+        f.write(_CDPARANOIA % dict(python=sys.executable, bad=bad or {},
+                                   pause=pause, state=state))
+    os.chmod(script, 0o755)
+    testCase.patch(cdparanoia, 'CDPARANOIA', script)
+
+    def reads():
+        with open(state) as f:
+            return dict((int(k), v) for k, v in json.load(f).items())
+
+    return reads
+
+
+class ReadTrackTestCase(common.TestCase):
+
+    def setUp(self):
+        self.runner = task.SyncRunner(verbose=False)
+        self.table = _Table()
+        self.dir = tempfile.mkdtemp(suffix=u'.whipper.test')
+        self.path = os.path.join(self.dir, u'track.wav')
+
+        audio = _Disc(self.table.leadout).read(0, self.table.leadout)
+        self.digest = checksum.TrackDigest(len(audio) // 4)
+        self.digest.update(audio)
+        self.digest.finish()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testVerify(self):
+        _fakeCdParanoia(self, self.dir)
+        t = cdparanoia.ReadTrackTask(self.path, self.table, 0,
+                                     self.table.leadout - 1, False,
+                                     verify=self.digest)
+        self.runner.run(t)
+        self.assertEqual(t.divergence, None)
+        self.assertEqual(t.chunks, self.digest.chunks)
+
+    def testVerifyDiffers(self):
+        # cd-paranoia hangs after the differing block, until it is stopped
+        reads = _fakeCdParanoia(self, self.dir, bad={500: [0]}, pause=900)
+        t = cdparanoia.ReadTrackTask(self.path, self.table, 0,
+                                     self.table.leadout - 1, False,
+                                     verify=self.digest)
+        then = time.time()
+        e = self.assertRaises(task.TaskException, self.runner.run, t)
+        self.assertTrue(isinstance(e.exception, cdparanoia.ChecksumException))
+        self.assertEqual(t.divergence, 450 * wcommon.SAMPLES_PER_FRAME)
+        # the read was stopped without reading the rest of the track
+        self.assertTrue(time.time() - then < 30)
+        self.assertFalse(self.table.leadout - 1 in reads())
+
+
+class ReadVerifyTrackTestCase(common.TestCase):
+
+    def setUp(self):
+        self.runner = task.SyncRunner(verbose=False)
+        self.table = _Table()
+        self.audio = _Disc(self.table.leadout).read(0, self.table.leadout)
+        self.bin = tempfile.mkdtemp(suffix=u'.whipper.test')
+        self.dir = tempfile.mkdtemp(suffix=u'.whipper.test')
+        self.path = os.path.join(self.dir, u'track.flac')
+        # so temporary files that are left behind are noticed
+        self.patch(tempfile, 'tempdir', self.dir)
+
+        readers = {'cdparanoia': cdparanoia.ReadTrackTask,
+                   'libcdio': _Reader}
+        self.patch(cdparanoia, 'getReadTrackTask',
+                   lambda backend='cdparanoia': readers[backend])
+        # there may be no flac; copy, so the output can be compared
+        self.patch(flac, 'encode_command',
+                   lambda infile, outfile: ['cp', infile, outfile])
+        self.patch(flac, 'stream_encode_command',
+                   lambda outfile: ['sh', '-c', 'cat > "$0"', outfile])
+        self.patch(encode, 'tag', lambda path, tags: None)
+
+    def tearDown(self):
+        shutil.rmtree(self.bin)
+        shutil.rmtree(self.dir)
+
+    def _rip(self, bad=None, pause=None, backend='libcdio', **kwargs):
+        if backend == 'cdparanoia':
+            self.reads = _fakeCdParanoia(self, self.bin, bad, pause)
+        else:
+            self.disc = _Disc(self.table.leadout, bad)
+            self.patch(_Reader, 'disc', self.disc)
+            self.reads = lambda: self.disc.reads
+        t = self.task = cdparanoia.ReadVerifyTrackTask(
+            self.path, self.table, 0, self.table.leadout - 1, False,
+            number=1, backend=backend, **kwargs)
+        self.runner.run(t)
+        return t
+
+    def _responses(self, confidence):
+        digest = checksum.TrackDigest(len(self.audio) // 4, 1, 1)
+        digest.update(self.audio)
+        digest.finish()
+        data = struct.pack('<B3LBLL', 1, 0, 0, 0, confidence, digest.v1, 0)
+        return [accurip._AccurateRipResponse(data)]
+
+    def _ripped(self, path=None):
+        w = wave.open(path or self.path)
+        try:
+            return w.readframes(w.getnframes())
+        finally:
+            w.close()
+
+    def _assertClean(self):
+        # nothing but the ripped track is left behind
+        self.assertEqual(os.listdir(self.dir),
+                         os.path.exists(self.path) and [u'track.flac'] or [])
+
+    def testFinish(self):
+        t = self._rip(encode=False)
+        self.assertFalse(os.path.exists(self.path))
+
+        # the track is encoded later, in another thread
+        thread = threading.Thread(target=t.finish)
+        thread.start()
+        thread.join()
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
+    def testFinishFails(self):
+        t = self._rip(encode=False)
+        self.patch(flac, 'encode_command', lambda infile, outfile: ['false'])
+        self.assertRaises(subprocess.CalledProcessError, t.finish)
+        self.assertFalse(os.path.exists(self.path))
+        self._assertClean()
+
+    def testStream(self):
+        for backend in ('libcdio', 'cdparanoia'):
+            t = self._rip(stream=True, backend=backend)
+            self.assertEqual(t.checksum, t.copychecksum)
+            # the copy read was encoded as it was read
+            with open(self.path, 'rb') as f:
+                self.assertEqual(f.read(), self.audio)
+            os.unlink(self.path)
+            self._assertClean()
+
+    def testStreamCopyDiffers(self):
+        e = self.assertRaises(task.TaskException, self._rip,
+                              bad={500: [1]}, pause=900, stream=True,
+                              backend='cdparanoia')
+        self.assertTrue(isinstance(e.exception, cdparanoia.ChecksumException))
+        self.assertEqual(self.reads()[self.table.leadout - 1], 1)
+        # the encoding was given up on
+        self.assertEqual(self.task._encoder._popen, None)
+        self._assertClean()
+
+    def testCopyDiffers(self):
+        # cd-paranoia hangs after the differing block, until it is stopped
+        e = self.assertRaises(task.TaskException, self._rip,
+                              bad={500: [1]}, pause=900,
+                              backend='cdparanoia')
+        self.assertTrue(isinstance(e.exception, cdparanoia.ChecksumException))
+        # only the test read got to the end
+        self.assertEqual(self.reads()[self.table.leadout - 1], 1)
+        self._assertClean()
+
+    def testRepair(self):
+        t = self._rip(bad={500: [1]}, repair=2)
+
+        # the copy read stopped at the block that differed, so only the
+        # track from there on was read again
+        reads = self.disc.reads
+        self.assertEqual((reads[449], reads[450], reads[1349]), (2, 3, 2))
+        self.assertTrue(t._repair.repaired)
+        self.assertTrue(t._repair.duration > 0)
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
+    def testRepairTestRead(self):
+        # the copy read and the read again outvote the test read
+        t = self._rip(bad={500: [0]}, repair=2)
+
+        self.assertEqual(self.disc.reads[500], 3)
+        self.assertEqual(t.checksum, t.copychecksum)
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
+    def testRepairFails(self):
+        # no two reads agree on the block
+        e = self.assertRaises(task.TaskException, self._rip,
+                              bad={500: [1, 2, 3]}, repair=2)
+        self.assertTrue(isinstance(e.exception, cdparanoia.ChecksumException))
+        self.assertEqual(self.disc.reads[500], 4)
+        self._assertClean()
+
+    def testSingleRead(self):
+        if not accurip.numpy:
+            raise common.unittest.SkipTest('numpy is not available')
+        t = self._rip(responses=self._responses(5), confidence=2)
+
+        # the copy read was skipped
+        self.assertEqual(self.disc.reads[0], 1)
+        self.assertEqual(t.arconfidence, 5)
+        self.assertEqual(t.copyduration, 0.0)
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
+    def testSingleReadStream(self):
+        if not accurip.numpy:
+            raise common.unittest.SkipTest('numpy is not available')
+        self._rip(responses=self._responses(5), confidence=2, stream=True)
+
+        # the test read was encoded as it was read
+        self.assertEqual(self.disc.reads[0], 1)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.audio)
+        self._assertClean()
+
+    def testSingleReadNotConfident(self):
+        if not accurip.numpy:
+            raise common.unittest.SkipTest('numpy is not available')
+        t = self._rip(responses=self._responses(1), confidence=2)
+
+        self.assertEqual(self.disc.reads[0], 2)
+        self.assertEqual(t.arconfidence, 1)
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
+    def testSingleReadNotInEntry(self):
+        t = self._rip(responses=self._responses(0), confidence=2)
+
+        # no AccurateRip checksums were calculated for the test read
+        self.assertEqual(self.disc.reads[0], 2)
+        self.assertEqual((t._testDigest.v1, t._testDigest.v2), (None, None))
+        self.assertEqual(t.arconfidence, None)
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
+    def testConfirmedTestReadCopyDiffers(self):
+        if not accurip.numpy:
+            raise common.unittest.SkipTest('numpy is not available')
+        t = self._rip(bad={500: [1]}, responses=self._responses(1),
+                      confidence=2)
+
+        self.assertEqual(t.arconfidence, 1)
+        self.assertEqual(t.checksum, t.copychecksum)
+        self.assertEqual(self._ripped(), self.audio)
+        self._assertClean()
+
 
 class VersionTestCase(common.TestCase):
 
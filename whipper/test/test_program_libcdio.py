@@ -0,0 +1,137 @@
+# -*- Mode: Python; test-case-name: whipper.test.test_program_libcdio -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import struct
+
+from whipper.common import common
+from whipper.extern.task import task
+from whipper.program import libcdio
+
+from whipper.test import common as tcommon
+
+
+class _Disc(object):
+    """
+    A disc on which every audio sample is its own position.
+    """
+
+    def __init__(self, leadout, overread=0, failures=None):
+        self.leadout = leadout
+        self._overread = overread  # frames the drive can read past the end
+        self._failures = failures or {}  # frame -> times to fail on it
+
+    def read(self, lsn, count):
+        if lsn < 0 or lsn + count > self.leadout + self._overread:
+            raise IOError('cannot read frames %d to %d' % (
+                lsn, lsn + count - 1))
+        for frame in range(lsn, lsn + count):
+            if self._failures.get(frame):
+                self._failures[frame] -= 1
+                raise IOError('error on frame %d' % frame)
+
+        first = lsn * common.SAMPLES_PER_FRAME
+        last = (lsn + count) * common.SAMPLES_PER_FRAME
+        return struct.pack('<%dI' % (last - first), *range(first, last))
+
+
+def _samples(data):
+    return list(struct.unpack('<%dI' % (len(data) // 4), data))
+
+
+def _expected(first, last, end):
+    # the samples first to last (exclusive), silent outside of 0 to end
+    return [0 <= s < end and s or 0 for s in range(first, last)]
+
+
+class ReadAudioTestCase(tcommon.TestCase):
+
+    def _read(self, disc, start, stop, offset=0, overread=False):
+        stats = {}
+        data = ''.join(libcdio.read_audio(disc.read, start, stop,
+                                          disc.leadout, offset, overread,
+                                          stats))
+        return _samples(data), stats
+
+    def testOffset(self):
+        disc = _Disc(1000)
+        for offset in (0, 6, -472, 667, 1176):
+            samples, stats = self._read(disc, 100, 299, offset)
+            first = 100 * common.SAMPLES_PER_FRAME + offset
+            self.assertEqual(samples, _expected(
+                first, first + 200 * common.SAMPLES_PER_FRAME,
+                1000 * common.SAMPLES_PER_FRAME))
+            self.assertEqual(stats['rereads'], 0)
+            # a frame more is read when the offset is not frame-aligned
+            self.assertEqual(stats['frames'], offset % 588 and 201 or 200)
+            self.assertEqual(stats['reads'], stats['frames'])
+
+    def testEdges(self):
+        # without overread, audio outside of the disc is silence
+        disc = _Disc(1000, overread=10)
+        end = 1000 * common.SAMPLES_PER_FRAME
+        samples, _ = self._read(disc, 0, 99, -1000)
+        self.assertEqual(samples, _expected(-1000, 100 * 588 - 1000, end))
+        samples, _ = self._read(disc, 900, 999, 1000)
+        self.assertEqual(samples, _expected(900 * 588 + 1000, end + 1000,
+                                            end))
+
+    def testOverread(self):
+        disc = _Disc(1000, overread=10)
+        end = 1000 * common.SAMPLES_PER_FRAME
+        samples, _ = self._read(disc, 900, 999, 1000, overread=True)
+        self.assertEqual(samples, range(900 * 588 + 1000, end + 1000))
+
+        # the lead-in can't be read, so it is silence after all
+        samples, _ = self._read(disc, 0, 99, -1000, overread=True)
+        self.assertEqual(samples, _expected(-1000, 100 * 588 - 1000, end))
+
+    def testErrors(self):
+        disc = _Disc(1000, failures={150: 2})
+        samples, stats = self._read(disc, 100, 299)
+        self.assertEqual(samples, range(100 * 588, 300 * 588))
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['rereads'], 2 * libcdio._BLOCK_FRAMES)
+        self.assertEqual(stats['reads'], 200 + stats['rereads'])
+        self.assertEqual(stats['suspects'], [(100, 174)])
+
+        disc = _Disc(1000, failures={150: libcdio._TRIES})
+        e = self.assertRaises(libcdio.ReadError, self._read, disc, 100, 299)
+        self.assertEqual((e.first, e.last), (100, 174))
+
+
+class _Reader(libcdio.ReadTrackTask):
+    """
+    I read tracks from the disc of the test instead of from a drive.
+    """
+
+    disc = None
+
+    def _open(self):
+        self._cdrom = self
+        return self.disc.read
+
+    def close(self):
+        pass
+
+
+class _Table(object):
+    leadout = 1000
+
+
+class ReadTrackTestCase(tcommon.TestCase):
+
+    def testQuality(self):
+        runner = task.SyncRunner(verbose=False)
+        for offset, quality in ((0, 200.0 / 275), (6, 201.0 / 276)):
+            self.patch(_Reader, 'disc', _Disc(1000, failures={150: 1}))
+            t = _Reader(None, _Table(), 100, 299, False, offset=offset)
+            runner.run(t)
+            self.assertEqual(t.quality, quality)
+
+        # without errors, the frame read for the offset is not held
+        # against the quality
+        self.patch(_Reader, 'disc', _Disc(1000))
+        for offset in (0, 6, -472):
+            t = _Reader(None, _Table(), 100, 299, False, offset=offset)
+            runner.run(t)
+            self.assertEqual(t.quality, 1.0)
@@ -1,11 +1,13 @@
 # -*- Mode: Python; test-case-name: whipper.test.test_program_sox -*-
 
 import os
+import struct
 import tempfile
+import wave
 
 from whipper.common import common
 from whipper.extern.task import task
-from whipper.program.soxi import AudioLengthTask
+from whipper.program.soxi import AudioLengthTask, audio_length
 from whipper.test import common as tcommon
 
 base_track_file = os.path.join(os.path.dirname(__file__), u'track.flac')
@@ -22,6 +24,47 @@ class AudioLengthTestCase(tcommon.TestCase):
         self.assertEqual(t.length, base_track_length)
 
 
+class HeaderLengthTestCase(tcommon.TestCase):
+
+    def testFlac(self):
+        self.assertEqual(audio_length(base_track_file), base_track_length)
+
+    def testWave(self):
+        fd, path = tempfile.mkstemp(suffix=u'.whipper.test.wav')
+        os.close(fd)
+        w = wave.open(path, 'wb')
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes('\0' * 4 * base_track_length)
+        w.close()
+
+        self.assertEqual(audio_length(path), base_track_length)
+        os.unlink(path)
+
+    def testWaveOddChunks(self):
+        # a fmt chunk with an extension of a single byte, and another
+        # chunk of odd size before the data, both padded to an even size
+        fmt = struct.pack('<HHIIHHH', 1, 2, 44100, 44100 * 4, 4, 16, 1) + \
+            '\0'
+        data = '\0' * 4 * base_track_length
+        chunks = ''.join([struct.pack('<4sI', chunkId, len(chunk)) + chunk +
+                          '\0' * (len(chunk) & 1)
+                          for chunkId, chunk in [('fmt ', fmt),
+                                                 ('LIST', 'odd'),
+                                                 ('data', data)]])
+        fd, path = tempfile.mkstemp(suffix=u'.whipper.test.wav')
+        with os.fdopen(fd, 'wb') as f:
+            f.write('RIFF' + struct.pack('<I', 4 + len(chunks)) + 'WAVE' +
+                    chunks)
+
+        self.assertEqual(audio_length(path), base_track_length)
+        os.unlink(path)
+
+    def testUnknown(self):
+        self.assertEqual(audio_length(__file__), None)
+
+
 class AudioLengthPathTestCase(tcommon.TestCase):
 
     def _testSuffix(self, suffix):